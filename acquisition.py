@@ -0,0 +1,78 @@
+'''
+Pacing of the middle server's reads of the RP data queue. Every get_GPI_data reply says how many
+samples had queued up since the previous read, so the next read is timed to find about a target
+number of samples waiting: reads come sooner when the queue filled faster than expected (or a slow
+round trip let it grow), and later while nothing needs fresh data. No extra round trip is needed to
+check the queue length. With blocking reads (get_GPI_data_blocking), reads are sent a little early
+and the board replies as soon as the target is reached.
+'''
+
+import collections
+
+
+MIN_INTERVAL = 0.01 # seconds, shortest time between reads
+MAX_INTERVAL = 1 # seconds, longest time between reads
+INFLOW_SMOOTHING = 0.2 # weight of the newest read in the measured sample rate
+HISTORY = 1000 # number of reads kept for statistics
+
+
+class AcquisitionPacer:
+    def __init__(self, sampleRate, capacity, minInterval=MIN_INTERVAL, maxInterval=MAX_INTERVAL, lead=0):
+        '''
+        Args:
+            sampleRate: (float) nominal samples per second entering the queue
+            capacity: (int) queue length at which the oldest samples are dropped
+            minInterval: (float) seconds, shortest time between reads
+            maxInterval: (float) seconds, longest time between reads
+            lead: (float) seconds before the target is expected to send a blocking read
+        '''
+        self.capacity = capacity
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.lead = lead
+        # Measured samples per second entering the queue
+        self.inflow = sampleRate
+        self.nextRead = 0
+        self.lastEnd = None
+        self.interval = minInterval
+        # (samples read, round trip in seconds) of the latest reads
+        self.history = collections.deque(maxlen=HISTORY)
+
+    def due(self, now):
+        return now >= self.nextRead
+
+    def update(self, samples, start, end, target):
+        '''
+        Schedule the next read after one that returned samples.
+
+        Args:
+            samples: (int) number of samples the read returned
+            start: (float) wall time the read was sent
+            end: (float) wall time the reply arrived, about when the queue was emptied
+            target: (int) number of samples the next read should find waiting
+        Returns:
+            bool: True if the queue was full, so samples were lost
+        '''
+        # A full queue says nothing about the rate, only that samples were dropped
+        if self.lastEnd is not None and end > self.lastEnd and samples < self.capacity:
+            measured = samples/(end - self.lastEnd)
+            self.inflow += INFLOW_SMOOTHING*(measured - self.inflow)
+        self.lastEnd = end
+        self.history.append((samples, end - start))
+        # Aim for target samples at the next read, correcting for how far off this one was, so a
+        # slow round trip that let the queue grow brings the next read forward
+        interval = max(2*target - samples, 0)/max(self.inflow, 1)
+        self.interval = min(max(interval, self.minInterval), self.maxInterval)
+        self.nextRead = end + self.interval - self.lead
+        return samples >= self.capacity
+
+    def stats(self):
+        '''
+        Returns:
+            (int, float, float, float): number of reads, mean samples per read, mean and max round
+                trip in ms over the latest reads
+        '''
+        if not self.history:
+            return 0, 0, 0, 0
+        samples, roundTrips = zip(*self.history)
+        return len(samples), sum(samples)/len(samples), 1000*sum(roundTrips)/len(roundTrips), 1000*max(roundTrips)
@@ -0,0 +1,111 @@
+'''
+Flow rate analysis of puff pressure data. The plenum pressure derivative is taken with a
+Savitzky-Golay filter on the uniform sampling grid, which smooths and differentiates the whole
+trace in one vectorized pass.
+'''
+
+import numpy as np
+from scipy.signal import savgol_filter
+
+
+PLENUM_VOLUME = 0.802 # L
+FLOW_WINDOW = 0.01 # seconds, Savitzky-Golay window used to differentiate pressure
+PUFF_THRESHOLD = 0.2 # fraction of peak flow rate above which gas is considered to be flowing
+NOISE_THRESHOLD = 5 # flow must also exceed this many standard deviations of the flow rate noise
+MIN_PUFF_GAP = 0.005 # seconds, flow regions closer than this are merged into one puff
+MIN_PUFF_DURATION = 0.002 # seconds, shorter flow regions are ignored
+EDGE_AVERAGE = 0.005 # seconds of pressure averaged before/after a puff to measure injected gas
+
+
+def uniform_grid(t, p):
+    '''
+    Return (t, p) on a uniform time grid, resampling only if the input spacing is not uniform.
+    '''
+    dt = np.median(np.diff(t))
+    if np.allclose(np.diff(t), dt, rtol=1e-3, atol=0):
+        return t, p
+    tUniform = np.arange(t[0], t[-1], dt)
+    return tUniform, np.interp(tUniform, t, p)
+
+
+def flow_rate(t, p, window=FLOW_WINDOW, polyorder=2, volume=PLENUM_VOLUME):
+    '''
+    Smoothed flow rate out of the plenum.
+    Parameters
+        t: NumPy array of times in seconds
+        p: NumPy array of plenum pressures in mbar
+        window: float, smoothing window in seconds
+        polyorder: int, order of the Savitzky-Golay polynomial
+        volume: float, plenum volume in L
+    Returns
+        (NumPy array, NumPy array): uniform times and flow rate in mbar-L/s
+    '''
+    t, p = uniform_grid(np.asarray(t, dtype=float), np.asarray(p, dtype=float))
+    dt = t[1] - t[0]
+    n = max(polyorder + 1, int(round(window/dt))) | 1 # odd number of samples
+    n = min(n, len(p) - (1 - len(p) % 2))
+    return t, volume*savgol_filter(p, n, polyorder, deriv=1, delta=dt)
+
+
+def find_puffs(t, rate, threshold=PUFF_THRESHOLD, minGap=MIN_PUFF_GAP, minDuration=MIN_PUFF_DURATION):
+    '''
+    Find the start and stop times of puffs from a flow rate trace.
+    Returns
+        list of (start, stop) times in seconds
+    '''
+    # Robust estimate of the noise standard deviation from the median absolute deviation
+    noise = 1.4826*np.median(np.abs(rate - np.median(rate)))
+    magnitude = np.abs(rate - np.median(rate))
+    level = max(threshold*magnitude.max(), NOISE_THRESHOLD*noise)
+    flowing = magnitude > level
+    # Flow regions touching either end of the trace are incomplete (or filter edge effects) and
+    # are left out
+    edges = np.diff(flowing.astype(np.int8))
+    starts = list(np.flatnonzero(edges == 1) + 1)
+    stops = list(np.flatnonzero(edges == -1) + 1)
+    if flowing[0]:
+        stops = stops[1:]
+    if flowing[-1]:
+        starts = starts[:-1]
+    puffs = []
+    for start, stop in zip(starts, stops):
+        if puffs and t[start] - puffs[-1][1] < minGap:
+            puffs[-1] = (puffs[-1][0], t[stop-1])
+        else:
+            puffs.append((t[start], t[stop-1]))
+    return [(float(a), float(b)) for a, b in puffs if b - a >= minDuration]
+
+
+def injected_gas(t, p, start, stop, volume=PLENUM_VOLUME):
+    '''
+    Gas that left the plenum between start and stop, from the pressure drop.
+    Returns
+        float: mbar-L
+    '''
+    before = p[(t >= start - EDGE_AVERAGE) & (t < start)]
+    after = p[(t > stop) & (t <= stop + EDGE_AVERAGE)]
+    if not len(before) or not len(after):
+        return float('nan')
+    return float(volume*abs(before.mean() - after.mean()))
+
+
+def analyze_shot(t, p, window=FLOW_WINDOW):
+    '''
+    Flow rate, puff times and injected gas for one shot.
+    Parameters
+        t: NumPy array of times in seconds (relative to T1 for archived shots)
+        p: NumPy array of plenum pressures in mbar
+    Returns
+        dict with 't' and 'flow_rate' arrays, 'puffs' list of (start, stop), 'puff_gas' list of
+        mbar-L per puff and 'injected_gas' total in mbar-L
+    '''
+    t = np.asarray(t, dtype=float)
+    p = np.asarray(p, dtype=float)
+    tUniform, rate = flow_rate(t, p, window)
+    puffs = find_puffs(tUniform, rate)
+    puffGas = [injected_gas(t, p, start, stop) for start, stop in puffs]
+    return {'t': tUniform,
+            'flow_rate': rate,
+            'puffs': puffs,
+            'puff_gas': puffGas,
+            'injected_gas': float(np.nansum(puffGas))}
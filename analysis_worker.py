@@ -0,0 +1,72 @@
+'''
+Long-lived process that analyzes and plots shots for the GUI. It is started once, keeps SciPy and
+matplotlib imported and reuses one figure, so a post-shot plot costs only the analysis and
+rendering time instead of a new interpreter launch per shot.
+'''
+
+import queue
+import multiprocessing
+
+
+PNG_DPI = 300
+
+
+def worker_main(jobs, results):
+    '''
+    Worker process loop. Each job is (archive folder, shot id); each result is (shot id, PNG path,
+    summary dict, error string or None).
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from plot_shot import load_shot, draw_shot
+    from analysis import analyze_shot
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        folder, shotId = job
+        try:
+            name, t, dp = load_shot([folder, shotId])
+            result = analyze_shot(t, dp)
+            draw_shot(fig, name, t, dp, result)
+            fig.savefig(name + '.png', dpi=PNG_DPI)
+            summary = {key: result[key] for key in ['puffs', 'puff_gas', 'injected_gas']}
+            results.put((shotId, name + '.png', summary, None))
+        except Exception as e:
+            results.put((shotId, None, None, '%s: %s' % (type(e).__name__, e)))
+
+
+class AnalysisWorker:
+    def __init__(self):
+        # Spawn rather than fork so the worker does not inherit the GUI's Tk state
+        ctx = multiprocessing.get_context('spawn')
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(target=worker_main, args=(self.jobs, self.results), name='AnalysisWorker', daemon=True)
+        self.process.start()
+
+    def submit(self, folder, shotId):
+        '''
+        Queue a shot from the archive in folder for analysis and plotting.
+        '''
+        self.jobs.put((folder, shotId))
+
+    def getResults(self):
+        '''
+        Return list of results that have finished since the last call, without blocking.
+        '''
+        finished = []
+        while True:
+            try:
+                finished.append(self.results.get_nowait())
+            except queue.Empty:
+                return finished
+
+    def stop(self):
+        self.jobs.put(None)
+        self.process.join(timeout=1)
@@ -0,0 +1,153 @@
+'''
+Analyze every shot in a shot data folder in parallel and write a summary table.
+
+Usage: python3 analyze_campaign.py [folder] [--workers N]
+
+Shots are read from the folder's shot archive (index.jsonl) as well as from older
+diff_pressure_<T1>.npy files. Results are cached in analysis_cache.json, keyed by a hash of each
+shot file's contents and of the analysis code and parameters, so re-runs only analyze new or
+changed shots, or all shots after the analysis has changed. The summary is written to
+analysis_summary.csv in the same folder.
+'''
+
+import os
+import re
+import csv
+import glob
+import json
+import inspect
+import hashlib
+import argparse
+import concurrent.futures
+import numpy as np
+from shot_archive import ShotArchive, load_shot_file
+import analysis
+from analysis import analyze_shot
+
+
+DEFAULT_FOLDER = 'shot_data' # SAVE_FOLDER in gui.py
+CACHE_FILE = 'analysis_cache.json'
+SUMMARY_FILE = 'analysis_summary.csv'
+FILL_AVERAGE = 0.01 # seconds of absolute pressure averaged for the fill pressure of old .npy shots
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def analysis_version():
+    '''
+    Hash of analysis.py (logic and parameters such as PUFF_THRESHOLD) and of analyze_file and
+    FILL_AVERAGE here. Cached results of another version are analyzed again.
+    '''
+    h = hashlib.sha1()
+    with open(analysis.__file__, 'rb') as f:
+        h.update(f.read())
+    h.update(inspect.getsource(analyze_file).encode('utf-8'))
+    h.update(repr(FILL_AVERAGE).encode('utf-8'))
+    return h.hexdigest()
+
+
+def find_shots(folder):
+    '''
+    Return list of (shot id, path) for archived shots and old-style .npy shots in folder.
+    '''
+    shots = []
+    if os.path.exists(os.path.join(folder, 'index.jsonl')):
+        archive = ShotArchive(folder)
+        shots += [(entry['shot_id'], archive.path(entry['shot_id'])) for entry in archive.listShots()]
+    archived = set(shotId for shotId, _ in shots)
+    for path in sorted(glob.glob(os.path.join(folder, 'diff_pressure_*.npy'))):
+        shotId = int(re.findall(r'diff_pressure_(\d+)\.npy', path)[0])
+        if shotId not in archived:
+            shots.append((shotId, path))
+    return shots
+
+
+def analyze_file(shotId, path):
+    '''
+    Analyze one shot file and return a JSON-serializable summary.
+    '''
+    if path.endswith('.npz'):
+        shot = load_shot_file(path)
+        t, dp = shot['t'], shot['diff']
+        fillPressure = shot.get('fill_pressure')
+    else:
+        t, dp = np.load(path)
+        fillPressure = None
+        absPath = path.replace('diff_pressure_', 'abs_pressure_')
+        if os.path.exists(absPath):
+            tAbs, pAbs = np.load(absPath)
+            fillPressure = float(pAbs[tAbs < tAbs[0] + FILL_AVERAGE].mean())
+    result = analyze_shot(t, dp)
+    return {'shot_id': shotId,
+            'fill_pressure': fillPressure,
+            'puffs': result['puffs'],
+            'puff_durations': [stop - start for start, stop in result['puffs']],
+            'puff_gas': result['puff_gas'],
+            'injected_gas': result['injected_gas']}
+
+
+def analyze_folder(folder, workers=None):
+    '''
+    Analyze all shots in folder that are not already in the cache, update the cache and write the
+    summary table.
+    Returns
+        list of per-shot summaries sorted by shot id
+    '''
+    cachePath = os.path.join(folder, CACHE_FILE)
+    cache = {}
+    if os.path.exists(cachePath):
+        with open(cachePath) as f:
+            cache = json.load(f)
+
+    jobs = {}
+    results = {}
+    version = analysis_version()
+    for shotId, path in find_shots(folder):
+        key = os.path.basename(path)
+        digest = file_hash(path)
+        if key in cache and cache[key]['hash'] == digest and cache[key].get('version') == version:
+            results[key] = cache[key]['result']
+        else:
+            jobs[key] = (shotId, path, digest)
+    print('%d shots cached, %d to analyze' % (len(results), len(jobs)))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(analyze_file, shotId, path): key for key, (shotId, path, _) in jobs.items()}
+        for future in concurrent.futures.as_completed(futures):
+            key = futures[future]
+            try:
+                results[key] = future.result()
+                cache[key] = {'hash': jobs[key][2], 'version': version, 'result': results[key]}
+            except Exception as e:
+                print('Analysis of %s failed: %s' % (key, e))
+
+    with open(cachePath, 'w') as f:
+        json.dump(cache, f)
+
+    summary = sorted(results.values(), key=lambda r: r['shot_id'])
+    with open(os.path.join(folder, SUMMARY_FILE), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['shot_id', 'fill_pressure_mbar', 'n_puffs', 'puff_durations_s', 'puff_gas_mbar_L', 'injected_gas_mbar_L'])
+        for r in summary:
+            writer.writerow([r['shot_id'],
+                             '' if r['fill_pressure'] is None else '%.4g' % r['fill_pressure'],
+                             len(r['puffs']),
+                             ' '.join('%.4f' % d for d in r['puff_durations']),
+                             ' '.join('%.4g' % g for g in r['puff_gas']),
+                             '%.4g' % r['injected_gas']])
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Analyze all shots in a shot data folder')
+    parser.add_argument('folder', nargs='?', default=DEFAULT_FOLDER)
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: one per CPU)')
+    args = parser.parse_args()
+    summary = analyze_folder(args.folder, args.workers)
+    print('Wrote %d shots to %s' % (len(summary), os.path.join(args.folder, SUMMARY_FILE)))
@@ -0,0 +1,211 @@
+'''
+Further GPI_RP boards served by the middle server next to the one at RP_HOSTNAME, which runs the
+fills and shots. Each further board has a worker thread with its own Koheron connection that reads
+the board's sample queue into a ring buffer of recent readings and refreshes a cache of its valve
+and shutter status. koheron-server runs one GPI_RP command at a time, whichever connection it
+comes from, so a valve command waits for the blocking read in progress: READ_WAIT keeps that short.
+XML-RPC requests for a board are answered from the ring buffer and the cache, and the main loop
+does no work per board, so its timing does not change as boards are added.
+
+The register helpers (read_valve, write_valve, read_status) are shared with RPServer.
+'''
+
+import time
+import threading
+import numpy as np
+from gauges import abs_mbar, diff_mbar
+from decimation import minmax_decimate
+from pressure_control import PressureEstimator
+
+
+READ_TARGET = 2000 # samples a blocking read of a board's queue waits for
+READ_WAIT = 0.02 # seconds a board may hold a blocking read open. A valve command to the board waits up to this long
+STATUS_INTERVAL = 0.5 # seconds between status reads of a board
+RECONNECT_INTERVAL = 5 # seconds between attempts to reconnect to a board
+
+
+def read_valve(driver, valve):
+    '''
+    Args:
+        driver: GPI_RP driver
+        valve: (string) one of V5, V4, V3, V7, FV2
+    Returns:
+        string: 'open' or 'close'
+    '''
+    if valve == 'FV2':
+        statusInt = driver.get_fast_sts()
+    else:
+        valve_number = ['V5', 'V4', 'V3', 'V7'].index(valve) + 1
+        statusInt = getattr(driver, 'get_slow_%s_sts' % valve_number)()
+    # V3 has opposite status logic
+    if valve == 'V3':
+        statusInt = int(not statusInt)
+    return 'open' if statusInt == 1 else 'close'
+
+
+def write_valve(driver, valve, command):
+    '''
+    Args:
+        driver: GPI_RP driver
+        valve: (string) one of V5, V4, V3, V7, FV2
+        command: (string) 'open' or 'close'
+    '''
+    if valve == 'FV2':
+        setter_method = 'set_fast'
+    else:
+        valve_number = ['V5', 'V4', 'V3', 'V7'].index(valve) + 1
+        setter_method = 'set_slow_%s' % valve_number
+    signal = 1 if command == 'open' else 0
+    # V3 expects opposite signals
+    signal = int(not signal) if valve == 'V3' else signal
+    getattr(driver, setter_method)(signal)
+
+
+def read_shutter_sensor(driver):
+    ai0 = driver.get_analog_input_0()
+    ai1 = driver.get_analog_input_1()
+    if ai0 < 9000 < ai1:
+        return 'closed'
+    elif ai0 > 9000 > ai1:
+        return 'open'
+    else:
+        return 'bad'
+
+
+def read_status(driver):
+    '''
+    Read the valve, shutter and W7-X signal status from a board.
+    '''
+    return {'shutter_setting': driver.get_analog_out(),
+            'shutter_sensor': read_shutter_sensor(driver),
+            'V3': read_valve(driver, 'V3'),
+            'V4': read_valve(driver, 'V4'),
+            'V5': read_valve(driver, 'V5'),
+            'V7': read_valve(driver, 'V7'),
+            'FV2': read_valve(driver, 'FV2'),
+            'w7x_permission': str(driver.get_W7X_permission()),
+            't1': str(driver.get_W7X_T1())}
+
+
+class Board:
+    def __init__(self, name, connect, sampleRate, history, log):
+        '''
+        Args:
+            name: (string) board name used by clients
+            connect: function returning a GPI_RP driver with a new connection to the board
+            sampleRate: (float) samples per second the board acquires
+            history: (float) seconds of readings kept in the ring buffer
+            log: function taking (text, level) that is safe to call from the worker thread,
+                e.g. RPServer.queueLog
+        '''
+        self.name = name
+        self.connect = connect
+        self.sampleRate = sampleRate
+        self.log = log
+        # Set to None by the worker when the connection fails, so take a local copy to use it
+        self.driver = None
+        # Columns (t, pAbsolute, pDiff), reading number n at row n % len(self.ring)
+        self.ring = np.zeros((int(history*sampleRate), 3))
+        self.count = 0
+        # Time of the newest reading in the ring
+        self.lastTime = 0
+        self.pressureEstimator = PressureEstimator(sampleRate)
+        # Latest read_status result, wall time it was read, and the last connection error
+        self.status = None
+        self.statusTime = 0
+        self.error = None
+        self.reads = 0
+        # Held while the ring buffer, estimator or status cache are changed or read
+        self.lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='Board ' + name, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            try:
+                if self.driver is None:
+                    self.driver = self.connect()
+                    self.error = None
+                    self.log('Board %s connected' % self.name, 'info')
+                driver = self.driver
+                if time.time() - self.statusTime >= STATUS_INTERVAL:
+                    status = read_status(driver)
+                    with self.lock:
+                        self.status = status
+                        self.statusTime = time.time()
+                words = driver.get_GPI_data_blocking(READ_TARGET, int(READ_WAIT*1000))
+                self.addReadings(words, time.time())
+            except Exception as e:
+                # The next read reconnects, with the cached status marked stale in the meantime
+                if self.error is None:
+                    self.log('Board %s: %s. Reconnecting...' % (self.name, e), 'error')
+                self.error = str(e)
+                self.driver = None
+                time.sleep(RECONNECT_INTERVAL)
+
+    def addReadings(self, words, now):
+        '''
+        Args:
+            words: (NumPy uint32 array) raw words in acquisition order
+            now: (float) wall time of the last word
+        '''
+        self.reads += 1
+        if not len(words):
+            return
+        pAbs = abs_mbar(words)
+        pDiff = diff_mbar(words)
+        n = len(words)
+        kept = min(n, len(self.ring))
+        rows = (self.count + n - kept + np.arange(kept)) % len(self.ring)
+        # Replies vary in delay, so keep readings after the previous batch for getPressures' search
+        now = max(now, self.lastTime + n/self.sampleRate)
+        with self.lock:
+            self.ring[rows, 0] = now - np.arange(kept-1, -1, -1)/self.sampleRate
+            self.lastTime = now
+            self.ring[rows, 1] = pAbs[-kept:]
+            self.ring[rows, 2] = pDiff[-kept:]
+            self.count += n
+            self.pressureEstimator.update(pAbs, now)
+
+    def getStatus(self):
+        '''
+        Cached status of the board (None until first read), with its age in seconds, the current
+        pressure and any connection error.
+        '''
+        with self.lock:
+            status = dict(self.status) if self.status is not None else {}
+            status['status_age'] = time.time() - self.statusTime if self.status is not None else None
+            status['pressure'] = float(self.pressureEstimator.windowMean())
+        status['error'] = self.error
+        return status
+
+    def getPressures(self, t0, t1, max_points):
+        '''
+        Readings between wall times t0 and t1 from the ring buffer, see RPServer.getPressures.
+        '''
+        with self.lock:
+            size = min(self.count, len(self.ring))
+            head = self.count % len(self.ring)
+            # Oldest readings first: the ring from head on (once it has wrapped), then up to head
+            segments = [self.ring[head:size], self.ring[:head]] if self.count > len(self.ring) else [self.ring[:size]]
+            selected = []
+            for segment in segments:
+                start = np.searchsorted(segment[:,0], t0, side='left')
+                end = np.searchsorted(segment[:,0], t1, side='right')
+                selected.append(segment[start:end])
+            selected = np.concatenate(selected)
+        t, (pAbs, pDiff) = minmax_decimate(selected[:,0], [selected[:,1], selected[:,2]], max_points)
+        return {'t': t.tolist(), 'abs': pAbs.tolist(), 'diff': pDiff.tolist()}
+
+    def setValve(self, valve, command):
+        driver = self.driver
+        if driver is None:
+            raise ConnectionError('Board %s is not connected' % self.name)
+        write_valve(driver, valve, command)
+        # Show the change without waiting for the next status read
+        with self.lock:
+            self.statusTime = 0
+
+    def close(self):
+        self.running = False
@@ -0,0 +1,92 @@
+'''
+Read-only browser dashboard served by the middle server. The static page in dashboard/ connects
+back over a WebSocket and receives the same snapshot and update messages as status stream
+subscribers (see status_stream.py), then draws the pressure traces client-side on a canvas. Each
+viewer costs the server one thread and one small JSON frame per tick, and no hardware reads.
+'''
+
+import os
+import json
+import base64
+import hashlib
+import functools
+import http.server
+import threading
+from status_stream import StatusPublisher, to_builtin
+
+
+DASHBOARD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dashboard')
+WEBSOCKET_PATH = '/ws'
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11' # fixed by RFC 6455
+
+
+def pack_websocket_message(message):
+    '''
+    Return a message dict as an unmasked WebSocket text frame.
+    '''
+    body = json.dumps(message, default=to_builtin).encode('utf-8')
+    if len(body) < 126:
+        header = bytes([0x81, len(body)])
+    elif len(body) < 1 << 16:
+        header = bytes([0x81, 126]) + len(body).to_bytes(2, 'big')
+    else:
+        header = bytes([0x81, 127]) + len(body).to_bytes(8, 'big')
+    return header + body
+
+
+class DashboardHandler(http.server.SimpleHTTPRequestHandler):
+    # Browsers only accept a WebSocket upgrade in an HTTP/1.1 response
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, *args, publisher=None, **kwargs):
+        self.publisher = publisher
+        super().__init__(*args, directory=DASHBOARD_FOLDER, **kwargs)
+
+    def do_GET(self):
+        if self.path != WEBSOCKET_PATH:
+            return super().do_GET()
+        key = self.headers.get('Sec-WebSocket-Key')
+        if self.headers.get('Upgrade', '').lower() != 'websocket' or not key:
+            self.send_error(400, 'Expected a WebSocket upgrade')
+            return
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.wfile.flush()
+        # The viewer only receives, so this thread sends its updates until it goes away
+        self.publisher.subscribe(self.connection, self.client_address)
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DashboardServer:
+    def __init__(self, port, host='0.0.0.0'):
+        '''
+        Serve the dashboard page on an HTTP port. Call publish with the same arguments as
+        StatusPublisher.publish to update the viewers.
+
+        Args:
+            port: (int) HTTP port of the dashboard
+            host: (string) interface to listen on
+        '''
+        self.publisher = StatusPublisher(pack=pack_websocket_message)
+        handler = functools.partial(DashboardHandler, publisher=self.publisher)
+        self.httpServer = http.server.ThreadingHTTPServer((host, port), handler)
+        self.httpServer.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpServer.serve_forever, name='DashboardServer', daemon=True)
+        self.thread.start()
+
+    def hasSubscribers(self):
+        return self.publisher.hasSubscribers()
+
+    def publish(self, status, points, messages):
+        self.publisher.publish(status, points, messages)
+
+    def close(self):
+        self.httpServer.shutdown()
+        self.publisher.close()
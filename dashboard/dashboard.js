@@ -0,0 +1,164 @@
+// Read-only view of the middle server status stream, see dashboard.py
+
+class PressurePlot {
+
+    constructor(canvas, title, color) {
+        this.canvas = canvas;
+        this.context = this.canvas.getContext('2d');
+        this.title = title;
+        this.color = color;
+    }
+
+    // t: times relative to the newest point (s), y: pressures (mbar), window: seconds shown
+    draw(t, y, window) {
+        let ctx = this.context;
+        let width = this.canvas.width;
+        let height = this.canvas.height;
+        let left = 70, right = 10, top = 25, bottom = 25;
+        ctx.clearRect(0, 0, width, height);
+
+        ctx.fillStyle = 'black';
+        ctx.font = '13px sans-serif';
+        ctx.fillText(this.title + (y.length ? ': ' + y[y.length-1].toPrecision(4) + ' mbar' : ''), left, 15);
+        if (y.length === 0) {
+            return;
+        }
+
+        let yMin = Infinity, yMax = -Infinity;
+        for (let value of y) {
+            yMin = Math.min(yMin, value);
+            yMax = Math.max(yMax, value);
+        }
+        let span = (yMax - yMin) || Math.abs(yMax)*0.1 || 1;
+        yMin -= 0.2*span;
+        yMax += 0.2*span;
+        let xPixel = (value) => left + (value + window)/window*(width - left - right);
+        let yPixel = (value) => top + (yMax - value)/(yMax - yMin)*(height - top - bottom);
+
+        // Axes with min/max labels
+        ctx.strokeStyle = '#999';
+        ctx.strokeRect(left, top, width - left - right, height - top - bottom);
+        ctx.textAlign = 'right';
+        ctx.fillText(yMax.toPrecision(4), left - 5, top + 10);
+        ctx.fillText(yMin.toPrecision(4), left - 5, height - bottom);
+        ctx.textAlign = 'center';
+        ctx.fillText('-' + window + ' s', left, height - 5);
+        ctx.fillText('now', width - right - 10, height - 5);
+        ctx.textAlign = 'left';
+
+        ctx.strokeStyle = this.color;
+        ctx.beginPath();
+        for (let i = 0; i < t.length; i++) {
+            if (i === 0) {
+                ctx.moveTo(xPixel(t[i]), yPixel(y[i]));
+            } else {
+                ctx.lineTo(xPixel(t[i]), yPixel(y[i]));
+            }
+        }
+        ctx.stroke();
+    }
+
+}
+
+class Dashboard {
+
+    constructor(document) {
+        this.window = 30; // seconds of pressure shown
+        this.maxLogLines = 200;
+        this.reconnectInterval = 1000; // ms
+
+        this.document = document;
+        this.connectionStatus = document.getElementById('connection-status');
+        this.log = document.getElementById('log');
+        this.absPlot = new PressurePlot(document.getElementById('abs-canvas'), 'Absolute gauge', '#1f77b4');
+        this.diffPlot = new PressurePlot(document.getElementById('diff-canvas'), 'Differential gauge', '#ff7f0e');
+
+        this.status = {};
+        this.points = []; // [t, abs, diff]
+        this.needsDraw = false;
+        this.connect();
+    }
+
+    connect() {
+        let protocol = window.location.protocol === 'https:' ? 'wss://' : 'ws://';
+        this.socket = new WebSocket(protocol + window.location.host + '/ws');
+        this.socket.onopen = () => {
+            this.connectionStatus.textContent = 'connected';
+            this.connectionStatus.className = 'connected';
+        };
+        this.socket.onmessage = (event) => {
+            this.handleMessage(JSON.parse(event.data));
+        };
+        this.socket.onclose = () => {
+            this.connectionStatus.textContent = 'not connected';
+            this.connectionStatus.className = 'disconnected';
+            setTimeout(() => { this.connect(); }, this.reconnectInterval);
+        };
+    }
+
+    handleMessage(message) {
+        if (message['type'] === 'snapshot') {
+            this.status = message['status'];
+            this.points = message['points'];
+        } else {
+            Object.assign(this.status, message['status']);
+            this.points = this.points.concat(message['points']);
+        }
+        // Drop points older than the plot window
+        if (this.points.length > 0) {
+            let newest = this.points[this.points.length-1][0];
+            let start = 0;
+            while (start < this.points.length && this.points[start][0] < newest - this.window) {
+                start++;
+            }
+            this.points = this.points.slice(start);
+        }
+        this.updateStatus();
+        this.addLogMessages(message['messages']);
+        if (!this.needsDraw) {
+            this.needsDraw = true;
+            window.requestAnimationFrame(() => { this.draw(); });
+        }
+    }
+
+    updateStatus() {
+        for (let key in this.status) {
+            let cell = this.document.getElementById('status-' + key);
+            if (cell) {
+                cell.textContent = this.status[key];
+                cell.className = String(this.status[key]);
+            }
+        }
+    }
+
+    addLogMessages(messages) {
+        for (let [level, text] of messages) {
+            let item = this.document.createElement('li');
+            item.textContent = text;
+            item.className = level;
+            this.log.appendChild(item);
+        }
+        while (this.log.childNodes.length > this.maxLogLines) {
+            this.log.removeChild(this.log.firstChild);
+        }
+        if (messages.length > 0) {
+            this.log.scrollTop = this.log.scrollHeight;
+        }
+    }
+
+    draw() {
+        this.needsDraw = false;
+        let t = [], pAbs = [], pDiff = [];
+        if (this.points.length > 0) {
+            let newest = this.points[this.points.length-1][0];
+            for (let [time, abs, diff] of this.points) {
+                t.push(time - newest);
+                pAbs.push(abs);
+                pDiff.push(diff);
+            }
+        }
+        this.absPlot.draw(t, pAbs, this.window);
+        this.diffPlot.draw(t, pDiff, this.window);
+    }
+
+}
@@ -0,0 +1,44 @@
+'''
+Reduce pressure time series to a bounded number of points for display or transfer without losing
+short features such as the spikes from FV2 puffs.
+'''
+
+import numpy as np
+
+
+def minmax_decimate(t, columns, max_points):
+    '''
+    Split samples into equal buckets and keep the min and max of each column in every bucket, in
+    the order they occurred. All columns share the returned time axis, which holds the first and
+    last time of each bucket.
+    Parameters
+        t: NumPy array of sample times
+        columns: list of NumPy arrays with the same length as t
+        max_points: int, maximum number of points to return (values below 2 are treated as 2)
+    Returns
+        (NumPy array, list of NumPy arrays): decimated times and columns
+    '''
+    # One bucket is a min and a max, so fewer than 2 points cannot be returned
+    max_points = max(2, int(max_points))
+    n = len(t)
+    if n <= max_points:
+        return t, columns
+    bucketSize = int(np.ceil(n/(max_points//2)))
+    nBuckets = int(np.ceil(n/bucketSize))
+    # Pad with the final sample so every bucket is full without changing any bucket's min/max
+    pad = (0, nBuckets*bucketSize - n)
+    tBuckets = np.pad(t, pad, mode='edge').reshape(nBuckets, bucketSize)
+    tOut = np.column_stack((tBuckets[:,0], tBuckets[:,-1])).ravel()
+    rows = np.arange(nBuckets)
+    out = []
+    for y in columns:
+        yBuckets = np.pad(y, pad, mode='edge').reshape(nBuckets, bucketSize)
+        iMin = yBuckets.argmin(axis=1)
+        iMax = yBuckets.argmax(axis=1)
+        lo = yBuckets[rows, iMin]
+        hi = yBuckets[rows, iMax]
+        minFirst = iMin <= iMax
+        first = np.where(minFirst, lo, hi)
+        second = np.where(minFirst, hi, lo)
+        out.append(np.column_stack((first, second)).ravel())
+    return tOut, out
@@ -0,0 +1,62 @@
+'''
+Conversion between the packed 32-bit words produced by the RP data_collector core and pressures in
+mbar for the absolute and differential gauges. Shared by the middle server and offline tools.
+'''
+
+import numpy as np
+
+
+TORR_TO_MBAR = 1.33322
+# Calibration for IN 1 (abs, 0.252 divider) and IN 2 (diff, 0.342 divider) of W7XRP2
+CALIBRATION = {'abs_offset': 0.0661, # V
+               'abs_gain': 4.526,
+               'abs_torr_per_volt': 500,
+               'diff_offset': 0.047, # V
+               'diff_gain': 3.329,
+               'diff_torr_per_volt': 10}
+
+
+def twos_complement(arr, num_bits=14):
+    arr = arr.astype(np.int32) # if arr is uint32, output is wrong if we don't do this
+    sign_mask = 1 << (num_bits - 1)  # For example 0b100000000
+    bits_mask = sign_mask - 1  # For example 0b011111111
+    return np.bitwise_and(arr, bits_mask) - np.bitwise_and(arr, sign_mask)
+
+
+def abs_mbar(arr, cal=CALIBRATION):
+    # Get parts of binary vals corresponding to abs measurement (digits 5 through 19)
+    arr = np.right_shift(arr, 14)
+    # Convert from unsigned to signed integers
+    arr = twos_complement(arr, 14)
+    # Convert to float
+    f = 2/(2**14-1)*arr
+    abs_voltage = cal['abs_offset']+cal['abs_gain']*f
+    return cal['abs_torr_per_volt']*abs_voltage*TORR_TO_MBAR
+
+
+def diff_mbar(arr, cal=CALIBRATION):
+    # Get parts of binary vals corresponding to diff measurement (last 14 digits)
+    arr = np.bitwise_and(arr, 0b11111111111111)
+    # Convert from unsigned to signed integers
+    arr = twos_complement(arr, 14)
+    # Convert to float
+    f = 2/(2**14-1)*arr
+    diff_voltage = cal['diff_offset']+cal['diff_gain']*f
+    return cal['diff_torr_per_volt']*diff_voltage*TORR_TO_MBAR
+
+
+def words_from_mbar(pAbs, pDiff, cal=CALIBRATION):
+    '''
+    Inverse of abs_mbar/diff_mbar, used to produce realistic raw words from simulated pressures.
+    Parameters
+        pAbs, pDiff: NumPy arrays of pressures in mbar
+    Returns
+        NumPy uint32 array of packed words
+    '''
+    def to_counts(p, offset, gain, torrPerVolt):
+        f = (np.asarray(p)/TORR_TO_MBAR/torrPerVolt - offset)/gain
+        counts = np.clip(np.round(f*(2**14-1)/2), -2**13, 2**13-1).astype(np.int32)
+        return np.bitwise_and(counts, 0b11111111111111).astype(np.uint32)
+    absCounts = to_counts(pAbs, cal['abs_offset'], cal['abs_gain'], cal['abs_torr_per_volt'])
+    diffCounts = to_counts(pDiff, cal['diff_offset'], cal['diff_gain'], cal['diff_torr_per_volt'])
+    return np.left_shift(absCounts, 14) | diffCounts
@@ -2,27 +2,44 @@
 GUI for valve control in GPI system at W7-X. Original code by Kevin Tang.
 '''
 
-import sys
-import os
-import subprocess
 import tkinter as tk
 import tkinter.font
 from tkinter import ttk
 from PIL import Image, ImageTk
 import time
+import queue
+import collections
 import datetime
+import threading
+import urllib.parse
 from xmlrpc.client import ServerProxy
 import numpy as np
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
+from shot_archive import ShotArchive
+from analysis_worker import AnalysisWorker
+from status_stream import StatusClient
+from safety_lane import send_safety_command
 
 
 MIDDLE_SERVER_ADDR = 'http://0.0.0.0:50000'
-SAVE_FOLDER = 'shot_data' # for puff pressure data
+STREAM_PORT = 50001 # middle server port that pushes status and log messages, see status_stream.py
+SAFETY_PORT = 50002 # middle server port for interrupt commands, see safety_lane.py
+SAVE_FOLDER = 'shot_data' # shot archive for puff pressure data, use one folder per campaign
 SOFTWARE_T1 = True  # send a T1 trigger through software (don't wait for hardware trigger)
 PRETRIGGER = 5 # seconds between T0 and T1 (for T1 timing if SOFTWARE_T1 or for post-shot actions if not SOFTWARE_T1)
-UPDATE_INTERVAL = .5  # seconds between plot updates
+UPDATE_INTERVAL = .1  # seconds between plot updates
+PLOT_WINDOW = 30 # seconds of pressure history shown in the plots at startup
+MIN_PLOT_WINDOW = 0.5 # seconds, shortest plot window reachable by zooming
+MAX_PLOT_WINDOW = 600 # seconds, longest plot window (beyond 30 s needs raw data recording on the middle server)
+ZOOM_FACTOR = 1.25 # change of the plot window per mouse wheel step
+LOG_LENGTH = 1000 # number of messages kept in the event log, older ones can be fetched from the middle server
+LOG_LEVELS = ['debug', 'info', 'warning', 'error'] # log message levels, least to most severe
+LOG_COLORS = {'warning': 'dark orange', 'error': 'red3'}
+PLOT_BUFFER = 10000 # max number of pressure readings kept for the plots
+PLOT_MARGIN = 0.2 # fraction of the data range left free above and below the plotted data
 CONTROL_INTERVAL = 0.2 # seconds between pump/fill loop iterations
+RESULT_INTERVAL = 0.02 # seconds between checks for finished middle server calls
 DEFAULT_PUFF = 0.05  # seconds duration for each puff 
 SHUTTER_CHANGE = 1 # seconds for the shutter to finish opening/closing
 MECH_PUMP_LIMIT = 1026 # mbar, max pressure the mechanical pump should work on
@@ -41,6 +58,26 @@ def find_nearest(array, value):
     if idx > 0 and (idx == len(array) or np.fabs(value - array[idx-1]) < np.fabs(value - array[idx])):
         return idx-1
     return idx
+
+
+def autoscale_limits(values, limits, margin=PLOT_MARGIN):
+    '''
+    Decide whether plot limits need to change to show values. The limits are only changed when
+    values leave them or take up less than half of them, so most updates keep the axes as they are.
+    Parameters
+        values: NumPy array of plotted values
+        limits: (float, float) current axis limits
+        margin: float, fraction of the data range to leave free on each side
+    Returns
+        (float, float) new limits, or None if the current limits are fine
+    '''
+    low, high = values.min(), values.max()
+    span = high - low
+    if span == 0:
+        span = abs(high)*0.1 or 1
+    if limits[0] <= low and high <= limits[1] and limits[1] - limits[0] < 2*(1 + 2*margin)*span:
+        return None
+    return low - margin*span, high + margin*span
     
     
 class ToolTip(object):
@@ -95,21 +132,105 @@ def createToolTip(widget, text):
     widget.bind('<Leave>', leave)
 
 
+class RPCWorker:
+    '''
+    Makes middle server calls on a background thread so the Tk thread never waits on the network.
+    Results are handed back through a queue and their callbacks run on the Tk thread when
+    processResults is called.
+    '''
+    def __init__(self, address):
+        self.address = address
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='RPCWorker', daemon=True)
+        self.thread.start()
+
+    def call(self, method, *args, callback=None, errback=None):
+        '''
+        Queue a call to a middle server method.
+
+        Args:
+            method: (string) name of the RPServer method
+            args: arguments of the method
+            callback: (function) called with the return value
+            errback: (function) called with the exception if the call fails
+        '''
+        self.requests.put((method, args, callback, errback))
+
+    def run(self):
+        # ServerProxy is not thread-safe, so the proxy belongs to this thread only
+        proxy = ServerProxy(self.address, verbose=False, allow_none=True)
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            method, args, callback, errback = request
+            try:
+                self.results.put((callback, getattr(proxy, method)(*args)))
+            except Exception as e:
+                self.results.put((errback, e))
+
+    def processResults(self):
+        '''
+        Run the callbacks of all calls that have finished. Must be called from the Tk thread.
+        '''
+        while True:
+            try:
+                function, value = self.results.get_nowait()
+            except queue.Empty:
+                return
+            if function is not None:
+                function(value)
+
+    def callNow(self, function, *args, callback=None, errback=None):
+        '''
+        Run function(*args) on a thread of its own, ahead of any queued middle server calls, and
+        hand its result back like call does.
+        '''
+        def run():
+            try:
+                self.results.put((callback, function(*args)))
+            except Exception as e:
+                self.results.put((errback, e))
+        threading.Thread(target=run, name='RPCWorker.callNow', daemon=True).start()
+
+    def stop(self):
+        self.requests.put(None)
+
+
 class GUI:
     def __init__(self, root):
-        self.last_plot = None
-        self.mainloop_running = True   
         self.starting_up = True
         self.middleServerConnected = False
         self.controlsEnabled = True
-        
-        self.pressureTimes = []
-        self.absPressures = []
-        self.diffPressures = []
+        # Latest middle server status, kept up to date by the status stream
+        self.serverStatus = {}
+        self.valveStatus = {}
+        
+        # Event log messages as (level, text), see _add_to_log and flushLog
+        self.logMessages = collections.deque(maxlen=LOG_LENGTH)
+        self.newLogMessages = []
+        self.historyWindow = None
+        
+        # Plotted readings as rows of (time, abs, diff), oldest first. Only the first plotCount rows
+        # are used; new readings are appended so the whole history is not rebuilt on every update
+        self.plotData = np.zeros((PLOT_BUFFER, 3))
+        self.plotCount = 0
+        self.plotWindow = PLOT_WINDOW
+        # Incremented on every zoom so replies requested at the old resolution can be discarded
+        self.plotZoom = 0
+        self.plotPending = False
+        self.absPressure = float('nan') # latest absolute pressure in mbar
+        # Saved plot backgrounds for blitting, see handleCanvasDraw
+        self.plotBackgrounds = None
         
         # Used to cancel data display if a shot is interrupted
         self.afterShotGetData = None
         
+        # Separate process that analyzes and plots shots, started now so its imports are ready
+        self.analysisWorker = AnalysisWorker()
+        self.shotWindow = None
+        
         self.setupGUI(root)
         self._add_to_log('GUI initialized')
         
@@ -245,11 +366,12 @@ class GUI:
         label = self.ax_abs.yaxis.get_ticklabels()
         self.ax_abs.yaxis.set_tick_params(which='both', labelleft=label, labelright=label)
         self.ax_abs.set_xlabel('Time [s]')
+        self.ax_abs.set_xlim(-PLOT_WINDOW, 0)
         self.ax_abs.set_title('Absolute gauge')
         self.ax_abs.grid(True, color='#c9dae5')
         self.ax_abs.patch.set_facecolor('#e3eff7')
-        self.line_abs, = self.ax_abs.plot([], [], c='C0', linewidth=1)
-        self.abs_text = self.ax_abs.text(0.97, 0.97, '? mbar', horizontalalignment='right', verticalalignment='top', transform=self.ax_abs.transAxes, fontsize=10)
+        self.line_abs, = self.ax_abs.plot([], [], c='C0', linewidth=1, animated=True)
+        self.abs_text = self.ax_abs.text(0.97, 0.97, '? mbar', horizontalalignment='right', verticalalignment='top', transform=self.ax_abs.transAxes, fontsize=10, animated=True)
         # Differential pressure plot matplotlib setup
         self.ax_diff = self.fig.add_subplot(212)
         self.ax_diff.margins(y=0.2)
@@ -257,13 +379,16 @@ class GUI:
         label = self.ax_diff.yaxis.get_ticklabels()
         self.ax_diff.yaxis.set_tick_params(which='both', labelleft=label, labelright=label)
         self.ax_diff.set_xlabel('Time [s]')
+        self.ax_diff.set_xlim(-PLOT_WINDOW, 0)
         self.ax_diff.set_title('Differential gauge')
         self.ax_diff.grid(True, color='#e5d5c7')
         self.ax_diff.patch.set_facecolor('#f7ebe1')
-        self.line_diff, = self.ax_diff.plot([], [], c='C1', linewidth=1)
-        self.diff_text = self.ax_diff.text(0.97, 0.97, '? mbar', horizontalalignment='right', verticalalignment='top', transform=self.ax_diff.transAxes, fontsize=10)
+        self.line_diff, = self.ax_diff.plot([], [], c='C1', linewidth=1, animated=True)
+        self.diff_text = self.ax_diff.text(0.97, 0.97, '? mbar', horizontalalignment='right', verticalalignment='top', transform=self.ax_diff.transAxes, fontsize=10, animated=True)
         # Plot tkinter setup
         self.canvas = FigureCanvasTkAgg(self.fig, master=self.root)
+        self.canvas.mpl_connect('draw_event', self.handleCanvasDraw)
+        self.canvas.mpl_connect('scroll_event', self.handleScroll)
         self.canvas.draw()
         
         # Uncomment to see click x/y positions, useful for interface building
@@ -340,6 +465,20 @@ class GUI:
         log_controls_frame = tk.Frame(controls_frame, background=gray)
         label_log_controls_frame = tk.Frame(log_controls_frame, background=gray)
         tk.Label(label_log_controls_frame, text='Event log', background=gray).pack(side=tk.LEFT, fill=tk.X)
+        self.logLevel = tk.StringVar(value='info')
+        self.logLevel.trace_add('write', lambda *args: self.refreshLog())
+        log_level_menu = tk.OptionMenu(label_log_controls_frame, self.logLevel, *LOG_LEVELS)
+        log_level_menu.config(background=gray, highlightbackground=gray)
+        createToolTip(log_level_menu, 'Show messages at or above this level')
+        self.logSearch = tk.StringVar()
+        self.logSearch.trace_add('write', lambda *args: self.refreshLog())
+        log_search_entry = ttk.Entry(label_log_controls_frame, textvariable=self.logSearch, width=12)
+        createToolTip(log_search_entry, 'Show only messages containing this text')
+        history_button = ttk.Button(label_log_controls_frame, text='History', width=7, command=self.showLogHistory)
+        createToolTip(history_button, 'Show all matching messages kept by the middle server')
+        history_button.pack(side=tk.RIGHT)
+        log_search_entry.pack(side=tk.RIGHT, padx=2)
+        log_level_menu.pack(side=tk.RIGHT)
         label_log_controls_frame.pack(side=tk.TOP, fill=tk.X)
         self.log = tk.Listbox(log_controls_frame, background=gray, highlightbackground=gray, font=font)
         yscrollbar = tk.Scrollbar(log_controls_frame, orient=tk.VERTICAL)
@@ -353,57 +492,169 @@ class GUI:
         log_controls_frame.pack(side=tk.TOP, fill=tk.BOTH, pady=10, expand=True)
         controls_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=5)
         
-    def connectToServer(self, hideFailureMessage=False):
-        self.middle = ServerProxy(MIDDLE_SERVER_ADDR, verbose=False, allow_none=True)
-        try:
-            self.middle.serverIsAlive()
-            self.middleServerConnected = True
-            self._add_to_log('Connected to middle server ' + MIDDLE_SERVER_ADDR)
-        except Exception as e:
-            if not hideFailureMessage:
-                print('Connect to middle server', MIDDLE_SERVER_ADDR, 'failed:', e)
-                self._add_to_log('Not connected to middle server ' + MIDDLE_SERVER_ADDR)
+    def connectToServer(self):
+        self.rpc = RPCWorker(MIDDLE_SERVER_ADDR)
+        self.callServer('serverIsAlive', callback=self.handleConnected, errback=self.handleConnectFailed)
+        self.stream = StatusClient(urllib.parse.urlsplit(MIDDLE_SERVER_ADDR).hostname, STREAM_PORT)
+        
+    def handleConnected(self, result):
+        self.middleServerConnected = True
+        self._add_to_log('Connected to middle server ' + MIDDLE_SERVER_ADDR)
+        
+    def handleConnectFailed(self, error):
+        print('Connect to middle server', MIDDLE_SERVER_ADDR, 'failed:', error)
+        self._add_to_log('Not connected to middle server ' + MIDDLE_SERVER_ADDR, 'warning')
+        
+    def callServer(self, method, *args, callback=None, errback=None):
+        '''
+        Call a middle server method without blocking the GUI. callback receives the return value
+        on the Tk thread; failures are logged unless errback is given.
+        '''
+        self.rpc.call(method, *args, callback=callback, errback=errback or (lambda e: self.handleCallFailed(method, e)))
+        
+    def handleCallFailed(self, method, error):
+        print('GUI.callServer', method, error)
+        self._add_to_log('Middle server call %s failed: %s' % (method, error), 'warning')
         
     def mainloop(self):
-        # self._add_to_log('Setting default state')
-        # self._add_to_log('Finished setting default state')
+        self.requestData()
+        self.processResults()
+        self.updatePlots()
+        self.root.mainloop()
         
-        last_control = time.time()
-        self.last_plot = time.time() + UPDATE_INTERVAL # +... to get more fast data before first average
+    def requestData(self):
+        '''
+        Ask the middle server for new plot data every CONTROL_INTERVAL, skipping a cycle if the
+        previous request has not been answered yet. Status and log messages are pushed by the
+        status stream instead.
+        '''
+        if not self.plotPending:
+            self.requestPlotData()
+        self.root.after(int(CONTROL_INTERVAL*1000), self.requestData)
         
-        while self.mainloop_running:
-            now = time.time()
-            
-            # Pump and fill loop logic
-            if now - last_control > CONTROL_INTERVAL:
-                last_control =  now
-                
-                # Get data on slower timescale now that it's queue-based
-                # self.get_data()
-                
-                self.getDataUpdateUI()
-             
-            # Draw GUI and get callback results ((...).after(...))
-            self.root.update()
+    def requestPlotData(self):
+        '''
+        Ask the middle server for the readings since the last plotted one, reduced to a min/max
+        envelope with two points per horizontal pixel of the plots. The rendering cost is the same
+        at every zoom level and short puffs stay visible. After a zoom the buffer is empty and the
+        whole window is fetched at the new resolution.
+        '''
+        now = time.time()
+        t0 = now - self.plotWindow
+        if self.plotCount:
+            t0 = max(t0, self.plotData[self.plotCount-1, 0])
+        secondsPerPixel = self.plotWindow/max(self.ax_abs.bbox.width, 1)
+        maxPoints = 2*max(1, int(np.ceil((now - t0)/secondsPerPixel)))
+        self.plotPending = True
+        # The end time is well past the newest reading so nothing is cut off by clock differences
+        self.callServer('getPressures', t0, now + self.plotWindow, maxPoints,
+                        callback=lambda data, zoom=self.plotZoom: self.handlePlotData(data, zoom),
+                        errback=self.handlePlotDataFailed)
+        
+    def handlePlotData(self, data, zoom):
+        self.plotPending = False
+        if zoom == self.plotZoom:
+            self.addPlotData(np.column_stack((data['t'], data['abs'], data['diff'])))
             
-            # Reduce CPU usage
-            time.sleep(.005)
+    def handlePlotDataFailed(self, error):
+        # Connection problems are reported by handleStreamMessage
+        self.plotPending = False
+        print('GUI.requestPlotData', error)
+        
+    def processResults(self):
+        self.rpc.processResults()
+        for message in self.stream.getMessages():
+            self.handleStreamMessage(message)
+        self.showAnalysisResults()
+        self.flushLog()
+        self.root.after(int(RESULT_INTERVAL*1000), self.processResults)
+        
+    def updatePlots(self):
+        self.drawPlots()
+        self.root.after(int(UPDATE_INTERVAL*1000), self.updatePlots)
                              
     def _quit_tkinter(self):
-        self.mainloop_running = False # ends our custom while loop
+        self.rpc.stop()
+        self.stream.stop()
+        self.analysisWorker.stop()
         self.root.quit()      # stops mainloop 
         self.root.destroy()   # this is necessary on Windows to prevent
                               # Fatal Python Error: PyEval_RestoreThread: NULL tstate
         
-    def _add_to_log(self, text):
+    def _add_to_log(self, text, level='info'):
+        '''
+        Queue a message for the event log. Messages are added to the widget in batches by flushLog.
+        
+        Args:
+            text: (string) message
+            level: (string) one of LOG_LEVELS
+        '''
         time_string = datetime.datetime.now().strftime('%H:%M:%S.%f')[:-3]
-        self.log.insert(tk.END, ' ' + time_string + ' ' + text)
+        self.newLogMessages.append((level, ' ' + time_string + ' ' + text))
+        
+    def logMatches(self, level, text):
+        return (LOG_LEVELS.index(level) >= LOG_LEVELS.index(self.logLevel.get())
+                and self.logSearch.get().lower() in text.lower())
+        
+    def insertLogRows(self, listbox, messages):
+        start = listbox.size()
+        listbox.insert(tk.END, *[text for _, text in messages])
+        for i, (level, _) in enumerate(messages):
+            if level in LOG_COLORS:
+                listbox.itemconfig(start + i, foreground=LOG_COLORS[level])
+        
+    def flushLog(self):
+        '''
+        Add queued messages to the event log in one batch, keeping at most LOG_LENGTH rows. The view
+        only follows new messages if it was already scrolled to the end.
+        '''
+        if not self.newLogMessages:
+            return
+        messages = self.newLogMessages
+        self.newLogMessages = []
+        self.logMessages.extend(messages)
+        shown = [(level, text) for level, text in messages if self.logMatches(level, text)]
+        if not shown:
+            return
+        following = self.log.yview()[1] == 1.0
+        self.insertLogRows(self.log, shown[-LOG_LENGTH:])
+        excess = self.log.size() - LOG_LENGTH
+        if excess > 0:
+            self.log.delete(0, excess - 1)
+        if following:
+            self.log.yview(tk.END)
+            
+    def refreshLog(self):
+        '''
+        Refill the event log after the level filter or search text changed.
+        '''
+        self.log.delete(0, tk.END)
+        self.insertLogRows(self.log, [(level, text) for level, text in self.logMessages if self.logMatches(level, text)])
         self.log.yview(tk.END)
+        
+    def showLogHistory(self):
+        self.callServer('getLogHistory', self.logLevel.get(), self.logSearch.get(), callback=self.handleLogHistory)
+        
+    def handleLogHistory(self, messages):
+        '''
+        Show the middle server's log history in a window that is reused for every request.
+        '''
+        if self.historyWindow is None or not self.historyWindow.winfo_exists():
+            self.historyWindow = tk.Toplevel(self.root)
+            self.historyList = tk.Listbox(self.historyWindow, width=100, height=40)
+            scrollbar = tk.Scrollbar(self.historyWindow, orient=tk.VERTICAL, command=self.historyList.yview)
+            self.historyList.config(yscrollcommand=scrollbar.set)
+            scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+            self.historyList.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.historyList.delete(0, tk.END)
+        self.insertLogRows(self.historyList, messages)
+        self.historyList.yview(tk.END)
+        self.historyWindow.title('Middle server log (%d messages)' % len(messages))
             
     def handleDisconnected(self):
         self.middleServerConnected = False
         self.state_text.set('State: middle server not connected')
-        self._add_to_log('Middle server disconnected')
+        self._add_to_log('Middle server disconnected', 'error')
         self.shutter_sensor_indicator.config(bg='black')
         self.shutter_setting_indicator.config(bg='black')
         self.V3_indicator.config(bg='black')
@@ -412,17 +663,28 @@ class GUI:
         self.V7_indicator.config(bg='black')
         self.FV2_indicator.config(bg='black')
         
-    def getDataUpdateUI(self):
-        try:
-            data = self.middle.getDataForGUI()
-            if not self.middleServerConnected:
-                self._add_to_log('Reconnected to middle server')
-                self.middleServerConnected = True
-        except Exception as e:
-            print('GUI.getDataUpdateUI', e)
+    def handleStreamMessage(self, message):
+        '''
+        Apply a status stream message: a snapshot replaces the known status, an update only carries
+        the values that changed.
+        '''
+        if message['type'] == 'disconnected':
             if self.middleServerConnected:
+                print('GUI.handleStreamMessage', message['error'])
                 self.handleDisconnected()
             return
+        if message['type'] == 'snapshot':
+            self.serverStatus = message['status']
+        else:
+            self.serverStatus.update(message['status'])
+        # The snapshot is empty if the middle server has not published its first status yet
+        if self.serverStatus:
+            self.getDataUpdateUI(dict(self.serverStatus, messages=message['messages']))
+            
+    def getDataUpdateUI(self, data):
+        if not self.middleServerConnected:
+            self._add_to_log('Reconnected to middle server')
+            self.middleServerConnected = True
         
         self.state_text.set('State: ' + data['state'])
         if self.controlsEnabled and data['state'] in ['filling', 'pumping out', 'exhaust', 'shot']:
@@ -447,6 +709,7 @@ class GUI:
             self.shutter_sensor_indicator.config(bg='black')
             
         for valve in ['V3', 'V4', 'V5', 'V7', 'FV2']:
+            self.valveStatus[valve] = data[valve]
             if data[valve] == 'open':
                 fill = 'green'
             elif data[valve] == 'close':
@@ -456,8 +719,8 @@ class GUI:
                 print(data[valve])
             getattr(self, valve+'_indicator').config(bg=fill)
         
-        for message in data['messages']:
-            self._add_to_log(message)
+        for level, message in data['messages']:
+            self._add_to_log(message, level)
             
         if data['w7x_permission'] == '4294967295':
             txt = 'high'
@@ -475,11 +738,6 @@ class GUI:
             txt = data['w7x_permission']
         self.t1_text.set('T1 HW or SW signal: %s' % txt)
             
-        self.pressureTimes, self.absPressures, self.diffPressures = zip(*data['pressures_history'])
-        if time.time() - self.last_plot > UPDATE_INTERVAL:
-            self.drawPlots()
-            self.last_plot = time.time()
-            
     def getPuffStart(self, puff_number):
         try:
             text = getattr(self, 'start_%d_entry' % puff_number).get().strip()
@@ -494,50 +752,133 @@ class GUI:
         except Exception as e:
             return None
     
+    def addPlotData(self, readings):
+        '''
+        Append the readings newer than those already plotted to the plot buffer, dropping the
+        oldest ones if it is full.
+        Parameters
+            readings: NumPy array or list of [time, abs, diff] rows sorted by time
+        '''
+        readings = np.asarray(readings, dtype=float)
+        if not len(readings):
+            return
+        if self.plotCount:
+            readings = readings[readings[:,0] > self.plotData[self.plotCount-1, 0]]
+        readings = readings[-PLOT_BUFFER:]
+        n = len(readings)
+        if not n:
+            return
+        if self.plotCount + n > PLOT_BUFFER:
+            keep = PLOT_BUFFER - n
+            self.plotData[:keep] = self.plotData[self.plotCount-keep:self.plotCount]
+            self.plotCount = keep
+        self.plotData[self.plotCount:self.plotCount+n] = readings
+        self.plotCount += n
+        self.absPressure = readings[-1, 1]
+        
+    def handleScroll(self, event):
+        '''
+        Zoom the time axis of the plots in (wheel up) or out (wheel down).
+        '''
+        if event.button == 'up':
+            window = self.plotWindow/ZOOM_FACTOR
+        else:
+            window = self.plotWindow*ZOOM_FACTOR
+        window = min(max(window, MIN_PLOT_WINDOW), MAX_PLOT_WINDOW)
+        if window == self.plotWindow:
+            return
+        self.plotWindow = window
+        self.plotZoom += 1
+        self.plotCount = 0
+        for ax, line in [(self.ax_abs, self.line_abs), (self.ax_diff, self.line_diff)]:
+            ax.set_xlim(-window, 0)
+            line.set_data([], [])
+        self.canvas.draw()
+        
+    def handleCanvasDraw(self, event):
+        '''
+        After a full redraw of the figure, save the axes backgrounds (everything but the lines and
+        pressure labels) for blitting and draw the lines on top.
+        '''
+        self.plotBackgrounds = [self.canvas.copy_from_bbox(ax.bbox) for ax in [self.ax_abs, self.ax_diff]]
+        for ax, artists in [(self.ax_abs, [self.line_abs, self.abs_text]), (self.ax_diff, [self.line_diff, self.diff_text])]:
+            for artist in artists:
+                ax.draw_artist(artist)
+    
     def drawPlots(self):
         # Do not attempt to draw plots if no data has been collected
+        if not self.plotCount:
+            return
         now = time.time()
-        relative_times = [t - now for t in self.pressureTimes]
-        if not relative_times:
+        times = self.plotData[:self.plotCount, 0]
+        start = np.searchsorted(times, now - self.plotWindow)
+        if start == self.plotCount:
+            start -= 1
+        relativeTimes = times[start:] - now
+        
+        redraw = self.plotBackgrounds is None
+        for ax, line, text, column in [(self.ax_abs, self.line_abs, self.abs_text, 1), (self.ax_diff, self.line_diff, self.diff_text, 2)]:
+            values = self.plotData[start:self.plotCount, column]
+            line.set_data(relativeTimes, values)
+            text.set_text('%.4g mbar' % values[-1])
+            limits = autoscale_limits(values, ax.get_ylim())
+            if limits is not None:
+                ax.set_ylim(limits)
+                redraw = True
+        
+        if redraw:
+            # Full redraw of axes and decorations, handleCanvasDraw saves the new backgrounds
+            self.canvas.draw()
             return
-        
-        # Update absolute gauge plot
-        self.line_abs.set_data(relative_times, self.absPressures)
-        self.ax_abs.relim()
-        self.ax_abs.autoscale_view(True,True,True)
-        self.abs_text.set_text('%.4g mbar' % self.absPressures[-1])
-        
-        # Update differential gauge plot
-        self.line_diff.set_data(relative_times, self.diffPressures)
-        self.ax_diff.relim()
-        self.ax_diff.autoscale_view(True,True,True)
-        self.diff_text.set_text('%.4g mbar' % self.diffPressures[-1])
-        
-        self.fig.canvas.draw_idle()
+        # Otherwise only the lines and labels are redrawn on top of the saved backgrounds
+        for ax, background, artists in [(self.ax_abs, self.plotBackgrounds[0], [self.line_abs, self.abs_text]),
+                                        (self.ax_diff, self.plotBackgrounds[1], [self.line_diff, self.diff_text])]:
+            self.canvas.restore_region(background)
+            for artist in artists:
+                ax.draw_artist(artist)
+            self.canvas.blit(ax.bbox)
 
     def handleInterrupt(self):
-        self.middle.interrupt()
+        '''
+        Send the interrupt over the middle server's safety lane, which acts on it immediately
+        instead of waiting for its next XML-RPC cycle. Falls back to XML-RPC if that fails.
+        '''
+        host = urllib.parse.urlsplit(MIDDLE_SERVER_ADDR).hostname
+        self.rpc.callNow(send_safety_command, host, SAFETY_PORT, 'interrupt',
+                         callback=self.handleInterruptDone, errback=self.handleInterruptFailed)
         self.enableControls()
         # Cancel display of post-shot data
         if self.afterShotGetData:
             self.root.after_cancel(self.afterShotGetData)
             self.afterShotGetData = None
         
+    def handleInterruptDone(self, reply):
+        if not reply['ok']:
+            self.handleInterruptFailed(reply['error'])
+            return
+        # The round trip starts in the click handler, so it is the click-to-safe-state latency
+        self._add_to_log('Interrupt: valves in safe state %.3g ms after click (middle server took %.3g ms)' 
+                         % (reply['round_trip_ms'], reply['handling_ms']))
+        
+    def handleInterruptFailed(self, error):
+        self._add_to_log('Safety lane interrupt failed (%s), sending interrupt through XML-RPC' % error, 'warning')
+        self.callServer('interrupt')
+        
     def handlePumpFill(self):
         '''
         Instruct middle server to pump and/or fill to desired pressure. Prompt user for confirmation
         if pressure is too high for mechanical pump and exhaust is not enabled.
         '''
         desiredPressure = float(self.desired_pressure_entry.get().strip())
-        pumpingOut = desiredPressure < self.absPressures[-1] or self.pumpOut.get()
-        if pumpingOut and self.absPressures[-1] > MECH_PUMP_LIMIT and not self.exhaust.get():
+        pumpingOut = desiredPressure < self.absPressure or self.pumpOut.get()
+        if pumpingOut and self.absPressure > MECH_PUMP_LIMIT and not self.exhaust.get():
             result = tk.messagebox.askquestion("Overpressure Warning", "Are you sure? This may damage the pump. You can enable exhaust to be safe, or proceed dangerously with 'Yes'.", icon='warning')
             if result != 'yes':
                 return
-        self.middle.changePressure(desiredPressure, self.pumpOut.get(), self.exhaust.get())
+        self.callServer('changePressure', desiredPressure, self.pumpOut.get(), self.exhaust.get())
         
     def handleT0(self):
-        Tdone = self.middle.handleT0({'puff_1_permission': self.enable_puff_1.get(),
+        self.callServer('handleT0', {'puff_1_permission': self.enable_puff_1.get(),
                                       'puff_2_permission': self.enable_puff_2.get(),
                                       'puff_3_permission': self.enable_puff_3.get(),
                                       'puff_4_permission': self.enable_puff_4.get(),
@@ -551,7 +892,10 @@ class GUI:
                                       'puff_4_duration': self.getPuffDuration(4),
                                       'shutter_change_duration': SHUTTER_CHANGE,
                                       'software_t1': SOFTWARE_T1,
-                                      'pretrigger': PRETRIGGER})
+                                      'pretrigger': PRETRIGGER},
+                        callback=self.handleShotStarted)
+            
+    def handleShotStarted(self, Tdone):
         # If a nonzero value is returned, settings were accepted and shot is happening for Tdone seconds
         if Tdone != 0:
             self.disableControls()
@@ -559,23 +903,24 @@ class GUI:
             self.afterShotGetData = self.root.after(int((Tdone+1)*1000), self.plotPuffs)
             
     def bindValveButtons(self):
-        self.shutter_setting_indicator.bind("<Button-1>", lambda event: self.middle.handleToggleShutter())
-        self.FV2_indicator.bind("<Button-1>", lambda event: self.middle.handleValve('FV2'))
-        self.V5_indicator.bind("<Button-1>", lambda event: self.middle.handleValve('V5'))
+        self.shutter_setting_indicator.bind("<Button-1>", lambda event: self.callServer('handleToggleShutter'))
+        self.FV2_indicator.bind("<Button-1>", lambda event: self.callServer('handleValve', 'FV2'))
+        self.V5_indicator.bind("<Button-1>", lambda event: self.callServer('handleValve', 'V5'))
         self.V4_indicator.bind("<Button-1>", lambda event: self.handleV4())
-        self.V3_indicator.bind("<Button-1>", lambda event: self.middle.handleValve('V3'))
-        self.V7_indicator.bind("<Button-1>", lambda event: self.middle.handleValve('V7'))        
+        self.V3_indicator.bind("<Button-1>", lambda event: self.callServer('handleValve', 'V3'))
+        self.V7_indicator.bind("<Button-1>", lambda event: self.callServer('handleValve', 'V7'))        
         
     def handleV4(self):
         '''
         Prompt user for confirmation if opening V4 and pressure is high as the pump may be damaged.
+        Uses the V4 status from the latest middle server data.
         '''
-        if self.absPressures[-1] > MECH_PUMP_LIMIT and self.middle.getValveStatus('V4') == 'close':
+        if self.absPressure > MECH_PUMP_LIMIT and self.valveStatus.get('V4') == 'close':
             result = tk.messagebox.askquestion("Overpressure Warning", "Are you sure? This may damage the pump.", icon='warning')
             if result == 'yes':
-                self.middle.handleValve('V4', 'open')
+                self.callServer('handleValve', 'V4', 'open')
         else:
-            self.middle.handleValve('V4')
+            self.callServer('handleValve', 'V4')
             
     def changeStandardElements(self, state):
         for element in [self.enable_puff_1_check, self.start_1_entry, self.duration_1_entry, 
@@ -603,29 +948,51 @@ class GUI:
             button.configure(relief=tk.FLAT, cursor='arrow')
         
     def plotPuffs(self):
-        # Get shot data from middle server
-        try:
-            T1, t, dp, da = self.middle.getLastShotData()
-        except Exception as e:
-            self._add_to_log('Get last shot data failed: %s' % e)
+        # Get shot data from middle server, handled in saveShot
+        self.afterShotGetData = None
+        self.callServer('getLastShotData', callback=self.saveShot, 
+                        errback=lambda e: self._add_to_log('Get last shot data failed: %s' % e, 'error'))
+        
+    def saveShot(self, shot):
+        if shot is None:
+            self._add_to_log('Middle server has no shot data', 'warning')
             return
+        shot['words'] = shot['words'].data
             
-        # Save shot data to file
+        # Save shot data to the archive
         try:
-            t = np.array(t)-T1
-            if not os.path.isdir(SAVE_FOLDER):
-                os.mkdir(SAVE_FOLDER)
-            savepath = SAVE_FOLDER + '/diff_pressure_%d.npy' % int(T1)
-            np.save(savepath, [t, dp])
-            savepath = SAVE_FOLDER + '/abs_pressure_%d.npy' % int(T1)
-            np.save(savepath, [t, da])
+            savepath = ShotArchive(SAVE_FOLDER).save(shot)
             self._add_to_log('Saved shot data to %s' % savepath)
         except Exception as e:
-            self._add_to_log('Save pressure data failed: %s' % e)
+            self._add_to_log('Save pressure data failed: %s' % e, 'error')
             return
             
-        # Launch script to plot data using the same python executable that's running this script
-        subprocess.Popen([sys.executable, 'plot_shot.py', savepath])
+        # Analyze and plot the shot in the background, see showAnalysisResults
+        self.analysisWorker.submit(SAVE_FOLDER, shot['shot_id'])
+        
+    def showAnalysisResults(self):
+        '''
+        Log and display the plots of any shots the analysis worker has finished.
+        '''
+        for shotId, pngPath, summary, error in self.analysisWorker.getResults():
+            if error:
+                self._add_to_log('Analysis of shot %d failed: %s' % (shotId, error), 'error')
+                continue
+            for i, ((start, stop), gas) in enumerate(zip(summary['puffs'], summary['puff_gas'])):
+                self._add_to_log('Shot %d puff %d: %.4f s to %.4f s, %.4g mbar-L' % (shotId, i+1, start, stop, gas))
+            self._add_to_log('Shot %d injected gas: %.4g mbar-L, plot saved to %s' % (shotId, summary['injected_gas'], pngPath))
+            
+            # Show the plot in a window that is reused for every shot
+            if self.shotWindow is None or not self.shotWindow.winfo_exists():
+                self.shotWindow = tk.Toplevel(self.root)
+                self.shotImage = tk.Label(self.shotWindow)
+                self.shotImage.pack(fill=tk.BOTH, expand=True)
+            image = Image.open(pngPath)
+            image.thumbnail((int(self.screen_width*.6), int(self.screen_height*.8)))
+            photo = ImageTk.PhotoImage(image)
+            self.shotImage.configure(image=photo)
+            self.shotImage.image = photo
+            self.shotWindow.title('Shot %d' % shotId)
 
  
 if __name__ == '__main__':
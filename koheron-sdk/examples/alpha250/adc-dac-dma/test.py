@@ -13,6 +13,7 @@ class AdcDacDma(object):
         self.client = client
         self.dac = np.zeros((self.n))
         self.adc = np.zeros((self.n))
+        self.progress = None
 
     @command()
     def select_adc_channel(self, channel):
@@ -41,10 +42,18 @@ class AdcDacDma(object):
     def get_adc_data(self):
         return self.client.recv_array(self.n/2, dtype='uint32')
 
+    @command(funcname='get_adc_data')
+    def get_adc_chunks(self):
+        return self.client.recv_array_chunks(self.n//2, dtype='uint32', progress=self.progress)
+
     def get_adc(self):
-        data = self.get_adc_data()
-        self.adc[::2] = (np.int32(data % 65536) - 32768) % 65536 - 32768
-        self.adc[1::2] = (np.int32(data >> 16) - 32768) % 65536 - 32768
+        # Each chunk is converted while the next one is still being received
+        i = 0
+        for data in self.get_adc_chunks():
+            n = 2 * len(data)
+            self.adc[i:i+n:2] = (np.int32(data % 65536) - 32768) % 65536 - 32768
+            self.adc[i+1:i+n:2] = (np.int32(data >> 16) - 32768) % 65536 - 32768
+            i += n
 
 if __name__=="__main__":
     host = os.getenv('HOST','192.168.1.16')
@@ -70,6 +79,7 @@ if __name__=="__main__":
     adc = np.zeros(driver.n)
 
     print("Get ADC{} data ({} points)".format(adc_channel, driver.n))
+    driver.progress = lambda received, total: print("{:.0f} %".format(100 * received / total), end='\r')
     driver.start_dma()
     driver.get_adc()
     driver.stop_dma()
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import os, time
-from koheron import command, connect
+from koheron import command, KoheronCluster
 
 class Cluster(object):
     def __init__(self, client):
@@ -49,30 +49,21 @@ class Cluster(object):
 if __name__=="__main__":
     # Define the IP addresses of the 4 Red Pitayas
     hosts = ['192.168.1.14', '192.168.1.5', '192.168.1.13', '192.168.1.6']
-    clients = []
-    drivers = []
+    cluster = KoheronCluster(hosts, Cluster, 'cluster')
+    drivers = cluster.drivers
 
-    for i, host in enumerate(hosts):
-        clients.append(connect(host, 'cluster', restart=False))
-        drivers.append(Cluster(clients[i]))
-
-    for driver in drivers:
-        driver.set_freq(10e6)
-        driver.set_clk_source('crystal')
-        driver.ctl_sata(1, 0)
-        driver.set_pulse_generator(100, 200)
+    cluster.broadcast('set_freq', 10e6)
+    cluster.broadcast('set_clk_source', 'crystal')
+    cluster.broadcast('ctl_sata', 1, 0)
+    cluster.broadcast('set_pulse_generator', 100, 200)
+    print('Configuration latencies (ms): {}'.format(1e3 * cluster.latencies))
 
     for i in [1,2,3]:
         drivers[i].set_clk_source('sata')
 
-    drivers[0].ctl_sata(1, 0)
-    drivers[1].ctl_sata(0, 7)
-    drivers[2].ctl_sata(0, 4)
-    drivers[3].ctl_sata(0, 2)
+    cluster.map('ctl_sata', [(1, 0), (0, 7), (0, 4), (0, 2)])
 
     for i in range(10000):
         drivers[1].phase_shift(1)
         print(i)
         time.sleep(0.01)
-
-
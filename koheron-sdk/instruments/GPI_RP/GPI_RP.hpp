@@ -11,9 +11,12 @@
 #include <chrono>
 #include <queue>
 #include <mutex>
+#include <condition_variable>
 
 #include <context.hpp>
 
+#include "shot_sequencer.hpp"
+
 // http://www.xilinx.com/support/documentation/ip_documentation/axi_fifo_mm_s/v4_1/pg080-axi-fifo-mm-s.pdf
 namespace Fifo_regs {
     constexpr uint32_t rdfr = 0x18;
@@ -23,6 +26,20 @@ namespace Fifo_regs {
 }
 
 constexpr uint32_t adc_buff_size = 50000;
+constexpr uint32_t max_blocking_ms = 500; // longest wait of get_GPI_data_blocking
+
+// Control registers a shot sequence may write, indexed by the register numbers sent with
+// set_sequence (same order as SEQUENCE_REGISTERS in GPI_RP.py)
+constexpr std::array<uint32_t, 7> sequence_registers = {{
+    reg::slow_1_manual,
+    reg::slow_2_manual,
+    reg::slow_3_manual,
+    reg::slow_4_manual,
+    reg::fast_manual,
+    reg::analog_out,
+    reg::send_T1
+}};
+constexpr int sequencer_priority = 80; // SCHED_FIFO priority of the sequence thread
 
 class GPI_RP {
     public:
@@ -32,8 +49,12 @@ class GPI_RP {
         , sts(ctx.mm.get<mem::status>())
         , adc_fifo_map(ctx.mm.get<mem::adc_fifo>())
         , adc_data(adc_buff_size)
+        , sequencer(ctl)
         {
             fifo_thread = std::thread{&GPI_RP::fifo_acquisition_thread, this};
+            if (!sequencer.set_realtime_priority(sequencer_priority)) {
+                ctx.log<WARNING>("GPI_RP: shot sequencer running without real-time priority");
+            }
         }
 
 	~GPI_RP()
@@ -206,13 +227,65 @@ class GPI_RP {
         std::vector<uint32_t>& get_GPI_data()
         {
             const std::lock_guard<std::mutex> lock(adc_data_queue_mutex);
-            const size_t queue_count = adc_data_queue.size();
-            adc_data.resize(queue_count);
-            for (size_t i = 0; i < queue_count; i++) {
-                adc_data[i] = adc_data_queue.front();
-                adc_data_queue.pop();
+            return empty_queue();
+        }
+
+        /** return data once min_samples are queued or timeout_ms has passed
+         *
+         * koheron-server holds this driver's mutex for the whole call, so every other GPI_RP
+         * command (from any client) waits while it blocks: keep timeout_ms short.
+         */
+        std::vector<uint32_t>& get_GPI_data_blocking(uint32_t min_samples, uint32_t timeout_ms)
+        {
+            std::unique_lock<std::mutex> lock(adc_data_queue_mutex);
+            const size_t wanted = std::min(min_samples, adc_buff_size);
+            adc_data_ready.wait_for(lock, std::chrono::milliseconds(std::min(timeout_ms, max_blocking_ms)),
+                                    [&] { return adc_data_queue.size() >= wanted; });
+            return empty_queue();
+        }
+
+        // Shot sequencer
+
+        /// Load a timeline of control register writes. registers are indices into
+        /// sequence_registers, times_us are microseconds after arm_sequence and must not
+        /// decrease. Returns false if the timeline is invalid or a sequence is running.
+        bool set_sequence(const std::vector<uint32_t>& registers,
+                          const std::vector<uint32_t>& values,
+                          const std::vector<uint32_t>& times_us) {
+            std::vector<uint32_t> offsets(registers.size());
+            for (size_t i = 0; i < registers.size(); i++) {
+                if (registers[i] >= sequence_registers.size()) {
+                    return false;
+                }
+                offsets[i] = sequence_registers[registers[i]];
             }
-            return adc_data;
+            return sequencer.load(offsets, values, times_us);
+        }
+
+        bool arm_sequence() {
+            return sequencer.arm();
+        }
+
+        void cancel_sequence() {
+            sequencer.cancel();
+        }
+
+        bool is_sequence_running() {
+            return sequencer.is_running();
+        }
+
+        /// ns after arm_sequence at which each action of the last run happened
+        std::vector<int64_t> get_sequence_times() {
+            return sequencer.get_execution_times();
+        }
+
+        /// Number of actions run, mean, standard deviation and max of their lateness (us)
+        std::array<double, 4> get_sequence_jitter() {
+            return sequencer.get_jitter_stats();
+        }
+
+        void reset_sequence_jitter() {
+            sequencer.reset_stats();
         }
 
         void wait_for(uint32_t n_pts)
@@ -232,8 +305,12 @@ class GPI_RP {
         std::mutex adc_data_queue_mutex;
         std::queue<uint32_t> adc_data_queue;
         std::vector<uint32_t> adc_data;
+        std::condition_variable adc_data_ready;
 
         void fill_buffer();
+        std::vector<uint32_t>& empty_queue();
+
+        ShotSequencer<Memory<mem::control>> sequencer;
 
         std::thread fifo_thread;
         std::atomic<bool> fifo_thread_running{true};
@@ -258,14 +335,30 @@ inline void GPI_RP::fill_buffer()
     const uint32_t samples = get_fifo_length();
     if (samples > 0)
     {
-        const std::lock_guard<std::mutex> lock(adc_data_queue_mutex);
-        for (size_t i=0; i < samples; i++)
         {
-            if (adc_data_queue.size() == adc_buff_size)
-                adc_data_queue.pop();
-            adc_data_queue.push(read_fifo());
+            const std::lock_guard<std::mutex> lock(adc_data_queue_mutex);
+            for (size_t i=0; i < samples; i++)
+            {
+                if (adc_data_queue.size() == adc_buff_size)
+                    adc_data_queue.pop();
+                adc_data_queue.push(read_fifo());
+            }
         }
+        // Wake get_GPI_data_blocking callers
+        adc_data_ready.notify_all();
+    }
+}
+
+// Move the queued samples to adc_data, with adc_data_queue_mutex held
+inline std::vector<uint32_t>& GPI_RP::empty_queue()
+{
+    const size_t queue_count = adc_data_queue.size();
+    adc_data.resize(queue_count);
+    for (size_t i = 0; i < queue_count; i++) {
+        adc_data[i] = adc_data_queue.front();
+        adc_data_queue.pop();
     }
+    return adc_data;
 }
 
 
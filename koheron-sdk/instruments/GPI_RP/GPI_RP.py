@@ -7,6 +7,10 @@ import numpy as np
 
 from koheron import command
 
+# Control registers a shot sequence may write, in the order of sequence_registers in GPI_RP.hpp
+SEQUENCE_REGISTERS = ['slow_1_manual', 'slow_2_manual', 'slow_3_manual', 'slow_4_manual',
+                      'fast_manual', 'analog_out', 'send_T1']
+
 class GPI_RP(object):
     def __init__(self, client):
         self.client = client
@@ -41,6 +45,15 @@ class GPI_RP(object):
     def get_GPI_data(self):
         return self.client.recv_vector(dtype='uint32')
 
+    @command()
+    def get_GPI_data_blocking(self, min_samples, timeout_ms):
+        '''
+        Like get_GPI_data, but the board first waits until min_samples are queued or timeout_ms
+        (at most 500) has passed, so a reader gets data as soon as it is there without polling.
+        Other GPI_RP commands, from any client, wait while this blocks.
+        '''
+        return self.client.recv_vector(dtype='uint32')
+
     @command()
     def reset_fifo(self):
         pass
@@ -125,6 +138,61 @@ class GPI_RP(object):
     def send_T1(self, state):
         pass
 
+    def set_sequence(self, actions):
+        '''
+        Load a shot timeline into the board-side sequencer.
+
+        Args:
+            actions: list of (register name from SEQUENCE_REGISTERS, value, seconds after
+                arm_sequence), in any order
+
+        Returns:
+            bool: False if the board rejected the timeline (e.g. a sequence is running)
+        '''
+        actions = sorted(actions, key=lambda action: action[2])
+        registers = np.array([SEQUENCE_REGISTERS.index(name) for name, _, _ in actions], dtype='uint32')
+        values = np.array([value for _, value, _ in actions], dtype='uint32')
+        times_us = np.array([round(t*1e6) for _, _, t in actions], dtype='uint32')
+        return self._set_sequence(registers, values, times_us)
+
+    @command(funcname='set_sequence')
+    def _set_sequence(self, registers, values, times_us):
+        return self.client.recv_bool()
+
+    @command()
+    def arm_sequence(self):
+        return self.client.recv_bool()
+
+    @command()
+    def cancel_sequence(self):
+        pass
+
+    @command()
+    def is_sequence_running(self):
+        return self.client.recv_bool()
+
+    @command()
+    def get_sequence_times(self):
+        '''
+        Returns:
+            NumPy int64 array: ns after arm_sequence at which each action of the last run was
+                carried out, in time order
+        '''
+        return self.client.recv_vector(dtype='int64')
+
+    @command()
+    def get_sequence_jitter(self):
+        '''
+        Returns:
+            NumPy array: number of actions run, mean, standard deviation and max of their
+                lateness in microseconds
+        '''
+        return self.client.recv_array(4, dtype='float64')
+
+    @command()
+    def reset_sequence_jitter(self):
+        pass
+
     @command()
     def get_W7X_permission(self):
         return self.client.recv_uint32()
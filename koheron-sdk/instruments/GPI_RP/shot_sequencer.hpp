@@ -0,0 +1,207 @@
+/// Shot sequencer for the GPI_RP driver
+///
+/// Runs a timeline of register writes (register offset, value, time after arming) from its own
+/// thread on the board, so the timing of a shot does not depend on the network or on the middle
+/// server's loop. The time each action was actually carried out is recorded for jitter statistics.
+///
+/// The sequencer only needs a class with write_reg(offset, value), so it does not depend on the
+/// server context and can be compiled on a host against a simulated register map:
+///
+///     struct SimulatedRegisters {
+///         std::map<uint32_t, uint32_t> values;
+///         void write_reg(uint32_t offset, uint32_t value) { values[offset] = value; }
+///     };
+///     SimulatedRegisters regs;
+///     ShotSequencer<SimulatedRegisters> sequencer(regs);
+
+#ifndef __DRIVERS_SHOT_SEQUENCER_HPP__
+#define __DRIVERS_SHOT_SEQUENCER_HPP__
+
+#include <cstdint>
+#include <cmath>
+#include <array>
+#include <vector>
+#include <algorithm>
+#include <thread>
+#include <mutex>
+#include <condition_variable>
+#include <chrono>
+#include <pthread.h>
+
+constexpr uint32_t max_sequence_length = 256;
+
+template <class Registers, class Clock = std::chrono::steady_clock>
+class ShotSequencer {
+    public:
+        /// spin_us: the thread sleeps until this long before each action, then busy-waits
+        ShotSequencer(Registers& regs_, uint32_t spin_us = 200)
+        : regs(regs_)
+        , spin(std::chrono::microseconds(spin_us))
+        {
+            sequence_thread = std::thread{&ShotSequencer::sequence_loop, this};
+        }
+
+        ~ShotSequencer()
+        {
+            {
+                const std::lock_guard<std::mutex> lock(mutex);
+                thread_running = false;
+                cancelled = true;
+            }
+            cv.notify_all();
+            sequence_thread.join();
+        }
+
+        /// Give the sequence thread a real-time (SCHED_FIFO) priority. Returns false if the
+        /// process is not allowed to.
+        bool set_realtime_priority(int priority) {
+            sched_param param{};
+            param.sched_priority = priority;
+            return pthread_setschedparam(sequence_thread.native_handle(), SCHED_FIFO, &param) == 0;
+        }
+
+        /// Replace the timeline. Times are in microseconds after arming and must not decrease.
+        /// Returns false, keeping the previous timeline, if a sequence is running or the
+        /// timeline is invalid.
+        bool load(const std::vector<uint32_t>& offsets,
+                  const std::vector<uint32_t>& values,
+                  const std::vector<uint32_t>& times_us) {
+            if (offsets.size() != values.size() || offsets.size() != times_us.size()
+                || offsets.size() > max_sequence_length
+                || !std::is_sorted(times_us.begin(), times_us.end())) {
+                return false;
+            }
+            const std::lock_guard<std::mutex> lock(mutex);
+            if (armed) {
+                return false;
+            }
+            actions.resize(offsets.size());
+            for (size_t i = 0; i < offsets.size(); i++) {
+                actions[i] = {offsets[i], values[i], std::chrono::microseconds(times_us[i])};
+            }
+            executed_ns.clear();
+            return true;
+        }
+
+        /// Start the loaded timeline now. Returns false if it is empty or already running.
+        bool arm() {
+            {
+                const std::lock_guard<std::mutex> lock(mutex);
+                if (armed || actions.empty()) {
+                    return false;
+                }
+                executed_ns.clear();
+                arm_time = Clock::now();
+                armed = true;
+                cancelled = false;
+            }
+            cv.notify_all();
+            return true;
+        }
+
+        /// Stop the running timeline. Returns once the sequence thread has stopped it, so no
+        /// register is written by the sequencer after this and a new timeline can be loaded.
+        void cancel() {
+            std::unique_lock<std::mutex> lock(mutex);
+            cancelled = true;
+            cv.notify_all();
+            cv.wait(lock, [this] { return !armed; });
+        }
+
+        bool is_running() {
+            const std::lock_guard<std::mutex> lock(mutex);
+            return armed;
+        }
+
+        /// Time in ns after arming at which each action of the last run was carried out, in
+        /// timeline order. Shorter than the timeline if the run was cancelled or is in progress.
+        std::vector<int64_t> get_execution_times() {
+            const std::lock_guard<std::mutex> lock(mutex);
+            return executed_ns;
+        }
+
+        /// Number of actions carried out since the last reset_stats, mean, standard deviation
+        /// and maximum of their lateness in microseconds
+        std::array<double, 4> get_jitter_stats() {
+            const std::lock_guard<std::mutex> lock(mutex);
+            const double variance = n_stats > 1 ? m2_ns/(n_stats - 1) : 0;
+            return {{double(n_stats), mean_ns*1e-3, std::sqrt(variance)*1e-3, max_ns*1e-3}};
+        }
+
+        void reset_stats() {
+            const std::lock_guard<std::mutex> lock(mutex);
+            n_stats = 0;
+            mean_ns = 0;
+            m2_ns = 0;
+            max_ns = 0;
+        }
+
+    private:
+        struct Action {
+            uint32_t offset;
+            uint32_t value;
+            typename Clock::duration time;
+        };
+
+        Registers& regs;
+        const typename Clock::duration spin;
+
+        std::mutex mutex;
+        std::condition_variable cv;
+        std::vector<Action> actions;
+        std::vector<int64_t> executed_ns;
+        typename Clock::time_point arm_time;
+        bool armed = false;
+        bool cancelled = false;
+        bool thread_running = true;
+
+        // Welford running statistics of the lateness of each action
+        uint64_t n_stats = 0;
+        double mean_ns = 0;
+        double m2_ns = 0;
+        double max_ns = 0;
+
+        std::thread sequence_thread;
+        void sequence_loop();
+        void add_lateness(double lateness_ns);
+};
+
+template <class Registers, class Clock>
+inline void ShotSequencer<Registers, Clock>::sequence_loop()
+{
+    std::unique_lock<std::mutex> lock(mutex);
+    while (thread_running) {
+        cv.wait(lock, [this] { return armed || !thread_running; });
+        for (size_t i = 0; i < actions.size() && armed; i++) {
+            const auto target = arm_time + actions[i].time;
+            // The mutex is released while sleeping so cancel and the getters are not held up
+            if (cv.wait_until(lock, target - spin, [this] { return cancelled; })) {
+                break;
+            }
+            // Busy-wait the last stretch with the mutex held: cancel waits at most this long
+            auto now = Clock::now();
+            while (now < target) {
+                now = Clock::now();
+            }
+            regs.write_reg(actions[i].offset, actions[i].value);
+            const auto done = Clock::now();
+            executed_ns.push_back(std::chrono::duration_cast<std::chrono::nanoseconds>(done - arm_time).count());
+            add_lateness(std::chrono::duration_cast<std::chrono::duration<double, std::nano>>(done - target).count());
+        }
+        armed = false;
+        // Wakes cancel()
+        cv.notify_all();
+    }
+}
+
+template <class Registers, class Clock>
+inline void ShotSequencer<Registers, Clock>::add_lateness(double lateness_ns)
+{
+    n_stats++;
+    const double delta = lateness_ns - mean_ns;
+    mean_ns += delta / n_stats;
+    m2_ns += delta * (lateness_ns - mean_ns);
+    max_ns = std::max(max_ns, lateness_ns);
+}
+
+#endif // __DRIVERS_SHOT_SEQUENCER_HPP__
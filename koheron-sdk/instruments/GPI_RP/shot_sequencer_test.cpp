@@ -0,0 +1,111 @@
+/// Host test of the shot sequencer against a simulated register map
+///
+///     make -C instruments/GPI_RP test
+
+#include <map>
+#include <vector>
+#include <cstdio>
+#include <cstdlib>
+
+#include "shot_sequencer.hpp"
+
+#define CHECK(condition) \
+    if (!(condition)) { \
+        std::fprintf(stderr, "%s:%d: check failed: %s\n", __FILE__, __LINE__, #condition); \
+        std::exit(1); \
+    }
+
+struct SimulatedRegisters {
+    std::mutex mutex;
+    std::map<uint32_t, uint32_t> values;
+    std::vector<std::pair<uint32_t, uint32_t>> writes;
+
+    void write_reg(uint32_t offset, uint32_t value) {
+        const std::lock_guard<std::mutex> lock(mutex);
+        values[offset] = value;
+        writes.push_back({offset, value});
+    }
+
+    size_t count() {
+        const std::lock_guard<std::mutex> lock(mutex);
+        return writes.size();
+    }
+};
+
+static void sleep_ms(int ms) {
+    std::this_thread::sleep_for(std::chrono::milliseconds(ms));
+}
+
+// 50 writes, 1 ms apart
+static void load_timeline(ShotSequencer<SimulatedRegisters>& sequencer) {
+    std::vector<uint32_t> offsets, values, times_us;
+    for (uint32_t i = 0; i < 50; i++) {
+        offsets.push_back(i % 4);
+        values.push_back(i);
+        times_us.push_back(1000 * i);
+    }
+    CHECK(sequencer.load(offsets, values, times_us));
+}
+
+static void test_invalid_timelines(ShotSequencer<SimulatedRegisters>& sequencer) {
+    CHECK(!sequencer.arm()); // nothing loaded
+    CHECK(!sequencer.load({1, 2}, {1}, {0, 1})); // sizes differ
+    CHECK(!sequencer.load({1, 2}, {1, 1}, {5, 1})); // times not sorted
+    CHECK(!sequencer.load(std::vector<uint32_t>(max_sequence_length + 1, 0),
+                          std::vector<uint32_t>(max_sequence_length + 1, 0),
+                          std::vector<uint32_t>(max_sequence_length + 1, 0)));
+}
+
+static void test_full_run(ShotSequencer<SimulatedRegisters>& sequencer, SimulatedRegisters& regs) {
+    load_timeline(sequencer);
+    CHECK(sequencer.arm());
+    CHECK(!sequencer.arm()); // already running
+    CHECK(sequencer.is_running());
+    sleep_ms(80);
+    CHECK(!sequencer.is_running());
+    const auto times = sequencer.get_execution_times();
+    CHECK(times.size() == 50 && regs.count() == 50);
+    for (size_t i = 0; i < times.size(); i++) {
+        CHECK(times[i] >= int64_t(1000000 * i)); // never early
+        CHECK(regs.writes[i].second == i); // in timeline order
+    }
+    const auto stats = sequencer.get_jitter_stats();
+    CHECK(stats[0] == 50);
+    std::printf("jitter: mean %.1f us, std %.1f us, max %.1f us\n", stats[1], stats[2], stats[3]);
+}
+
+static void test_cancel_and_rearm(ShotSequencer<SimulatedRegisters>& sequencer, SimulatedRegisters& regs) {
+    const size_t before = regs.count();
+    CHECK(sequencer.arm());
+    sleep_ms(10);
+    sequencer.cancel();
+    // Stopped when cancel returns: no later writes, and a new timeline is accepted at once
+    CHECK(!sequencer.is_running());
+    const size_t after = regs.count();
+    CHECK(after > before && after < before + 50);
+    CHECK(sequencer.get_execution_times().size() == after - before);
+    load_timeline(sequencer);
+    sleep_ms(60);
+    CHECK(regs.count() == after);
+
+    // Re-armed, the new timeline runs in full
+    CHECK(sequencer.arm());
+    sleep_ms(80);
+    CHECK(!sequencer.is_running());
+    CHECK(regs.count() == after + 50);
+
+    // Cancel without a running timeline returns at once and does not block the next arm
+    sequencer.cancel();
+    CHECK(sequencer.arm());
+    sequencer.cancel();
+}
+
+int main() {
+    SimulatedRegisters regs;
+    ShotSequencer<SimulatedRegisters> sequencer(regs);
+    test_invalid_timelines(sequencer);
+    test_full_run(sequencer, regs);
+    test_cancel_and_rearm(sequencer, regs);
+    std::printf("shot sequencer tests passed\n");
+    return 0;
+}
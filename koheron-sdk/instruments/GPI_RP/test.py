@@ -23,12 +23,10 @@ c = koheron.connect('localhost', name='GPI_RP')
 rp = GPI_RP(c)
 times = []
 
-start = time.time()
 try:
     while True:
-        time.sleep(time.time() - start + .1)
-        start = time.time()
-        data = rp.get_GPI_data()
+        # Returns as soon as 1000 samples (0.1 s) are queued on the board
+        data = rp.get_GPI_data_blocking(1000, 200)
         print(hex(data[0]) if data.size else [], len(data))
 finally:
     p.terminate()
@@ -2,9 +2,12 @@ from .version import __version__
 
 from .koheron import KoheronClient
 from .koheron import command
+from .koheron import ClientPool
 from .koheron import ConnectionError
 from .koheron import connect
 from .koheron import run_instrument
 from .koheron import upload_instrument
 from .alpha250 import Alpha250
+from .stream import FifoStream
 
+from .cluster import KoheronCluster
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Drivers for the same instrument on several boards, called concurrently. Each board has its own
+connection and a thread to call it from, so a command sent to every board takes about one round
+trip instead of one per board.
+'''
+
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from .koheron import connect
+
+
+def to_array(results):
+    try:
+        return np.array(results)
+    except ValueError:
+        # Results of different shapes: one object per host
+        array = np.empty(len(results), dtype=object)
+        array[:] = results
+        return array
+
+
+class KoheronCluster:
+    def __init__(self, hosts, driver_class, name=None, restart=False):
+        ''' Connect to all hosts in parallel
+
+        Args:
+            hosts: List of IP addresses
+            driver_class: Python driver class, instantiated with the client of each host
+            name: Instrument to run on each board (the one running if None)
+            restart: Restart the instrument if it is already running
+        '''
+        self.hosts = list(hosts)
+        self.executor = ThreadPoolExecutor(max_workers=len(self.hosts))
+        # Seconds taken by each host for the last broadcast or map
+        self.latencies = np.zeros(len(self.hosts))
+        clients, errors = self._run([(connect, (host, name), {'restart': restart}) for host in self.hosts])
+        if errors:
+            # Do not leave the other connections and the executor threads open
+            for client in clients:
+                if client is not None:
+                    client.sock.close()
+            self.executor.shutdown()
+            raise RuntimeError('KoheronCluster: ' + '; '.join(errors))
+        self.clients = clients
+        self.drivers = [driver_class(client) for client in self.clients]
+
+    def __len__(self):
+        return len(self.drivers)
+
+    def __getitem__(self, index):
+        return self.drivers[index]
+
+    def broadcast(self, method, *args):
+        ''' Call the same driver method with the same arguments on every board
+
+        Returns:
+            NumPy array of the results in host order (None for methods without a result)
+        '''
+        return to_array(self._gather([(getattr(driver, method), args, {}) for driver in self.drivers]))
+
+    def map(self, method, args):
+        ''' Call a driver method on every board with different arguments
+
+        Args:
+            method: Driver method name
+            args: One entry per host: a tuple of arguments, or a single argument
+
+        Returns:
+            NumPy array of the results in host order
+        '''
+        if len(args) != len(self.drivers):
+            raise ValueError('map: expects arguments for {} hosts, got {}'.format(len(self.drivers), len(args)))
+        return to_array(self._gather([(getattr(driver, method), arg if isinstance(arg, tuple) else (arg,), {})
+                                      for driver, arg in zip(self.drivers, args)]))
+
+    def close(self):
+        self.executor.shutdown()
+        for client in self.clients:
+            client.sock.close()
+
+    def _gather(self, calls):
+        results, errors = self._run(calls)
+        if errors:
+            raise RuntimeError('KoheronCluster: ' + '; '.join(errors))
+        return results
+
+    def _run(self, calls):
+        ''' Returns the results in host order (None where a call failed) and the errors '''
+        futures = [self.executor.submit(self._timed, i, func, args, kwargs)
+                   for i, (func, args, kwargs) in enumerate(calls)]
+        results = []
+        errors = []
+        # Wait for every host before returning, so no call is still running
+        for host, future in zip(self.hosts, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(None)
+                errors.append('{}: {}'.format(host, e))
+        return results, errors
+
+    def _timed(self, index, func, args, kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.latencies[index] = time.time() - start
@@ -17,6 +17,9 @@ import string
 import json
 import requests
 import time
+import queue
+import threading
+import contextlib
 
 from .version import __version__
 
@@ -79,11 +82,14 @@ def command(classname=None, funcname=None):
             device_name = classname or self.__class__.__name__
             cmd_name = funcname or func.__name__
             device_id, cmd_id, cmd_args = self.client.get_ids(device_name, cmd_name)
-            # print('send_command', device_id, cmd_id, cmd_args, args)
-            self.client.send_command(device_id, cmd_id, cmd_args, *args)
-            self.client.last_device_called = device_name
-            self.client.last_cmd_called = cmd_name
-            return func(self, *args)
+            # Held until the response has been read, so that commands from other threads
+            # cannot interleave on the socket or change last_cmd_called in between
+            with self.client.lock:
+                # print('send_command', device_id, cmd_id, cmd_args, args)
+                self.client.send_command(device_id, cmd_id, cmd_args, *args)
+                self.client.last_device_called = device_name
+                self.client.last_cmd_called = cmd_name
+                return func(self, *args)
         return wrapper
     return real_command
 
@@ -236,6 +242,8 @@ class KoheronClient:
         self.port = port
         self.unixsock = unixsock
         self.is_connected = False
+        # Held by each command from sending it to reading its response (see command)
+        self.lock = threading.RLock()
 
         if host != '':
             try:
@@ -442,6 +450,83 @@ class KoheronClient:
         buff = self.recv_all(dtype.itemsize * arr_len)
         return np.frombuffer(buff, dtype=dtype.newbyteorder('<')).reshape(shape)
 
+    def recv_into(self, buff, timeout=1):
+        '''Fill a writable buffer (e.g. a numpy array) with exactly len(buff) bytes.'''
+        view = memoryview(buff).cast('B')
+        n_rcv = 0
+        start = time.time()
+        while n_rcv < len(view):
+            try:
+                n = self.sock.recv_into(view[n_rcv:])
+            except:
+                raise ConnectionError('recv_into: Socket connection broken.')
+            if n == 0:
+                raise ConnectionError('recv_into: Socket connection closed.')
+            n_rcv += n
+            if time.time() - start > timeout:
+                raise Exception('recv_into timeout: took too long to get data')
+
+    def recv_array_chunks(self, shape, dtype='uint32', chunk_size=65536, progress=None,
+                          min_rate=1e6, timeout=1, check_type=True):
+        '''Receive a numpy array with known shape as an iterator of 1-D chunks.
+
+        Each chunk can be processed while the rest of the array is still arriving. Instead of
+        a fixed timeout for the whole transfer, each chunk must arrive within
+        timeout + chunk bytes / min_rate seconds.
+
+        Args:
+            shape: Shape of the std::array returned by the command
+            dtype: Element type
+            chunk_size: Number of elements per chunk (the last one may be shorter)
+            progress: Function called with (bytes received, total bytes) after each chunk
+            min_rate: Slowest accepted transfer rate in bytes per second
+            timeout: Seconds allowed per chunk on top of the transfer time at min_rate
+
+        Returns:
+            Iterator of numpy arrays in array order (a reshaped array is reassembled with
+            np.concatenate(chunks).reshape(shape)). The iterator must be run to the end, or
+            closed, before the next command: closing it early discards the rest of the array.
+            The client lock is held until then, so it must be iterated in the calling thread.
+        '''
+        arr_len = int(np.prod(shape))
+        if check_type:
+            self.check_ret_array(dtype, arr_len)
+        dtype = np.dtype(dtype).newbyteorder('<')
+        self.lock.acquire()
+        try:
+            # Header checked now, so the caller may send nothing else before iterating
+            self.recv(fmt='')
+        except:
+            self.lock.release()
+            raise
+        chunks = self._iter_array_chunks(arr_len, dtype, int(chunk_size), progress, min_rate, timeout)
+        # Started so that closing it always releases the lock
+        next(chunks)
+        return chunks
+
+    def _iter_array_chunks(self, arr_len, dtype, chunk_size, progress, min_rate, timeout):
+        total = arr_len * dtype.itemsize
+        n_rcv = 0
+        try:
+            yield
+            for start in range(0, arr_len, chunk_size):
+                chunk = np.empty(min(chunk_size, arr_len - start), dtype=dtype)
+                self.recv_into(chunk, timeout=timeout + chunk.nbytes / min_rate)
+                n_rcv += chunk.nbytes
+                if progress is not None:
+                    progress(n_rcv, total)
+                yield chunk
+        except GeneratorExit:
+            # Closed early: discard the rest so the connection stays in step with the server
+            scratch = memoryview(bytearray(min(total - n_rcv, chunk_size * dtype.itemsize)))
+            while n_rcv < total:
+                view = scratch[:total - n_rcv]
+                self.recv_into(view, timeout=timeout + len(view) / min_rate)
+                n_rcv += len(view)
+            raise
+        finally:
+            self.lock.release()
+
     def recv_tuple(self, fmt, check_type=True):
         if check_type:
             self.check_ret_tuple()
@@ -450,3 +535,65 @@ class KoheronClient:
     def __del__(self):
         if hasattr(self, 'sock'):
             self.sock.close()
+
+# --------------------------------------------
+# Connection pool
+# --------------------------------------------
+
+class ClientPool:
+    def __init__(self, host='', port=36000, size=4):
+        ''' Connections to one koheron-server, for threads that send commands in parallel
+
+        A KoheronClient serializes the commands of all threads using it. Each session of the
+        pool is its own connection, so e.g. a status query does not wait for a large data read.
+        Connections are opened when first needed and kept for reuse.
+
+        Args:
+            host: A string with the IP address
+            port: Port of the TCP connection (must be an integer)
+            size: Maximum number of connections
+        '''
+        self.host = host
+        self.port = port
+        self.size = size
+        self.idle = queue.LifoQueue()
+        # One slot per connection that may be open: taken by acquire, given back by release or
+        # discard, so a thread waiting for a connection wakes when another is closed
+        self.slots = threading.BoundedSemaphore(size)
+
+    @contextlib.contextmanager
+    def session(self, timeout=None):
+        ''' Borrow a client for the duration of a with block
+
+        Waits up to timeout seconds (forever if None) when all connections are in use.
+        The client is closed instead of returned to the pool if the block raised, since a
+        response may be left unread on its connection.
+        '''
+        client = self.acquire(timeout)
+        try:
+            yield client
+        except:
+            self.discard(client)
+            raise
+        self.release(client)
+
+    def acquire(self, timeout=None):
+        if not self.slots.acquire(timeout=timeout):
+            raise TimeoutError('ClientPool: no connection to {} free after {} s'.format(self.host, timeout))
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return KoheronClient(self.host, self.port)
+        except:
+            self.slots.release()
+            raise
+
+    def release(self, client):
+        self.idle.put(client)
+        self.slots.release()
+
+    def discard(self, client):
+        client.sock.close()
+        self.slots.release()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Continuous acquisition from FIFO-backed drivers. A FifoStream calls a driver read method (e.g.
+GPI_RP.get_GPI_data_blocking or Decimator.read_adc) in a loop on a background thread and puts the
+samples in a preallocated ring buffer, so receiving the next block overlaps with the consumer
+processing the previous one. Samples the consumer did not take before the ring wrapped are counted
+as dropped.
+
+Commands sent on the same KoheronClient from other threads wait for the read in progress; use
+another connection (see ClientPool) for commands that must not be held up.
+'''
+
+import time
+import threading
+import numpy as np
+
+
+class FifoStream:
+    def __init__(self, read, capacity, dtype=None, interval=0, callback=None, on_error=None):
+        ''' Stream the samples returned by a driver read method
+
+        Args:
+            read: Function returning a 1-D NumPy array of new samples (possibly empty), e.g. a
+                bound driver method or a lambda around one with arguments
+            capacity: Number of samples kept in the ring buffer
+            dtype: Sample type, taken from the first read if None
+            interval: Seconds to wait after a read that returned no samples (0 for blocking reads)
+            callback: If given, called with each new block of samples from a consumer thread
+                instead of iterating over the stream
+            on_error: In callback mode, called with the exception that stopped the stream (from
+                the read function or the callback); it is also kept in stats()['error']
+        '''
+        self.read_function = read
+        self.capacity = int(capacity)
+        self.interval = interval
+        self.callback = callback
+        self.on_error = on_error
+        self.ring = None if dtype is None else np.empty(self.capacity, dtype=dtype)
+        # Sample counts since start: written by the stream thread, taken by the consumer, lost
+        self.write_count = 0
+        self.read_count = 0
+        self.dropped = 0
+        self.reads = 0
+        self.read_time = 0.0
+        # Exception that stopped the stream, and whether get has raised it yet
+        self.error = None
+        self.error_raised = False
+        self.running = False
+        self.start_time = None
+        self.condition = threading.Condition()
+        self.threads = []
+
+    def start(self):
+        self.running = True
+        self.start_time = time.time()
+        self.error = None
+        self.error_raised = False
+        self.threads = [threading.Thread(target=self._receive, name='FifoStream', daemon=True)]
+        if self.callback is not None:
+            self.threads.append(threading.Thread(target=self._consume, name='FifoStreamCallback', daemon=True))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def __iter__(self):
+        ''' Yield blocks of new samples until the stream is stopped '''
+        while True:
+            samples = self.get()
+            if samples is None:
+                return
+            yield samples
+
+    def get(self, max_samples=None, timeout=None):
+        ''' Take the samples received since the last call
+
+        Args:
+            max_samples: Return at most this many (the oldest ones), leaving the rest
+            timeout: Seconds to wait for samples, None to wait until there are some
+
+        Returns:
+            NumPy array (a copy, empty on timeout), or None once the stream has stopped and
+            every sample has been taken
+
+        Raises:
+            The exception of the read function that stopped the stream, once, after every
+            sample received before it has been taken
+        '''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.write_count > self.read_count or not self.running, timeout):
+                return np.empty(0, dtype=self.ring.dtype if self.ring is not None else 'uint32')
+            available = self.write_count - self.read_count
+            if available == 0:
+                if self.error is not None and not self.error_raised:
+                    self.error_raised = True
+                    raise self.error
+                return None
+            n = available if max_samples is None else min(available, max_samples)
+            start = self.read_count % self.capacity
+            first = min(n, self.capacity - start)
+            samples = np.concatenate((self.ring[start:start+first], self.ring[:n-first]))
+            self.read_count += n
+            return samples
+
+    def stats(self):
+        ''' Acquisition statistics since start
+
+        Returns:
+            dict: reads, samples received, samples dropped, samples waiting in the ring,
+                throughput (samples/s), mean time per read (ms) and the exception that stopped
+                the stream (None while it runs)
+        '''
+        with self.condition:
+            elapsed = time.time() - self.start_time if self.start_time else 0
+            return {'reads': self.reads,
+                    'samples': self.write_count,
+                    'dropped': self.dropped,
+                    'waiting': self.write_count - self.read_count,
+                    'throughput': self.write_count/elapsed if elapsed > 0 else 0,
+                    'mean_read_ms': 1000*self.read_time/self.reads if self.reads else 0,
+                    'error': self.error}
+
+    def _receive(self):
+        while self.running:
+            start = time.time()
+            try:
+                samples = np.asarray(self.read_function()).ravel()
+            except Exception as e:
+                with self.condition:
+                    self.error = e
+                    self.running = False
+                    self.condition.notify_all()
+                return
+            with self.condition:
+                self.reads += 1
+                self.read_time += time.time() - start
+                if len(samples):
+                    self._append(samples)
+                    self.condition.notify_all()
+            if not len(samples) and self.interval:
+                time.sleep(self.interval)
+
+    def _append(self, samples):
+        if self.ring is None:
+            self.ring = np.empty(self.capacity, dtype=samples.dtype)
+        n = len(samples)
+        kept = samples[-self.capacity:]
+        start = (self.write_count + n - len(kept)) % self.capacity
+        first = min(len(kept), self.capacity - start)
+        self.ring[start:start+first] = kept[:first]
+        self.ring[:len(kept)-first] = kept[first:]
+        self.write_count += n
+        # Samples overwritten before the consumer took them
+        oldest = self.write_count - self.capacity
+        if self.read_count < oldest:
+            self.dropped += oldest - self.read_count
+            self.read_count = oldest
+
+    def _consume(self):
+        try:
+            for samples in self:
+                self.callback(samples)
+        except Exception as e:
+            with self.condition:
+                if self.error is None:
+                    self.error = e
+                    self.error_raised = True
+                self.running = False
+                self.condition.notify_all()
+            if self.on_error is not None:
+                self.on_error(e)
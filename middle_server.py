@@ -12,64 +12,71 @@ TODO:
 import time
 import datetime
 import xmlrpc.server
+import xmlrpc.client
+import queue
 import logging
+import threading
+import collections
 import koheron
 import numpy as np
 from GPI_RP.GPI_RP import GPI_RP
+from gauges import abs_mbar, diff_mbar, words_from_mbar, CALIBRATION
+from recorder import SegmentRecorder, RecordingReader
+from decimation import minmax_decimate
+from shot_capture import ShotCapture, ShotPersister
+from status_stream import StatusPublisher
+from dashboard import DashboardServer
+from shared_ring import SharedRingWriter
+from safety_lane import SafetyLane
+from pressure_control import PressureEstimator, ValveController
+from acquisition import AcquisitionPacer
+from boards import Board, read_valve, write_valve, read_shutter_sensor, read_status
 
 
 # User settings
 RP_HOSTNAME = 'w7xrp2' # hostname of red pitaya being used
+BOARD_NAME = 'GPI' # name of the board at RP_HOSTNAME in the board methods (getBoards, getBoardStatus, ...)
+BOARDS = {} # name: hostname of further GPI_RP boards to acquire from and control valves on (see boards.py)
 LOG_FILE = 'log.txt'
 PUMPED_OUT = 0 # mbar, pressure at which to stop pumping out
-FILL_MARGIN = 5 # mbar, stop this amount short of desired fill pressure to avoid overshoot
+FILL_TOLERANCE = 0.5 # mbar, a fill is complete once the settled pressure is this close to the desired pressure
 SIMULATE_RP = False # create fake data to test pump/puff methods, gui...
 ANNOUNCE_HEALTH = False # regularly log info about middle server health
+RECORD_RAW = True # stream every raw pressure word to segment files in RECORD_FOLDER
+RECORD_FOLDER = 'raw_data'
+RECORD_RETENTION = 7*24*3600 # seconds, raw data segments older than this are deleted
+SHOT_FOLDER = 'shot_archive' # middle server's own archive of every captured shot
+SHARED_RING = True # publish raw pressure words in shared memory for readers on this computer (see shared_ring.py)
+SHARED_RING_SECONDS = 60 # seconds of raw pressure words kept in shared memory
 
 # Less commonly changed user settings
-CONTROL_INTERVAL = 0.1 # seconds between pump/fill loop iterations
+CONTROL_INTERVAL = 0.1 # seconds between handling XML-RPC requests and publishing status
+ACQUISITION_TARGET = 500 # samples waiting in the RP queue at each read while pumping, filling or during a shot
+ACQUISITION_TARGET_IDLE = 2000 # samples waiting in the RP queue at each read while idle
+RP_QUEUE_SIZE = 50000 # samples the RP driver queues before dropping the oldest (adc_buff_size in GPI_RP.hpp)
+BLOCKING_READ_WAIT = 0.02 # seconds the RP may hold a read open until the acquisition target is queued, 0 to poll with get_GPI_data. Other RP commands, including the safety lane's, wait up to this long
+BLOCKING_READ_LEAD = 0.003 # seconds before the acquisition target is expected that a blocking read is sent
 MECH_PUMP_LIMIT = 1026 # mbar, max pressure the mechanical pump should work on
+SETTLE_TIME = 1 # seconds after closing V5/V4 before the settled pressure is read to learn from and top up
+PULSE_RANGE = 10 # mbar, fill deficits up to this are topped up with V5 pulses instead of a continuous fill
+FILL_MARGIN = 5 # mbar, a continuous fill stops this short of the desired pressure until the V5 lag is learned, then V5 pulses top up
+MAX_FILL_PULSES = 5 # V5 pulses tried before a fill is reported complete outside FILL_TOLERANCE
 MAX_FILL = 3*1013 # mbar, max pressure that user can request
 READING_HISTORY = 30 # seconds of pressure readings to keep in memory
 MAX_PUFF_DURATION = 2 # seconds max for FV2 to remain open for an individual puff
 PRESSURE_HZ = 10000 # FPGA sampling rate for absolute and differential pressure gauges
 DOWNSAMPLE_N = 1000 # number of pressure measurements to average when downsampling
-TORR_TO_MBAR = 1.33322
+MAX_QUERY_POINTS = 20000 # max number of points returned by getPressures
+RECENT_SHOTS = 20 # number of captured shots kept in memory for clients to fetch
+LOG_HISTORY = 10000 # number of log messages kept in memory for getLogHistory
+LOG_LEVELS = ['debug', 'info', 'warning', 'error'] # log message levels, least to most severe
+STREAM_PORT = 50001 # TCP port that pushes status, downsampled pressure and log messages to subscribers
+DASHBOARD_PORT = 8080 # HTTP port of the read-only browser dashboard, None to disable it
+SAFETY_PORT = 50002 # TCP port of the safety lane for interrupt/safe state commands (see safety_lane.py)
+BOARD_SEQUENCER = False # run the shot timeline (V3, shutter, software T1) on the GPI_RP board-side sequencer instead of server tasks
+T1_PULSE = 0.001 # seconds the software T1 line is held high by the board sequencer
     
 
-def twos_complement(arr, num_bits=14):
-    arr = arr.astype(np.int32) # if arr is uint32, output is wrong if we don't do this
-    sign_mask = 1 << (num_bits - 1)  # For example 0b100000000
-    bits_mask = sign_mask - 1  # For example 0b011111111
-    return np.bitwise_and(arr, bits_mask) - np.bitwise_and(arr, sign_mask)
-    
-    
-def abs_mbar(arr):
-    # Get parts of binary vals corresponding to abs measurement (digits 5 through 19)
-    arr = np.right_shift(arr, 14)
-    # Convert from unsigned to signed integers
-    arr = twos_complement(arr, 14)
-    # Convert to float
-    f = 2/(2**14-1)*arr
-    # Calibration for IN 1 of W7XRP2 with a 0.252 divider 
-    abs_voltage = 0.0661+4.526*f
-    # 500 Torr/Volt
-    return 500*abs_voltage*TORR_TO_MBAR
-    
-    
-def diff_mbar(arr):
-    # Get parts of binary vals corresponding to diff measurement (last 14 digits)
-    arr = np.bitwise_and(arr, 0b11111111111111)
-    # Convert from unsigned to signed integers
-    arr = twos_complement(arr, 14)
-    # Convert to float
-    f = 2/(2**14-1)*arr
-    # Calibration for IN 2 of W7XRP2 with a 0.342 divider
-    diff_voltage = 0.047+3.329*f
-    # 10 Torr/Volt
-    return 10*diff_voltage*TORR_TO_MBAR
-    
-    
 def find_nearest(array, value):
     '''
     Find index of first value in an ORDERED array closest to given value.
@@ -91,6 +98,8 @@ class RPServer:
         self.targetPressure = None
         self.pumpoutRefill = False
         self.gotFirstQueue = False
+        # Times reads of the RP queue by how many samples each read finds
+        self.acquisitionPacer = AcquisitionPacer(PRESSURE_HZ, RP_QUEUE_SIZE, lead=BLOCKING_READ_LEAD if BLOCKING_READ_WAIT else 0)
         logging.basicConfig(filename=LOG_FILE, format='%(message)s', level=logging.DEBUG)
         
         # Arrays to store a downsampled version of the pressure readings
@@ -99,35 +108,98 @@ class RPServer:
         # Queue of (time to execute, function, args) objects like threading.Timer does. We want to 
         # avoid threading for Koheron interactions because of potential bugs
         self.taskQueue = []
-        # Queue of strings to send to GUI for logging
-        self.messageQueue = []
+        # Queue of [level, message] pairs to send to GUI for logging, bounded in case no GUI is
+        # connected to collect them
+        self.messageQueue = collections.deque(maxlen=LOG_HISTORY)
+        # Recent [level, message] pairs for clients that want more than the GUI shows
+        self.logHistory = collections.deque(maxlen=LOG_HISTORY)
+        # Log messages and downsampled points not yet pushed to status stream subscribers
+        self.streamMessages = []
+        self.streamPoints = []
+        # (text, level) log messages from other threads, logged by the main loop (see queueLog)
+        self.threadLog = queue.Queue()
         # Pressure probe data. Will be (N,3)-shaped numpy array with columns (t, pAbsolute, pDiff)
         self.pressures = None
+        # Updated with every batch of absolute gauge readings, read by the pump/fill control
+        self.pressureEstimator = PressureEstimator(PRESSURE_HZ)
+        # Learns valve lags and V5 pulse size from the valve timeline and the pressure
+        self.valveController = ValveController()
         # Keep track of server health
         self.mainloopTimes = []
         # Variables to record times to return appropriate data to GUI post-puff
+        self.lastT0 = None
         self.lastT1 = None
         self.lastTdone = None
-        # Variable used to store time and pressure data from the latest shot
-        self.lastShotData = None
+        # handleT0 parameters, fill pressure, log messages and valve/shutter actions of the current
+        # shot, saved with its pressure data (lists are None outside of a shot)
+        self.shotParams = None
+        self.shotFillPressure = None
+        self.shotEvents = None
+        self.shotValves = None
+        # Wall time the board sequencer was armed and the (name, command) of each of its register writes
+        self.sequenceArmed = None
+        self.sequenceEvents = []
+        # Raw data of the shot in progress, and records of the latest shots for clients to fetch
+        self.shotCapture = None
+        self.recentShots = collections.deque(maxlen=RECENT_SHOTS)
+        self.shotPersister = ShotPersister(SHOT_FOLDER, self.queueLog)
+        # Background writer that archives every raw pressure word to disk
+        self.recorder = SegmentRecorder(RECORD_FOLDER, RECORD_RETENTION, PRESSURE_HZ, log=self.queueLog) if RECORD_RAW else None
+        self.recordingReader = RecordingReader(RECORD_FOLDER, PRESSURE_HZ) if RECORD_RAW else None
         
         # Create new xmlrpc server and register RPServer with it to expose RPServer functions
         address = ('0.0.0.0', 50000)
         self.RPCServer = xmlrpc.server.SimpleXMLRPCServer(address, allow_none=True, logRequests=False)
+        # Raw words for readers on this computer, without going through XML-RPC. Created once the
+        # port is bound, since the writer replaces any segment of the same name and a second server
+        # started by mistake must fail before it takes the running server's ring
+        self.sharedRing = SharedRingWriter(SHARED_RING_SECONDS*PRESSURE_HZ, PRESSURE_HZ) if SHARED_RING else None
         self.RPCServer.register_instance(self)
         # This timeout is how long handle_request() blocks the main thread even when there are no requests
         self.RPCServer.timeout = .001
+        # Status stream for GUIs and monitoring scripts and the browser dashboard, see publishStatus
+        self.statusPublishers = [StatusPublisher(STREAM_PORT)]
+        if DASHBOARD_PORT is not None:
+            self.statusPublishers.append(DashboardServer(DASHBOARD_PORT))
         
+        # Safety lane command waiting for the main loop to finish it, see handleSafetyCommand
+        self.safetyRequest = None
+        # Held by the safety lane for its register writes and by the main loop to replace
+        # self.RPKoheron, so the lane always writes through the current connection
+        self.rpLock = threading.Lock()
+        # The safety lane thread and the main loop share this connection: the client holds its
+        # lock for each command until the response has been read
         rpConnection = koheron.connect(RP_HOSTNAME, name='GPI_RP')
         self.RPKoheron = GPI_RP(rpConnection)
+        # Further boards, each acquired and polled by its own worker thread
+        self.boards = {}
+        if not SIMULATE_RP:
+            for name, host in BOARDS.items():
+                self.boards[name] = Board(name, lambda host=host: GPI_RP(koheron.connect(host, name='GPI_RP')), PRESSURE_HZ, READING_HISTORY, self.queueLog)
         
         self.addToLog('Server setting default state')
         self.setDefault()
+        self.safetyLane = SafetyLane(SAFETY_PORT, self.handleSafetyCommand)
         
         if ANNOUNCE_HEALTH:
             self.addTask(10, self.announceServerHealth, [])
         
-        self.mainloop()
+        try:
+            self.mainloop()
+        finally:
+            self.close()
+        
+    def close(self):
+        '''
+        Release the XML-RPC port and the shared memory ring and write out the raw data still queued
+        when the main loop exits (e.g. on Ctrl+C).
+        '''
+        self.RPCServer.server_close()
+        if self.sharedRing:
+            self.sharedRing.close()
+            self.sharedRing = None
+        if self.recorder:
+            self.recorder.close()
         
     def mainloop(self):
         last_control = time.time()
@@ -135,17 +207,23 @@ class RPServer:
         while True:
             now = time.time()
             
-            if now - last_control > CONTROL_INTERVAL:
-                last_control =  now
-                
-                # Get data on slower timescale now that it's queue-based
+            if self.safetyRequest:
+                self.finishSafetyRequest()
+            
+            # Get data when enough has queued up on the RP, see acquisitionTarget
+            if self.acquisitionPacer.due(now):
                 if SIMULATE_RP:
                     self.getFakePressureData()
                 else:
                     self.getPressureData()
+            
+            if now - last_control > CONTROL_INTERVAL:
+                last_control =  now
                 
                 # Execute remote commands if any have been received
                 self.RPCServer.handle_request()
+                
+                self.publishStatus()
                     
             # Do any required tasks in task queue
             self.handleTasks()
@@ -160,7 +238,12 @@ class RPServer:
         '''
         Carry out any tasks that are up for execution in the task queue. Any tasks added to the task queue while this method is running will be executed at the very earliest on the next call to handleTasks.
         '''
+        while not self.threadLog.empty():
+            self.addToLog(*self.threadLog.get_nowait())
         for execTime, function, args in self.taskQueue.copy():
+            # Tasks are dropped by finishSafetyRequest after a safety command
+            if self.safetyRequest:
+                return
             if execTime < time.time():
                 function(*args)
                 self.taskQueue.remove((execTime, function, args))
@@ -174,26 +257,115 @@ class RPServer:
     def clearTasks(self):
         self.taskQueue = []
         
-    def addToLog(self, text):
+    def addToLog(self, text, level='info'):
+        '''
+        Args:
+            text: (string) message
+            level: (string) one of LOG_LEVELS
+        '''
         time_string = datetime.datetime.now().strftime('%H:%M:%S.%f')[:-3]
         message = 'MS ' + time_string + ' ' + text
-        self.messageQueue.append(message)
-        logging.info(message)
+        self.messageQueue.append([level, message])
+        self.logHistory.append([level, message])
+        self.streamMessages.append([level, message])
+        if self.shotEvents is not None:
+            self.shotEvents.append(message)
+        logging.log(getattr(logging, level.upper()), message)
         print(message)
+        
+    def queueLog(self, text, level='info'):
+        '''
+        addToLog for other threads: the message is logged from the main loop by handleTasks, since
+        the log queues and shot records are only changed there.
+        '''
+        self.threadLog.put((text, level))
+        
+    def getLogHistory(self, level='debug', search=''):
+        '''
+        Return the recent log messages at or above a level that contain a search string.
+        
+        Args:
+            level: (string) minimum level, one of LOG_LEVELS
+            search: (string) case-insensitive text the messages must contain
+        Returns:
+            list of [level, message] pairs, oldest first
+        '''
+        minimum = LOG_LEVELS.index(level)
+        search = search.lower()
+        return [[l, m] for l, m in self.logHistory if LOG_LEVELS.index(l) >= minimum and search in m.lower()]
     
     def announceServerHealth(self):
         ml = np.array(self.mainloopTimes)*1000
-        self.addToLog('MS main loop: mean %.3g ms, std %.3g ms, min %.3g ms, max %.3g ms' % (ml.mean(), ml.std(), ml.min(), ml.max()))
+        self.addToLog('MS main loop: mean %.3g ms, std %.3g ms, min %.3g ms, max %.3g ms' % (ml.mean(), ml.std(), ml.min(), ml.max()), 'debug')
+        if self.recorder:
+            self.addToLog('MS recorder: %d samples written, %d batches dropped, %d failed to write' % (self.recorder.recordedSamples, self.recorder.droppedBatches, self.recorder.failedBatches), 'debug')
+        reads, samples, roundTrip, maxRoundTrip = self.acquisitionPacer.stats()
+        self.addToLog('MS acquisition: %d reads, %.4g samples per read, every %.3g ms, round trip mean %.3g ms, max %.3g ms' % (reads, samples, self.acquisitionPacer.interval*1000, roundTrip, maxRoundTrip), 'debug')
+        if self.safetyLane.latencies:
+            sl = np.array(self.safetyLane.latencies)
+            self.addToLog('MS safety lane: %d commands, mean %.3g ms, max %.3g ms to reset valves' % (len(sl), sl.mean(), sl.max()), 'debug')
+        for board in self.boards.values():
+            self.addToLog('MS board %s: %d reads, %d samples%s' % (board.name, board.reads, board.count, ', ' + board.error if board.error else ''), 'debug')
         self.mainloopTimes = []
         self.addTask(10, self.announceServerHealth, [])
             
     def setState(self, state):
         self.addToLog('Setting middle server state = ' + state)
         self.state = state
+            
+    def handleSafetyCommand(self, command):
+        '''
+        Called from the safety lane thread. Writes the default valve, shutter and permission
+        settings immediately, between two Koheron commands of the main loop, then leaves logging,
+        clearing tasks and state to the main loop (finishSafetyRequest), which checks for it
+        before anything else it does.
+        
+        Args:
+            command: (string) 'interrupt' (same as the GUI's cancel button) or 'safe_state' (the
+                same, for scripts)
+        '''
+        if command not in ['interrupt', 'safe_state']:
+            raise ValueError('Unknown safety command %s' % command)
+        received = time.time()
+        try:
+            with self.rpLock:
+                driver = self.RPKoheron
+                # Holding the client lock for the whole sequence keeps main loop commands from interleaving
+                with driver.client.lock:
+                    self.writeDefaultState(driver)
+        finally:
+            # Even if the writes failed (e.g. a broken connection), the main loop sets the default
+            # state again, through a new connection if need be
+            self.safetyRequest = (command, received)
+        
+    def writeDefaultState(self, driver):
+        '''
+        The register writes of setDefault, without its logging and shot records, so they can be
+        made from the safety lane thread.
+        '''
+        if BOARD_SEQUENCER:
+            self.cancelSequence(driver)
+        write_valve(driver, 'V3', 'open')
+        for valve in ['V4', 'V5', 'V7', 'FV2']:
+            write_valve(driver, valve, 'close')
+        driver.set_analog_out(0)
+        for puffnum in [1, 2, 3, 4]:
+            getattr(driver, 'set_fast_permission_%d' % puffnum)(0)
+        driver.send_T1(0)
+        
+    def finishSafetyRequest(self):
+        command, received = self.safetyRequest
+        self.safetyRequest = None
+        self.addToLog('Safety lane %s: valves reset, %.3g ms until main loop took over' % (command, (time.time()-received)*1000), 'warning')
+        # Also closes anything a task that was already running may have opened after the safety lane
+        self.interrupt()
         
     def interrupt(self):
         self.clearTasks()
-        self.addToLog('Manual interrupt received')
+        # Keep whatever has been captured of an interrupted shot
+        if self.shotCapture is not None:
+            self.finishShot()
+        self.addToLog('Manual interrupt received', 'warning')
         self.setState('idle')
         self.setDefault()
             
@@ -201,6 +373,8 @@ class RPServer:
         pass
         
     def setDefault(self):
+        if BOARD_SEQUENCER:
+            self.cancelSequence(self.RPKoheron)
         self.handleValve('V3', command='open')
         self.handleValve('V4', command='close')
         self.handleValve('V5', command='close')
@@ -212,6 +386,13 @@ class RPServer:
         self.RPKoheron.send_T1(0)
         self.addToLog('Finished setting default state')
         
+    def cancelSequence(self, driver):
+        try:
+            driver.cancel_sequence()
+        except KeyError:
+            # Instrument built without the sequencer, so there is nothing to cancel
+            pass
+        
     def disarm(self):
         pass
     
@@ -228,7 +409,7 @@ class RPServer:
         '''
         Return average pressure over the last 0.1 seconds.
         '''
-        return np.mean(self.pressures[-1000:,1])
+        return self.pressureEstimator.windowMean()
         
     def lowerPressure(self, desiredPressure, fillPressure):
         '''
@@ -238,7 +419,8 @@ class RPServer:
             desiredPressure: (mbar) exhaust and/or pump down to this pressure
             fillPressure: (mbar) if not None, fill to this pressure after pumping out
         '''
-        currentPressure = self.currentPressure()
+        # Filtered pressure extrapolated to now, which lags less than the window mean while pumping
+        currentPressure = self.pressureEstimator.pressure(time.time())
         if self.state == 'exhaust':
             if desiredPressure < currentPressure > MECH_PUMP_LIMIT:
                 if self.getValveStatus('V7') == 'close':
@@ -256,30 +438,108 @@ class RPServer:
                 self.addToLog('Exhaust to %.4g mbar complete (%.4g mbar), pumping was not necessary' % (desiredPressure, currentPressure))
                 self.setState('idle')
         elif self.state == 'pumping out':
-            if currentPressure > desiredPressure:
-                if self.getValveStatus('V4') == 'close':
-                    self.handleValve('V4', command='open')
+            rate = self.pressureEstimator.rate()
+            if self.getValveStatus('V4') == 'close' and currentPressure > desiredPressure:
+                self.handleValve('V4', command='open')
+                self.addTask(0, self.lowerPressure, [desiredPressure, fillPressure])
+            elif self.getValveStatus('V4') == 'open' and not self.valveController.shouldClose('V4', currentPressure, rate, desiredPressure, rising=False):
                 self.addTask(0, self.lowerPressure, [desiredPressure, fillPressure])
             else:
+                # Closed early enough for the pressure to settle at the desired pressure
                 self.handleValve('V4', command='close')
+                self.valveController.valveClosed('V4', time.time(), currentPressure, rate)
                 self.addToLog('Pump out to %.4g mbar complete (%.4g mbar)' % (desiredPressure, currentPressure))
                 self.setState('idle')
                 if fillPressure is not None:
                     self.setState('filling')
                     self.addTask(0, self.raisePressure, [fillPressure])
+                else:
+                    self.addTask(SETTLE_TIME, self.learnValveLag, [])
             
     def raisePressure(self, desiredPressure):
-        currentPressure = self.currentPressure()
-        if self.state == 'filling':
-            if currentPressure < desiredPressure - FILL_MARGIN:
-                if self.getValveStatus('V5') == 'close':
-                    self.addToLog('Beginning fill')
-                    self.handleValve('V5', command='open')
-                self.addTask(0, self.raisePressure, [desiredPressure])
-            else:
-                self.handleValve('V5', command='close')
-                self.addToLog('Fill to %.4g mbar complete (%.4g mbar)' % (desiredPressure, currentPressure))
+        '''
+        Fill with V5 open until closing it is predicted to leave the pressure on desiredPressure,
+        then let finishFill check the settled pressure. Small deficits are filled with V5 pulses.
+        '''
+        if self.state != 'filling':
+            return
+        now = time.time()
+        currentPressure = self.pressureEstimator.pressure(now)
+        rate = self.pressureEstimator.rate()
+        if self.getValveStatus('V5') == 'close':
+            deficit = desiredPressure - currentPressure
+            if deficit <= FILL_TOLERANCE:
+                self.addToLog('Fill to %.4g mbar complete (%.4g mbar), filling was not necessary' % (desiredPressure, currentPressure))
                 self.setState('idle')
+            elif deficit <= PULSE_RANGE and self.valveController.pulseDuration(deficit) is not None:
+                self.pulseFill(desiredPressure, currentPressure, 0)
+            else:
+                self.addToLog('Beginning fill')
+                self.handleValve('V5', command='open')
+                self.addTask(0, self.raisePressure, [desiredPressure])
+        elif self.valveController.shouldClose('V5', currentPressure, rate, self.fillTarget(desiredPressure), rising=True):
+            self.handleValve('V5', command='close')
+            self.valveController.valveClosed('V5', now, currentPressure, rate)
+            self.addTask(SETTLE_TIME, self.finishFill, [desiredPressure, 0, None, None])
+        else:
+            self.addTask(0, self.raisePressure, [desiredPressure])
+            
+    def fillTarget(self, desiredPressure):
+        '''
+        Pressure a continuous fill aims for: FILL_MARGIN short of desiredPressure until the V5 lag
+        has been learned, since V5 pulses can top up an undershoot but nothing corrects an overshoot.
+        '''
+        if self.valveController.lagLearned('V5'):
+            return desiredPressure
+        return desiredPressure - FILL_MARGIN
+        
+    def finishFill(self, desiredPressure, pulses, pulseStart, pulseDuration):
+        '''
+        Learn from the settled pressure after V5 closed, then top up with another V5 pulse if the
+        pressure is still more than FILL_TOLERANCE short of desiredPressure.
+        
+        Args:
+            desiredPressure: (mbar)
+            pulses: (int) number of V5 pulses so far
+            pulseStart: (mbar) settled pressure before the last pulse, None after a continuous fill
+            pulseDuration: (seconds) length of the last pulse, None after a continuous fill
+        '''
+        if self.state != 'filling':
+            return
+        settled = self.currentPressure()
+        if pulseStart is None:
+            self.valveController.learnLag(settled)
+            self.valveController.learnFill(settled)
+        else:
+            self.valveController.learnPulse(settled - pulseStart, pulseDuration)
+        deficit = desiredPressure - settled
+        if deficit > FILL_TOLERANCE and pulses < MAX_FILL_PULSES and self.valveController.pulseDuration(deficit) is not None:
+            self.pulseFill(desiredPressure, settled, pulses)
+            return
+        level = 'info' if abs(deficit) <= FILL_TOLERANCE else 'warning'
+        self.addToLog('Fill to %.4g mbar complete (%.4g mbar, %d V5 pulses)' % (desiredPressure, settled, pulses), level)
+        self.addToLog('Learned V5 lag %.3g s, V4 lag %.3g s, pulse efficiency %.2g' % (self.valveController.lag('V5'), self.valveController.lag('V4'), self.valveController.pulseEfficiency), 'debug')
+        self.setState('idle')
+        
+    def pulseFill(self, desiredPressure, settled, pulses):
+        '''
+        Open V5 for as long as the learned fill rate says is needed to reach desiredPressure.
+        '''
+        duration = self.valveController.pulseDuration(desiredPressure - settled)
+        self.addToLog('Topping up %.2g mbar with a %.3g s V5 pulse' % (desiredPressure - settled, duration))
+        self.handleValve('V5', command='open')
+        self.addTask(duration, self.endFillPulse, [desiredPressure, pulses + 1, settled, duration])
+        
+    def endFillPulse(self, desiredPressure, pulses, pulseStart, pulseDuration):
+        self.handleValve('V5', command='close')
+        self.addTask(SETTLE_TIME, self.finishFill, [desiredPressure, pulses, pulseStart, pulseDuration])
+        
+    def learnValveLag(self):
+        '''
+        Learn from the settled pressure after a pump out that was not followed by a fill.
+        '''
+        if self.state == 'idle':
+            self.valveController.learnLag(self.currentPressure())
             
     def changePressure(self, desiredPressure, pumpOut, exhaust):
         '''
@@ -291,7 +551,7 @@ class RPServer:
             exhaust: (bool) whether to exhaust when pressure is > 1026 mbar
         '''
         if desiredPressure < PUMPED_OUT or desiredPressure > MAX_FILL:
-            self.addToLog('User requested an invalid pressure')
+            self.addToLog('User requested an invalid pressure', 'warning')
             return
         # Proceed with raising/lowering the pressure
         # Open V3 so that the absolute pressure gauge will be able to read
@@ -323,6 +583,7 @@ class RPServer:
             pNewTimes = np.arange(-len(pAbs)+1, 1)*delta+now
             newData = np.column_stack((pNewTimes, pAbs, pDiff))
             self.pressures = newData
+            self.pressureEstimator.update(newData[:,1], now)
             self.lastFakeDataTime = now
         else:
             # Continue creaking fake data
@@ -341,8 +602,11 @@ class RPServer:
             pNewTimes = np.arange(-len(pAbs)+1, 1)*delta+now
             newData = np.column_stack((pNewTimes, pAbs, pDiff))
             self.pressures = np.vstack((self.pressures, newData))
+            self.pressureEstimator.update(newData[:,1], now)
             self.lastFakeDataTime = now
-               
+        
+        self.acquisitionPacer.update(len(newData), now, now, self.acquisitionTarget())
+        self.storeRawData(words_from_mbar(newData[:,1], newData[:,2]), now)
         self.downsamplePressureData(now, newData)
         self.prunePressureData(now)
         
@@ -353,18 +617,28 @@ class RPServer:
         try:
             # Get data from RP
             # This may raise an exception due to network timeout
-            combined_pressure_history = self.RPKoheron.get_GPI_data()
+            target = self.acquisitionTarget()
+            if BLOCKING_READ_WAIT:
+                # Sent a little early, the RP replies as soon as target samples are queued
+                combined_pressure_history = self.RPKoheron.get_GPI_data_blocking(target, int(BLOCKING_READ_WAIT*1000))
+            else:
+                combined_pressure_history = self.RPKoheron.get_GPI_data()
+            # The newest sample is from when the RP replied, not from when the read was sent
+            sent, now = now, time.time()
+            queueFull = self.acquisitionPacer.update(len(combined_pressure_history), sent, now, target)
             # Show warning if the RP data queue is full, which means some data has been lost
-            if len(combined_pressure_history) == 50000:
+            if queueFull:
                 # Show this message except during program startup, when the FPGA queue is normally full
                 if self.gotFirstQueue:
-                    self.addToLog('Lost some data due to network lag')
+                    self.addToLog('Lost some data due to network lag', 'warning')
                 else:
                     self.gotFirstQueue = True
+            self.storeRawData(combined_pressure_history, now)
                     
             # Add fast readings
             pAbs = abs_mbar(combined_pressure_history)
             pDiff = diff_mbar(combined_pressure_history)
+            self.pressureEstimator.update(pAbs, now)
             pNewTimes = np.arange(-len(pAbs)+1, 1)*delta+now
             newData = np.column_stack((pNewTimes, pAbs, pDiff))
             if self.pressures is None:
@@ -375,15 +649,42 @@ class RPServer:
             self.pressures[:,0] = pTimes
         except Exception as e:
             # Log disconnection and attempt to reconnect
-            self.addToLog(str(e))
-            self.addToLog('Get pressure data failed. Attempting to reconnect to RP...')
+            self.addToLog(str(e), 'error')
+            self.addToLog('Get pressure data failed. Attempting to reconnect to RP...', 'error')
+            self.acquisitionPacer.nextRead = now + CONTROL_INTERVAL
             rpConnection = koheron.connect(RP_HOSTNAME, name='GPI_RP')
-            self.RPKoheron = GPI_RP(rpConnection)
+            with self.rpLock:
+                self.RPKoheron = GPI_RP(rpConnection)
         
         if newData is not None:
             self.downsamplePressureData(now, newData)
         self.prunePressureData(now)
         
+    def acquisitionTarget(self):
+        '''
+        Number of samples the next read of the RP queue should find: fewer while pump/fill control
+        or a shot needs fresh data, more while idle to save round trips.
+        '''
+        return ACQUISITION_TARGET_IDLE if self.state == 'idle' else ACQUISITION_TARGET
+        
+    def storeRawData(self, words, now):
+        '''
+        Pass newly acquired raw words to the recorder, the shared memory ring and, during a shot, to
+        the shot capture buffer.
+        
+        Args:
+            words: (NumPy uint32 array) raw words in acquisition order
+            now: (float) wall time of the last word
+        '''
+        if self.recorder:
+            self.recorder.record(words, now)
+        if self.sharedRing:
+            self.sharedRing.write(words, now)
+        if self.shotCapture is not None:
+            self.shotCapture.add(words, now)
+            if self.shotCapture.isComplete():
+                self.finishShot()
+        
     def downsamplePressureData(self, now, newData):
         delta = 1/PRESSURE_HZ
         if self.downsamplingQueue is None:
@@ -394,18 +695,47 @@ class RPServer:
             for i in range(len(self.downsamplingQueue)//DOWNSAMPLE_N):
                 latestDownsampledMean = self.downsamplingQueue[i*DOWNSAMPLE_N:(i+1)*DOWNSAMPLE_N].mean(axis=0)
                 self.pressuresDownsampled.append(latestDownsampledMean.tolist())
+                self.streamPoints.append(latestDownsampledMean.tolist())
             # Remove processed readings from the downsampling queue
             self.downsamplingQueue = self.downsamplingQueue[(i+1)*DOWNSAMPLE_N:]
             
     def prunePressureData(self, now):
-        if self.state != 'shot': 
-            # Remove fast readings older than READING_HISTORY seconds
-            range_start = find_nearest(self.pressures[:,0]-now, -READING_HISTORY)
-            self.pressures = self.pressures[range_start:]
-            # Prune old downsampled readings
+        # Remove fast readings older than READING_HISTORY seconds. Shot data is kept in self.shotCapture
+        range_start = find_nearest(self.pressures[:,0]-now, -READING_HISTORY)
+        self.pressures = self.pressures[range_start:]
+        # Prune old downsampled readings (none until the first DOWNSAMPLE_N readings have arrived)
+        if len(self.pressuresDownsampled):
             range_start = find_nearest(np.array(self.pressuresDownsampled)[:,0]-now, -READING_HISTORY)
             self.pressuresDownsampled = self.pressuresDownsampled[range_start:]
         
+    def getPressures(self, t0, t1, max_points=None):
+        '''
+        Return pressure readings between wall times t0 and t1, from the in-memory history if it
+        covers t0 and from the raw data recording otherwise. Live plots ask for the latest readings
+        every cycle, which the in-memory history serves without touching the disk.
+        
+        Args:
+            t0, t1: (float) start and end of the time range in seconds since the epoch
+            max_points: (int) if the range holds more samples than this, reduce it with a min/max
+                envelope so that short spikes are kept (capped at MAX_QUERY_POINTS)
+        Returns:
+            dict with lists 't', 'abs' and 'diff' (mbar)
+        '''
+        if max_points is None or max_points > MAX_QUERY_POINTS:
+            max_points = MAX_QUERY_POINTS
+        inMemory = self.pressures is not None and len(self.pressures) and self.pressures[0,0] <= t0
+        if self.recordingReader is not None and not inMemory:
+            self.recordingReader.refresh()
+            t, pAbs, pDiff = self.recordingReader.pressures(t0, t1, max_points)
+        elif self.pressures is None:
+            return {'t': [], 'abs': [], 'diff': []}
+        else:
+            start = np.searchsorted(self.pressures[:,0], t0, side='left')
+            end = np.searchsorted(self.pressures[:,0], t1, side='right')
+            selected = self.pressures[start:end]
+            t, (pAbs, pDiff) = minmax_decimate(selected[:,0], [selected[:,1], selected[:,2]], max_points)
+        return {'t': t.tolist(), 'abs': pAbs.tolist(), 'diff': pDiff.tolist()}
+        
     def setShutter(self, state):
         if state == 'open':
             self.addToLog('OPENING shutter')
@@ -414,9 +744,11 @@ class RPServer:
             self.addToLog('CLOSING shutter')
             value = 0
         else:
-            self.addToLog('Bad shutter command')
+            self.addToLog('Bad shutter command', 'warning')
             return
         self.RPKoheron.set_analog_out(value)
+        if self.shotValves is not None:
+            self.shotValves.append([time.time(), 'shutter', state])
         
     def handleToggleShutter(self):
         currentSetting = self.RPKoheron.get_analog_out()
@@ -425,53 +757,97 @@ class RPServer:
         elif currentSetting == 1:
             self.setShutter('close')
         else:
-            self.addToLog('Shutter register has bad value')
+            self.addToLog('Shutter register has bad value', 'warning')
             
+    def getStatus(self):
+        '''
+        Read the valve, shutter and W7-X signal status from the RP.
+        '''
+        status = read_status(self.RPKoheron)
+        status['state'] = self.state
+        return status
+        
+    def getBoards(self):
+        '''
+        Names of the boards served, starting with BOARD_NAME, the board that runs fills and shots.
+        '''
+        return [BOARD_NAME] + list(self.boards)
+        
+    def getBoard(self, name):
+        if name not in self.boards:
+            raise ValueError('Unknown board %s' % name)
+        return self.boards[name]
+        
+    def getBoardStatus(self, board):
+        '''
+        Status of a board by name. Further boards answer from the status cache of their worker,
+        with 'status_age' (seconds), 'pressure' (mbar) and 'error' added.
+        '''
+        if board == BOARD_NAME:
+            return self.getStatus()
+        return self.getBoard(board).getStatus()
+        
+    def getBoardPressures(self, board, t0, t1, max_points=None):
+        '''
+        Pressure readings of a board by name, see getPressures. Further boards only keep the
+        last READING_HISTORY seconds.
+        '''
+        if board == BOARD_NAME:
+            return self.getPressures(t0, t1, max_points)
+        if max_points is None or max_points > MAX_QUERY_POINTS:
+            max_points = MAX_QUERY_POINTS
+        return self.getBoard(board).getPressures(t0, t1, max_points)
+        
+    def handleBoardValve(self, board, valve_name, command):
+        '''
+        Open or close a valve of a board by name, see handleValve.
+        '''
+        if board == BOARD_NAME:
+            return self.handleValve(valve_name, command)
+        if command not in ['open', 'close']:
+            raise ValueError('Bad valve command %s' % command)
+        self.addToLog('%s %s on board %s' % ('OPENING' if command == 'open' else 'CLOSING', valve_name, board))
+        self.getBoard(board).setValve(valve_name, command)
+        
     def getDataForGUI(self):
+        '''
+        Polling alternative to the status stream. Each call reads the hardware, so clients that
+        only watch should subscribe to STREAM_PORT instead.
+        '''
         # Copy and flush message queue
-        messageQueue = self.messageQueue
-        self.messageQueue = []
-        
-        return {'shutter_setting': self.getShutterSetting(),
-                'shutter_sensor': self.getShutterSensor(),
-                'V3': self.getValveStatus('V3'),
-                'V4': self.getValveStatus('V4'),
-                'V5': self.getValveStatus('V5'),
-                'V7': self.getValveStatus('V7'),
-                'FV2': self.getValveStatus('FV2'),
-                'pressures_history': self.pressuresDownsampled,
-                'messages': messageQueue,
-                'state': self.state,
-                'w7x_permission': str(self.RPKoheron.get_W7X_permission()),
-                't1': str(self.RPKoheron.get_W7X_T1())}
+        messageQueue = list(self.messageQueue)
+        self.messageQueue.clear()
+        
+        data = self.getStatus()
+        data['pressures_history'] = self.pressuresDownsampled
+        data['messages'] = messageQueue
+        return data
+        
+    def publishStatus(self):
+        '''
+        Push the status, new downsampled points and new log messages to status stream and dashboard
+        subscribers. The hardware is read once per tick no matter how many subscribers there are,
+        and not at all if there are none.
+        '''
+        messages, self.streamMessages = self.streamMessages, []
+        points, self.streamPoints = self.streamPoints, []
+        status = None
+        if any(publisher.hasSubscribers() for publisher in self.statusPublishers):
+            try:
+                status = self.getStatus()
+            except Exception as e:
+                print('RPServer.publishStatus', e)
+        for publisher in self.statusPublishers:
+            publisher.publish(status, points, messages)
             
     def getShutterSetting(self):
         return self.RPKoheron.get_analog_out()
             
     def getShutterSensor(self):
-        ai0 = self.RPKoheron.get_analog_input_0()
-        ai1 = self.RPKoheron.get_analog_input_1()
-        if ai0 < 9000 < ai1:
-            return 'closed'
-        elif ai0 > 9000 > ai1:
-            return 'open'
-        else:
-            return 'bad'
+        return read_shutter_sensor(self.RPKoheron)
         
     def getValveStatus(self, valveName):
-        if valveName == 'FV2':
-            statusInt = self.RPKoheron.get_fast_sts()
-        else:
-            valve_number = ['V5', 'V4', 'V3', 'V7'].index(valveName) + 1
-            statusInt = getattr(self.RPKoheron, 'get_slow_%s_sts' % valve_number)()
-        # V3 has opposite status logic 
-        if valveName == 'V3':
-            statusInt = int(not statusInt)
-        if statusInt == 1:
-            status = 'open'
-        else:
-            status = 'close'
-        return status
+        return read_valve(self.RPKoheron, valveName)
                 
     def handleValve(self, valve_name, command=None):
         """Open/close specified valve.
@@ -480,12 +856,6 @@ class RPServer:
             valve_name: (string) One of V5, V4, V3, V7
             command: (string) 'open'/'close' (default None will toggle)
         """
-        if valve_name == 'FV2':
-            setter_method = 'set_fast'
-        else:
-            valve_number = ['V5', 'V4', 'V3', 'V7'].index(valve_name) + 1
-            setter_method = 'set_slow_%s' % valve_number
-            
         # If command arg is not supplied, set to toggle state of valve
         if not command:
             current_status = self.getValveStatus(valve_name)
@@ -494,18 +864,17 @@ class RPServer:
             else:
                 command = 'close'
         if command == 'open':
-            signal = 1
             action_text = 'OPENING'
         elif command == 'close':
-            signal = 0
             action_text = 'CLOSING'
         self.addToLog(action_text + ' ' + valve_name)
-            
-        # V3 expects opposite signals
-        signal = int(not signal) if valve_name == 'V3' else signal
         
         # Send signal
-        getattr(self.RPKoheron, setter_method)(signal)
+        write_valve(self.RPKoheron, valve_name, command)
+        if command == 'open':
+            self.valveController.valveOpened(valve_name, time.time(), self.currentPressure())
+        if self.shotValves is not None:
+            self.shotValves.append([time.time(), valve_name, command])
             
     def setPermission(self, puff_number, value):
         """Output permission signal on pin required by black box for it to really open FV.
@@ -520,6 +889,78 @@ class RPServer:
         self.RPKoheron.send_T1(1)
         self.RPKoheron.send_T1(0)
         
+    def sequenceWrites(self, name, command):
+        '''
+        Control register writes that carry out one shot action on the board sequencer.
+        
+        Args:
+            name: (string) valve name, 'shutter' or 'T1'
+            command: (string) 'open'/'close', None for 'T1'
+        Returns:
+            list of (register name from GPI_RP.SEQUENCE_REGISTERS, value, seconds after the action)
+        '''
+        if name == 'T1':
+            return [('send_T1', 1, 0), ('send_T1', 0, T1_PULSE)]
+        signal = int(command == 'open')
+        if name == 'shutter':
+            return [('analog_out', signal, 0)]
+        if name == 'FV2':
+            return [('fast_manual', signal, 0)]
+        # V3 expects opposite signals
+        signal = int(not signal) if name == 'V3' else signal
+        valve_number = ['V5', 'V4', 'V3', 'V7'].index(name) + 1
+        return [('slow_%d_manual' % valve_number, signal, 0)]
+        
+    def scheduleShotActions(self, actions):
+        '''
+        Schedule the timing-critical actions of a shot. With BOARD_SEQUENCER they are sent to the
+        board as one timeline and run from its sequencer thread, otherwise they are server tasks.
+        
+        Args:
+            actions: list of (seconds from now, name, command), with name a valve name or 'shutter'
+                and command 'open'/'close', or name 'T1' and command None for a software T1
+        '''
+        self.sequenceArmed = None
+        if BOARD_SEQUENCER:
+            writes = []
+            for t, name, command in actions:
+                for i, (register, value, delay) in enumerate(self.sequenceWrites(name, command)):
+                    # Only the first write of an action is recorded as a shot event
+                    writes.append((max(t + delay, 0), register, value, (name, command) if i == 0 else None))
+            writes.sort(key=lambda write: write[0])
+            try:
+                armed = self.RPKoheron.set_sequence([(register, value, t) for t, register, value, _ in writes]) and self.RPKoheron.arm_sequence()
+            except Exception as e:
+                # e.g. KeyError from an instrument built without the sequencer
+                self.addToLog('Board sequencer failed (%s: %s)' % (type(e).__name__, e), 'error')
+                armed = False
+            if armed:
+                # Sequence times are relative to the board receiving arm_sequence, about half a round trip earlier
+                self.sequenceArmed = time.time()
+                self.sequenceEvents = [event for _, _, _, event in writes]
+                self.addToLog('Shot timeline armed on the board sequencer (%d register writes)' % len(writes))
+                return
+            self.addToLog('Board sequencer rejected the shot timeline, scheduling it as server tasks', 'warning')
+        for t, name, command in actions:
+            if name == 'T1':
+                self.addTask(t, self.sendT1toRP, [])
+            elif name == 'shutter':
+                self.addTask(t, self.setShutter, [command])
+            else:
+                self.addTask(t, self.handleValve, [name, command])
+                
+    def recordSequenceTimes(self):
+        '''
+        Add the board sequencer's actual action times to the shot's valve events and log its timing.
+        '''
+        times = self.RPKoheron.get_sequence_times()
+        for event, t in zip(self.sequenceEvents, times):
+            if event is not None and self.shotValves is not None:
+                self.shotValves.append([self.sequenceArmed + float(t)*1e-9, event[0], event[1]])
+        n, mean, std, worst = self.RPKoheron.get_sequence_jitter()
+        self.addToLog('Board sequencer ran %d of %d writes; lateness over %d writes: mean %.1f us, std %.1f us, max %.1f us'
+                      % (len(times), len(self.sequenceEvents), n, mean, std, worst))
+        
     def postShotActions(self):
         self.handleValve('V3', command='open')
         self.setState('idle')
@@ -527,16 +968,63 @@ class RPServer:
         self.setPermission(1, False)
         self.setPermission(2, False)
         
-        # Save shot data
-        start = find_nearest(self.pressures[:,0], self.lastT1)
-        end = find_nearest(self.pressures[:,0], self.lastTdone)
-        t = self.pressures[start:end,0].tolist()
-        da = self.pressures[start:end,1].tolist()
-        dp = self.pressures[start:end,2].tolist()
-        self.lastShotData = [self.lastT1, t, dp, da]
+    def finishShot(self):
+        '''
+        Turn the shot capture buffer into a shot record, keep it for clients and save it to
+        SHOT_FOLDER in the background.
+        '''
+        capture = self.shotCapture
+        self.shotCapture = None
+        shot = {'shot_id': capture.shotId,
+                'T0': self.lastT0,
+                'T1': self.lastT1,
+                't_start': capture.tStart if capture.tStart is not None else capture.t0,
+                'sample_rate': PRESSURE_HZ,
+                'words': capture.capturedWords(),
+                'calibration': CALIBRATION,
+                'params': self.shotParams,
+                'fill_pressure': self.shotFillPressure,
+                'events': self.shotEvents,
+                'valves': self.shotValves}
+        self.shotEvents = None
+        self.shotValves = None
+        self.recentShots.append(shot)
+        self.shotPersister.persist(shot)
+        self.addToLog('Captured shot %d (%.3g s of data)' % (capture.shotId, capture.fill/PRESSURE_HZ))
+        
+    def shotForClient(self, shot):
+        # XML-RPC needs the raw words as bytes
+        return dict(shot, words=xmlrpc.client.Binary(shot['words'].astype('<u4').tobytes()))
+        
+    def listShots(self):
+        '''
+        Return ids of the shots that can be fetched with getShot without reading the archive.
+        '''
+        return [shot['shot_id'] for shot in self.recentShots]
+        
+    def getShot(self, shot_id):
+        '''
+        Return the record of a shot, in the format stored by shot_archive.ShotArchive. Shots that are
+        no longer in memory are read back from SHOT_FOLDER. Returns None if the shot is unknown.
+        '''
+        for shot in self.recentShots:
+            if shot['shot_id'] == shot_id:
+                return self.shotForClient(shot)
+        archive = self.shotPersister.archive
+        if shot_id not in archive:
+            return None
+        shot = archive.load(shot_id)
+        for key in ['t', 'abs', 'diff', 'n_samples']:
+            shot.pop(key)
+        return self.shotForClient(shot)
         
     def getLastShotData(self):
-        return self.lastShotData
+        '''
+        Return the record of the latest shot, or None if no shot has been captured.
+        '''
+        if not self.recentShots:
+            return None
+        return self.shotForClient(self.recentShots[-1])
         
     def handleT0(self, p):
         valid_start_1 = p['puff_1_start'] is not None and p['puff_1_start'] >= 0
@@ -557,55 +1045,67 @@ class RPServer:
         quit = False
         if not puff_1_happening:
             if p['puff_1_start'] is None or p['puff_1_start'] < 0:
-                self.addToLog('Error: puff 1 has invalid start')
+                self.addToLog('Error: puff 1 has invalid start', 'error')
             if p['puff_1_duration'] is None or p['puff_1_duration'] <= 0 or p['puff_1_duration'] > MAX_PUFF_DURATION:
-                self.addToLog('Error: puff 1 has invalid duration')    
+                self.addToLog('Error: puff 1 has invalid duration', 'error')    
             if not p['puff_1_permission']:
-                self.addToLog('Error: puff 1 must be used')
+                self.addToLog('Error: puff 1 must be used', 'error')
             quit = True
         for puffnum in [2, 3, 4]:
             if p['puff_%d_permission' % puffnum] and not locals()['puff_%d_happening' % puffnum]:
                 if p['puff_%d_start' % puffnum] is None or p['puff_%d_start' % puffnum] < 0:
-                    self.addToLog('Error: puff %d has invalid start' % puffnum)
+                    self.addToLog('Error: puff %d has invalid start' % puffnum, 'error')
                 if p['puff_%d_duration' % puffnum] is None or p['puff_%d_duration' % puffnum] <= 0 or p['puff_%d_duration' % puffnum] > MAX_PUFF_DURATION:
-                    self.addToLog('Error: puff %d has invalid duration' % puffnum)    
+                    self.addToLog('Error: puff %d has invalid duration' % puffnum, 'error')    
                 quit = True
         # Puff 1 should not bleed into puff 2
         if puff_1_happening and puff_2_happening:
             if not p['puff_1_start'] + p['puff_1_duration'] < p['puff_2_start']:
-                self.addToLog('Error: puff 1 and puff 2 would overlap')
+                self.addToLog('Error: puff 1 and puff 2 would overlap', 'error')
                 quit = True
         # Puff 2 should not bleed into puff 3
         if puff_2_happening and puff_3_happening:
             if not p['puff_2_start'] + p['puff_2_duration'] < p['puff_3_start']:
-                self.addToLog('Error: puff 2 and puff 3 would overlap')
+                self.addToLog('Error: puff 2 and puff 3 would overlap', 'error')
                 quit = True
         # Puff 3 should not bleed into puff 4
         if puff_3_happening and puff_4_happening:
             if not p['puff_3_start'] + p['puff_3_duration'] < p['puff_4_start']:
-                self.addToLog('Error: puff 3 and puff 4 would overlap')
+                self.addToLog('Error: puff 3 and puff 4 would overlap', 'error')
                 quit = True
         # TODO: also quit when e.g. only puffs 1 and 4 are enabled
         if quit:
             return 0
+        
+        # A T0 before the last shot's capture is complete: save what it has before this shot's
+        # parameters replace the last shot's
+        if self.shotCapture is not None:
+            self.addToLog('T0 arrived before shot %d was captured in full, saving its data so far' % self.shotCapture.shotId, 'warning')
+            self.finishShot()
             
         # Set permission signal required by black box
         for puffnum in [1, 2, 3, 4]:
             self.setPermission(puffnum, locals()['puff_%d_happening' % puffnum])
         
+        self.shotParams = p
+        self.shotFillPressure = float(self.currentPressure())
+        self.shotEvents = []
+        self.shotValves = []
+        self.lastT0 = time.time()
         self.setState('shot')
         self.addToLog('---T0---')
-        self.addTask(pretrigger - 1 + p['puff_1_start'], self.handleValve, ['V3', 'close'])
+        # Timing-critical actions, see scheduleShotActions
+        shotActions = [(pretrigger - 1 + p['puff_1_start'], 'V3', 'close')]
         if p['software_t1']:
             self.addTask(pretrigger, self.addToLog, args=['Sending software T1'])
-            self.addTask(pretrigger, self.sendT1toRP, [])
+            shotActions.append((pretrigger, 'T1', None))
         else:
             self.addTask(pretrigger, self.addToLog, args=['Hardware T1 should happen now'])
         
         # Calculate when puffs will be done to queue post-shot actions
         if puff_1_happening: # never False
             puff_1_done = p['puff_1_start'] + p['puff_1_duration']
-            self.addTask(pretrigger+p['puff_1_start']-p['shutter_change_duration'], self.setShutter, ['open'])
+            shotActions.append((pretrigger+p['puff_1_start']-p['shutter_change_duration'], 'shutter', 'open'))
         else:
             puff_1_done = 0
         if puff_2_happening:
@@ -622,12 +1122,16 @@ class RPServer:
             puff_4_done = 0
         allPuffsDone = max(puff_1_done, puff_2_done, puff_3_done, puff_4_done)
         # Close shutter after all puffs are done
-        self.addTask(pretrigger+allPuffsDone+1, self.setShutter, ['close'])
+        shotActions.append((pretrigger+allPuffsDone+1, 'shutter', 'close'))
         # Close shutter in between puffs if they're far apart (TODO: also handle puffs 3 and 4)
         if puff_1_happening and puff_2_happening:
             if p['puff_2_start'] - puff_1_done > 2*p['shutter_change_duration'] + 3:
-                self.addTask(pretrigger+puff_1_done+1, self.setShutter, ['close'])
-                self.addTask(pretrigger+p['puff_2_start']-p['shutter_change_duration'], self.setShutter, ['open'])
+                shotActions.append((pretrigger+puff_1_done+1, 'shutter', 'close'))
+                shotActions.append((pretrigger+p['puff_2_start']-p['shutter_change_duration'], 'shutter', 'open'))
+        self.scheduleShotActions(shotActions)
+        if BOARD_SEQUENCER and self.sequenceArmed is not None:
+            # After the last action (shutter close), before the shot capture is finished
+            self.addTask(pretrigger + allPuffsDone + 1.5, self.recordSequenceTimes, [])
         # Open V3, set state 'idle', and save pressure data after all puffs are done
         self.addTask(pretrigger + allPuffsDone + 2, self.postShotActions, [])
         # Reset puff countup timer after all puffs done (not sure this is working)
@@ -635,6 +1139,8 @@ class RPServer:
         # Variables to record times to return appropriate data to GUI post-puff
         self.lastT1 = time.time()+pretrigger
         self.lastTdone = self.lastT1+allPuffsDone+2
+        # Capture raw data from T0 until all puffs are done in a buffer sized for this schedule
+        self.shotCapture = ShotCapture(int(self.lastT1), self.lastT0, self.lastTdone, PRESSURE_HZ)
         
         # Send fast puff timing info to FPGA
         for puffnum in [1, 2, 3, 4]:
@@ -1,30 +1,56 @@
 import sys
-import matplotlib.pyplot as plt
 import numpy as np
-from scipy.interpolate import interp1d
-from scipy.misc import derivative
-from scipy.signal import medfilt
-
-
-PLENUM_VOLUME = 0.802 # L 
-
-datafile = sys.argv[1]
-t, dp = np.load(datafile)
-
-plt.figure()
-plt.suptitle(datafile.split('.npy')[0])
-plt.subplot(211)
-pressures = medfilt(dp, 11)
-plt.plot(t, dp)
-plt.ylabel('Diff. pressure [mbar]')
-plt.subplot(212)
-f = interp1d(t, dp, kind='linear')
-newtimes = np.arange(t[0], t[-1], 0.0005)
-dp_coarse = [PLENUM_VOLUME*derivative(f, ti, dx=.02) for ti in newtimes[100:-100]]
-dp_fine = [PLENUM_VOLUME*derivative(f, ti, dx=.005) for ti in newtimes[100:-100]]
-plt.plot(newtimes[100:-100], medfilt(dp_fine,11))
-plt.plot(newtimes[100:-100], medfilt(dp_coarse,11))
-plt.xlabel('t-T1 [s]')
-plt.ylabel('Flow rate [mbar-L/sec]')
-plt.savefig(datafile.split('.npy')[0] + '.png', dpi=300)
-plt.show()
+from shot_archive import ShotArchive
+from analysis import analyze_shot, flow_rate
+
+
+def load_shot(args):
+    '''
+    Return (name, t, dp) for the command line arguments: archive_folder shot_id, or
+    diff_pressure_<T1>.npy for old files.
+    '''
+    if len(args) > 1:
+        shot = ShotArchive(args[0]).load(args[1])
+        return '%s/shot_%d' % (args[0], shot['shot_id']), shot['t'], shot['diff']
+    t, dp = np.load(args[0])
+    return args[0].split('.npy')[0], t, dp
+
+
+def print_result(result):
+    for i, ((start, stop), gas) in enumerate(zip(result['puffs'], result['puff_gas'])):
+        print('Puff %d: %.4f s to %.4f s, %.4g mbar-L' % (i+1, start, stop, gas))
+    print('Total injected gas: %.4g mbar-L' % result['injected_gas'])
+
+
+def draw_shot(fig, name, t, dp, result):
+    '''
+    Draw pressure and flow rate of a shot on fig, reusing its axes if it already has them.
+    '''
+    if len(fig.axes) != 2:
+        fig.clear()
+        fig.add_subplot(211)
+        fig.add_subplot(212)
+    ax_pressure, ax_flow = fig.axes
+    ax_pressure.cla()
+    ax_flow.cla()
+    fig.suptitle(name)
+    ax_pressure.plot(t, dp)
+    ax_pressure.set_ylabel('Diff. pressure [mbar]')
+    ax_flow.plot(result['t'], result['flow_rate'])
+    ax_flow.plot(*flow_rate(t, dp, window=0.04))
+    for start, stop in result['puffs']:
+        ax_flow.axvspan(start, stop, color='C2', alpha=0.2)
+    ax_flow.set_title('Injected gas: %.4g mbar-L' % result['injected_gas'], fontsize=10)
+    ax_flow.set_xlabel('t-T1 [s]')
+    ax_flow.set_ylabel('Flow rate [mbar-L/sec]')
+
+
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    name, t, dp = load_shot(sys.argv[1:])
+    result = analyze_shot(t, dp)
+    print_result(result)
+    fig = plt.figure()
+    draw_shot(fig, name, t, dp, result)
+    fig.savefig(name + '.png', dpi=300)
+    plt.show()
@@ -0,0 +1,230 @@
+'''
+Streaming estimates of the plenum pressure and predictive valve control for the middle server's
+pump/fill cycles. The estimator is updated once per acquired batch of absolute gauge readings, and
+control code reads the window mean, the filtered pressure and its rate of change in O(1) instead of
+averaging stored readings. The controller learns from each fill and pump-out how far the pressure
+keeps moving after a valve is told to close, and how much a short V5 pulse adds.
+'''
+
+import numpy as np
+
+
+WINDOW = 1000 # readings in the window mean (0.1 s at 10 kHz)
+RATE_NOISE = 500 # mbar/s per sqrt(s), how quickly the Kalman filter lets the fill/pump rate change
+INITIAL_RATE_STD = 1000 # mbar/s, uncertainty of the rate before the first two batches
+MIN_MEASUREMENT_STD = 0.05 # mbar, floor on the noise of a batch mean (digitisation, drift)
+RESYNC_INTERVAL = 1000 # batches between exact recomputations of the window sum
+DEFAULT_VALVE_LAG = 0.1 # seconds the pressure keeps moving at the close-time rate after a close command, before learning
+MAX_VALVE_LAG = 2 # seconds, upper limit of a learned valve lag
+LEARNING_RATE = 0.3 # weight of the newest measurement in the learned lag and pulse efficiency
+MIN_LEARNING_RATE = 1 # mbar/s, slower closes are too noisy to learn the lag from
+MIN_LEARNING_OPEN = 0.3 # seconds a valve must have been open for its rate estimate to be trusted
+MIN_PULSE = 0.01 # seconds, shortest V5 pulse
+MAX_PULSE = 1 # seconds, longest V5 pulse
+
+
+class PressureEstimator:
+    def __init__(self, sampleRate, window=WINDOW, rateNoise=RATE_NOISE):
+        '''
+        Window mean of the latest readings plus a constant-rate Kalman filter, which gives the
+        pressure at the newest reading without the lag of the window mean, and its rate of change.
+
+        Args:
+            sampleRate: (float) readings per second
+            window: (int) number of readings in the window mean
+            rateNoise: (float) mbar/s per sqrt(s), process noise of the rate
+        '''
+        self.sampleRate = sampleRate
+        self.rateNoise = rateNoise
+        # Latest readings, reading number n at index n % window, and their running sum
+        self.ring = np.zeros(window)
+        self.windowSum = 0.0
+        self.count = 0
+        self.updates = 0
+        # Kalman filter state [mbar, mbar/s] at wall time self.t, and wall time of the newest reading
+        self.state = None
+        self.covariance = None
+        self.t = None
+        self.tLast = None
+
+    def update(self, readings, t):
+        '''
+        Add a batch of readings.
+
+        Args:
+            readings: (NumPy array) absolute pressures in mbar in acquisition order
+            t: (float) wall time of the last reading
+        '''
+        if not len(readings):
+            return
+        self.updateWindow(readings)
+        self.updateFilter(readings, t)
+        self.tLast = t
+
+    def updateWindow(self, readings):
+        window = len(self.ring)
+        new = readings[-window:]
+        index = (self.count + len(readings) - len(new) + np.arange(len(new))) % window
+        # Readings older than the window are still zero in the ring until it has filled up
+        self.windowSum += new.sum() - self.ring[index].sum()
+        self.ring[index] = new
+        self.count += len(readings)
+        self.updates += 1
+        if self.updates % RESYNC_INTERVAL == 0:
+            # Keep rounding errors of the running sum from accumulating
+            self.windowSum = self.ring.sum()
+
+    def updateFilter(self, readings, t):
+        # The batch mean is one measurement, taken at the middle of the batch
+        z = readings.mean()
+        tMeasured = t - (len(readings) - 1)/2/self.sampleRate
+        r = max(readings.var()/len(readings), MIN_MEASUREMENT_STD**2)
+        if self.state is None:
+            self.state = np.array([z, 0.0])
+            self.covariance = np.diag([r, INITIAL_RATE_STD**2])
+            self.t = tMeasured
+            return
+        dt = tMeasured - self.t
+        if dt > 0:
+            f = np.array([[1, dt], [0, 1]])
+            q = self.rateNoise**2*np.array([[dt**3/3, dt**2/2], [dt**2/2, dt]])
+            self.state = f @ self.state
+            self.covariance = f @ self.covariance @ f.T + q
+            self.t = tMeasured
+        gain = self.covariance[:, 0]/(self.covariance[0, 0] + r)
+        self.state = self.state + gain*(z - self.state[0])
+        self.covariance = self.covariance - np.outer(gain, self.covariance[0])
+
+    def windowMean(self):
+        '''
+        Mean of the latest `window` readings (nan before any readings).
+        '''
+        if not self.count:
+            return np.nan
+        return self.windowSum/min(self.count, len(self.ring))
+
+    def pressure(self, t=None):
+        '''
+        Filtered pressure in mbar, extrapolated at the current rate to wall time t (default: the
+        newest reading). nan before any readings.
+        '''
+        if self.state is None:
+            return np.nan
+        if t is None:
+            t = self.tLast
+        return self.state[0] + self.state[1]*(t - self.t)
+
+    def rate(self):
+        '''
+        Rate of change of the pressure in mbar/s (0 before two batches have arrived).
+        '''
+        if self.state is None:
+            return 0.0
+        return self.state[1]
+
+
+class ValveController:
+    def __init__(self):
+        '''
+        Decides when to close the fill/pump valves so the pressure settles on target, and how long
+        to pulse V5 to top up. Learned values are kept for the life of the middle server.
+        '''
+        # Seconds the pressure keeps moving at the close-time rate after a close command: valve
+        # closing time plus gauge and plumbing lag, per valve
+        self.lags = {}
+        # (wall time, pressure) each valve was opened at, and (valve, pressure, rate) of the latest
+        # trusted close
+        self.opened = {}
+        self.lastClose = None
+        # (pressure at open, seconds open) of the latest V5 opening, to seed fillRate from
+        self.lastFill = None
+        # Fill rate (mbar/s) just before V5 last closed, and the fraction of it a pulse achieves
+        self.fillRate = None
+        self.pulseEfficiency = 1.0
+
+    def lag(self, valve):
+        return self.lags.get(valve, DEFAULT_VALVE_LAG)
+
+    def lagLearned(self, valve):
+        return valve in self.lags
+
+    def valveOpened(self, valve, t, pressure):
+        self.opened[valve] = (t, pressure)
+
+    def shouldClose(self, valve, pressure, rate, target, rising):
+        '''
+        True if closing the valve now is predicted to leave the pressure at or past target.
+
+        Args:
+            valve: (string) valve name
+            pressure: (float) filtered pressure now, mbar
+            rate: (float) rate of change now, mbar/s
+            target: (float) mbar
+            rising: (bool) True when filling, False when pumping out
+        '''
+        predicted = pressure + rate*self.lag(valve)
+        return predicted >= target if rising else predicted <= target
+
+    def valveClosed(self, valve, t, pressure, rate):
+        '''
+        Record a close command, to learn from once the pressure has settled (see learnLag and
+        learnFill).
+        '''
+        openTime, openPressure = self.opened.pop(valve, (t, pressure))
+        trusted = t - openTime >= MIN_LEARNING_OPEN
+        self.lastClose = (valve, pressure, rate) if trusted else None
+        if valve == 'V5':
+            self.lastFill = (openPressure, t - openTime)
+            if trusted and rate > 0:
+                self.fillRate = rate
+
+    def learnLag(self, settledPressure):
+        '''
+        Update the lag of the last closed valve from the pressure it settled at.
+
+        Returns:
+            float or None: the lag measured this time (seconds), None if it could not be measured
+        '''
+        if self.lastClose is None:
+            return None
+        valve, pressure, rate = self.lastClose
+        self.lastClose = None
+        if abs(rate) < MIN_LEARNING_RATE:
+            return None
+        measured = min(max((settledPressure - pressure)/rate, 0), MAX_VALVE_LAG)
+        # The first measurement replaces DEFAULT_VALVE_LAG, which is only a guess
+        if valve in self.lags:
+            self.lags[valve] = (1 - LEARNING_RATE)*self.lags[valve] + LEARNING_RATE*measured
+        else:
+            self.lags[valve] = measured
+        return measured
+
+    def learnFill(self, settledPressure):
+        '''
+        Seed the fill rate from the settled rise of the last V5 opening (a fill or a pulse) while no
+        trusted close has set it, so pulses can top up after short fills.
+        '''
+        if self.lastFill is None:
+            return
+        openPressure, duration = self.lastFill
+        self.lastFill = None
+        rise = settledPressure - openPressure
+        if self.fillRate is None and duration > 0 and rise > 0:
+            self.fillRate = rise/duration
+
+    def pulseDuration(self, deficit):
+        '''
+        Seconds to open V5 to raise the pressure by deficit mbar, None if no fill rate is known.
+        '''
+        if not self.fillRate:
+            return None
+        return min(max(deficit/(self.fillRate*self.pulseEfficiency), MIN_PULSE), MAX_PULSE)
+
+    def learnPulse(self, rise, duration):
+        '''
+        Update the pulse efficiency from the settled pressure rise of a pulse.
+        '''
+        if not self.fillRate or duration <= 0 or rise <= 0:
+            return
+        measured = rise/(duration*self.fillRate)
+        self.pulseEfficiency = (1 - LEARNING_RATE)*self.pulseEfficiency + LEARNING_RATE*measured
@@ -0,0 +1,373 @@
+'''
+Continuous recorder for the raw packed pressure words streamed from the RP.
+
+Every word is appended to preallocated, memory-mapped segment files named after the sequence
+number of their first sample. Next to each segment, a small sidecar index holds one
+(sequence number, wall time) record per acquired batch, where the sequence number is that of the
+last sample in the batch. Writing happens on a background thread so the middle server control
+loop only ever pays for a queue put, and old segments are deleted once they are older than the
+configured retention. RAM use is bounded by the queue size and the OS page cache.
+'''
+
+import os
+import glob
+import time
+import queue
+import threading
+import numpy as np
+from gauges import abs_mbar, diff_mbar
+from decimation import minmax_decimate
+
+
+SEGMENT_SAMPLES = 6000000 # samples per segment file (10 minutes at 10 kHz, 24 MB)
+FLUSH_INTERVAL = 5 # seconds between flushes of the active segment to disk
+MAX_QUEUED_BATCHES = 1000 # batches waiting to be written before new ones are dropped
+SAMPLE_TOLERANCE = 0.01 # fraction of a sample period by which a time may miss a sample's time and still include it (float64 wall times are only exact to about 0.3 us)
+WORD_DTYPE = np.dtype('<u4')
+INDEX_DTYPE = np.dtype([('seq', '<i8'), ('time', '<f8')])
+
+
+def segment_paths(folder):
+    '''
+    Return sorted list of (first sequence number, data path, index path) for segments in folder.
+    '''
+    segments = []
+    for dataPath in glob.glob(os.path.join(folder, '*.u32')):
+        name = os.path.basename(dataPath).split('.')[0]
+        segments.append((int(name), dataPath, dataPath[:-len('.u32')] + '.idx'))
+    return sorted(segments)
+
+
+def read_index(indexPath):
+    '''
+    Return the structured (seq, time) array stored in a segment index file. A trailing partial
+    record, which can only be left by a crash mid-write, is ignored.
+    '''
+    with open(indexPath, 'rb') as f:
+        raw = f.read()
+    usable = len(raw) - len(raw) % INDEX_DTYPE.itemsize
+    return np.frombuffer(raw[:usable], dtype=INDEX_DTYPE)
+
+
+class SegmentRecorder:
+    def __init__(self, folder, retention, sampleRate, segmentSamples=SEGMENT_SAMPLES, log=None):
+        '''
+        Args:
+            folder: (string) directory for segment and index files, created if missing
+            retention: (float) seconds after which a finished segment is deleted, None keeps all
+            sampleRate: (float) Hz, used to time samples within a batch
+            segmentSamples: (int) number of words preallocated in each segment file
+            log: function taking (text, level), called from the writer thread when a write fails
+        '''
+        self.folder = folder
+        self.log = log
+        self.retention = retention
+        self.sampleRate = sampleRate
+        self.segmentSamples = segmentSamples
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        # Continue the sequence numbering of any earlier recording in the same folder
+        self.nextSeq = 0
+        segments = segment_paths(folder)
+        if segments:
+            firstSeq, _, indexPath = segments[-1]
+            index = read_index(indexPath)
+            self.nextSeq = int(index['seq'][-1]) + 1 if len(index) else firstSeq
+
+        # Statistics, read by the middle server for health reports
+        self.recordedSamples = 0
+        self.droppedBatches = 0
+        self.failedBatches = 0
+        self.lastError = None
+
+        self.segmentData = None
+        self.indexFile = None
+        self.lastFlush = time.time()
+        self.batchQueue = queue.Queue(maxsize=MAX_QUEUED_BATCHES)
+        self.writerThread = threading.Thread(target=self.writerLoop, name='SegmentRecorder', daemon=True)
+        self.writerThread.start()
+
+    def record(self, words, t):
+        '''
+        Queue a batch of raw words for writing. Never blocks; if the writer has fallen too far
+        behind, the batch is dropped and counted in self.droppedBatches.
+
+        Args:
+            words: (NumPy uint32 array) raw words in acquisition order
+            t: (float) wall time of the last word in the batch
+        '''
+        if len(words) == 0:
+            return
+        try:
+            self.batchQueue.put_nowait((words, t))
+        except queue.Full:
+            self.droppedBatches += 1
+
+    def close(self):
+        '''
+        Write out everything that has been queued and close the active segment.
+        '''
+        self.batchQueue.put(None)
+        self.writerThread.join()
+
+    def writerLoop(self):
+        while True:
+            try:
+                item = self.batchQueue.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                self.writeBatch(*item)
+            if self.segmentData is not None and time.time() - self.lastFlush > FLUSH_INTERVAL:
+                try:
+                    self.segmentData.flush()
+                except OSError as e:
+                    self.writeFailed(e)
+                self.lastFlush = time.time()
+        self.closeSegment()
+
+    def writeBatch(self, words, t):
+        words = np.asarray(words, dtype=WORD_DTYPE)
+        try:
+            self.writeWords(words, t)
+        except Exception as e:
+            # Number the lost words anyway, so later sequence numbers still match their times
+            self.nextSeq = self.batchEndSeq
+            self.failedBatches += 1
+            self.writeFailed(e)
+            return
+        self.lastError = None
+
+    def writeWords(self, words, t):
+        self.batchEndSeq = self.nextSeq + len(words)
+        written = 0
+        while written < len(words):
+            if self.segmentData is None:
+                self.openSegment()
+            n = min(len(words) - written, self.segmentSamples - self.segmentFill)
+            self.segmentData[self.segmentFill:self.segmentFill+n] = words[written:written+n]
+            self.segmentFill += n
+            written += n
+            self.nextSeq += n
+            self.recordedSamples += n
+            # Time of the last word written to this segment
+            tLast = t - (len(words) - written)/self.sampleRate
+            record = np.array([(self.nextSeq - 1, tLast)], dtype=INDEX_DTYPE)
+            self.indexFile.write(record.tobytes())
+            self.indexFile.flush()
+            if self.segmentFill == self.segmentSamples:
+                self.closeSegment()
+
+    def writeFailed(self, error):
+        '''
+        Report a failed write and drop the active segment, so the next batch starts a new one
+        instead of the writer thread stopping.
+        '''
+        # Reported once until a batch is written again, e.g. while the disk stays full
+        if self.log and str(error) != self.lastError:
+            self.log('Recorder: %s. Starting a new segment' % error, 'error')
+        self.lastError = str(error)
+        try:
+            self.closeSegment()
+        except Exception:
+            # Flushing the broken segment can fail the same way; it is let go of regardless
+            pass
+        self.segmentData = None
+        self.indexFile = None
+
+    def openSegment(self):
+        self.pruneSegments()
+        basePath = os.path.join(self.folder, '%012d' % self.nextSeq)
+        with open(basePath + '.u32', 'wb') as f:
+            nBytes = self.segmentSamples*WORD_DTYPE.itemsize
+            # Reserve the disk space up front where the OS allows it
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(f.fileno(), 0, nBytes)
+            else:
+                f.truncate(nBytes)
+        self.segmentData = np.memmap(basePath + '.u32', dtype=WORD_DTYPE, mode='r+', shape=(self.segmentSamples,))
+        self.segmentFill = 0
+        self.indexFile = open(basePath + '.idx', 'ab')
+
+    def closeSegment(self):
+        if self.segmentData is not None:
+            self.segmentData.flush()
+            del self.segmentData
+            self.segmentData = None
+            self.indexFile.close()
+            self.indexFile = None
+
+    def pruneSegments(self):
+        '''
+        Delete segments whose last write is older than the retention time.
+        '''
+        if self.retention is None:
+            return
+        cutoff = time.time() - self.retention
+        for _, dataPath, indexPath in segment_paths(self.folder):
+            if os.path.getmtime(indexPath if os.path.exists(indexPath) else dataPath) < cutoff:
+                for path in [dataPath, indexPath]:
+                    try:
+                        if os.path.exists(path):
+                            os.remove(path)
+                    except OSError as e:
+                        # Retried at the next segment; recording goes on meanwhile
+                        if self.log:
+                            self.log('Recorder: could not delete %s: %s' % (path, e), 'warning')
+
+
+class RecordingReader:
+    def __init__(self, folder, sampleRate):
+        '''
+        Read-only access to the segments written by SegmentRecorder, usable offline or from inside
+        the middle server while recording continues.
+
+        Args:
+            folder: (string) directory holding segment and index files
+            sampleRate: (float) Hz, must match the rate used when recording
+        '''
+        self.folder = folder
+        self.sampleRate = sampleRate
+        # Indices and memory maps of finished segments never change, so they are cached
+        self.indexCache = {}
+        self.mapCache = {}
+        self.refresh()
+
+    def refresh(self):
+        '''
+        Rebuild the combined batch index from the segments currently on disk.
+        '''
+        segments = segment_paths(self.folder)
+        self.segments = []
+        batchStarts, batchEnds, batchTimes = [], [], []
+        for i, (firstSeq, dataPath, indexPath) in enumerate(segments):
+            if not os.path.exists(indexPath):
+                continue
+            finished = i < len(segments) - 1
+            if finished and firstSeq in self.indexCache:
+                index = self.indexCache[firstSeq]
+            else:
+                index = read_index(indexPath)
+                if finished:
+                    self.indexCache[firstSeq] = index
+            if not len(index):
+                continue
+            self.segments.append((firstSeq, int(index['seq'][-1]), dataPath))
+            batchStarts.append(np.concatenate(([firstSeq], index['seq'][:-1]+1)))
+            batchEnds.append(index['seq'])
+            batchTimes.append(index['time'])
+        # Drop caches for segments deleted by the recorder's retention
+        existing = set(s[0] for s in self.segments)
+        for cache in [self.indexCache, self.mapCache]:
+            for firstSeq in list(cache):
+                if firstSeq not in existing:
+                    del cache[firstSeq]
+        if batchEnds:
+            self.batchStarts = np.concatenate(batchStarts)
+            self.batchEnds = np.concatenate(batchEnds)
+            self.batchTimes = np.concatenate(batchTimes)
+        else:
+            self.batchStarts = self.batchEnds = np.zeros(0, dtype=np.int64)
+            self.batchTimes = np.zeros(0)
+
+    def timeRange(self):
+        '''
+        Return (first, last) wall time covered by the recording, or None if it is empty.
+        '''
+        if not len(self.batchEnds):
+            return None
+        first = self.batchTimes[0] - (self.batchEnds[0] - self.batchStarts[0])/self.sampleRate
+        return first, self.batchTimes[-1]
+
+    def sequenceRange(self, t0, t1):
+        '''
+        Return (first, last) sequence numbers of samples with t0 <= time <= t1, or None if there are
+        none. Only the batch index is searched; no sample data is read.
+        '''
+        if not len(self.batchEnds) or t1 < t0:
+            return None
+        # Sample times are computed from batch times in floating point, so a t0 or t1 taken from
+        # sampleTimes may miss its sample by a rounding error
+        tolerance = SAMPLE_TOLERANCE/self.sampleRate
+        i0 = np.searchsorted(self.batchTimes, t0 - tolerance, side='left')
+        if i0 == len(self.batchTimes):
+            return None
+        s0 = max(self.batchStarts[i0], self.batchEnds[i0] - int(np.floor((self.batchTimes[i0] - t0)*self.sampleRate + SAMPLE_TOLERANCE)))
+        j = np.searchsorted(self.batchTimes, t1 + tolerance, side='right')
+        if j == len(self.batchTimes):
+            s1 = self.batchEnds[-1]
+        else:
+            s1 = max(self.batchStarts[j] - 1, int(np.floor(self.batchEnds[j] - (self.batchTimes[j] - t1)*self.sampleRate + SAMPLE_TOLERANCE)))
+        if s1 < s0:
+            return None
+        return int(s0), int(s1)
+
+    def sampleTimes(self, seqs):
+        '''
+        Return wall times for an array of recorded sequence numbers.
+        '''
+        batch = np.searchsorted(self.batchEnds, seqs, side='left')
+        return self.batchTimes[batch] - (self.batchEnds[batch] - seqs)/self.sampleRate
+
+    def readWords(self, s0, s1):
+        '''
+        Return (sequence numbers, raw words) for recorded samples with s0 <= sequence <= s1. Sample
+        numbers belonging to deleted segments are skipped.
+        '''
+        seqs, words = [], []
+        for firstSeq, lastSeq, dataPath in self.segments:
+            if lastSeq < s0 or firstSeq > s1:
+                continue
+            if firstSeq not in self.mapCache:
+                self.mapCache[firstSeq] = np.memmap(dataPath, dtype=WORD_DTYPE, mode='r')
+            a = max(s0, firstSeq)
+            b = min(s1, lastSeq)
+            words.append(np.array(self.mapCache[firstSeq][a-firstSeq:b-firstSeq+1]))
+            seqs.append(np.arange(a, b+1, dtype=np.int64))
+        if not words:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=WORD_DTYPE)
+        return np.concatenate(seqs), np.concatenate(words)
+
+    def words(self, t0, t1):
+        '''
+        Return (times, raw words) for every recorded sample with t0 <= time <= t1.
+        '''
+        seqRange = self.sequenceRange(t0, t1)
+        if seqRange is None:
+            return np.zeros(0), np.zeros(0, dtype=WORD_DTYPE)
+        seqs, words = self.readWords(*seqRange)
+        return self.sampleTimes(seqs), words
+
+    def pressures(self, t0, t1, max_points=None, chunk=1000000):
+        '''
+        Return (t, pAbs, pDiff) in mbar between wall times t0 and t1. If max_points is given, the
+        series is reduced with a min/max envelope so that no spike is lost. Samples are decoded a
+        chunk at a time, so memory use does not depend on the length of the range.
+        '''
+        seqRange = self.sequenceRange(t0, t1)
+        if seqRange is None:
+            return np.zeros(0), np.zeros(0), np.zeros(0)
+        s0, s1 = seqRange
+        nSamples = s1 - s0 + 1
+        if max_points is None or nSamples <= max_points:
+            seqs, words = self.readWords(s0, s1)
+            return self.sampleTimes(seqs), abs_mbar(words), diff_mbar(words)
+        # Chunk boundaries are aligned to whole envelope buckets so every bucket is reduced once
+        bucketSize = int(np.ceil(nSamples/(max_points//2)))
+        chunk = max(bucketSize, chunk - chunk % bucketSize)
+        parts = []
+        for start in range(s0, s1+1, chunk):
+            seqs, words = self.readWords(start, min(s1, start+chunk-1))
+            if not len(words):
+                continue
+            nPoints = 2*int(np.ceil(len(words)/bucketSize))
+            parts.append(minmax_decimate(self.sampleTimes(seqs), [abs_mbar(words), diff_mbar(words)], nPoints))
+        if not parts:
+            return np.zeros(0), np.zeros(0), np.zeros(0)
+        t = np.concatenate([p[0] for p in parts])
+        pAbs = np.concatenate([p[1][0] for p in parts])
+        pDiff = np.concatenate([p[1][1] for p in parts])
+        return t, pAbs, pDiff
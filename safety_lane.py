@@ -0,0 +1,83 @@
+'''
+Dedicated command channel for safety commands to the middle server. XML-RPC requests are only
+handled once per control loop iteration, behind data acquisition and queued tasks; the safety lane
+has its own thread that is always waiting for a connection, so a "Cancel and reset valves" click
+reaches the hardware without waiting for the main loop.
+
+Protocol: the client connects, sends one JSON line {"command": name} and gets one JSON line back,
+{"ok": bool, "error": string or null, "handling_ms": float}, once the handler has returned.
+'''
+
+import json
+import time
+import socket
+import threading
+import collections
+
+
+CLIENT_TIMEOUT = 1 # seconds a connected client has to send its command
+COMMAND_TIMEOUT = 2 # seconds send_safety_command waits for the reply
+LATENCY_HISTORY = 100 # number of handling times kept for reporting
+
+
+def send_safety_command(host, port, command, timeout=COMMAND_TIMEOUT):
+    '''
+    Send a command over the safety lane and wait until the middle server has carried it out.
+
+    Returns:
+        dict: the server's reply plus 'round_trip_ms', the time from this call to the reply
+    '''
+    start = time.perf_counter()
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall((json.dumps({'command': command}) + '\n').encode('utf-8'))
+        reply = json.loads(sock.makefile('r', encoding='utf-8').readline())
+    reply['round_trip_ms'] = (time.perf_counter() - start)*1000
+    return reply
+
+
+class SafetyLane:
+    def __init__(self, port, handler, host='0.0.0.0'):
+        '''
+        Args:
+            port: (int) TCP port of the safety lane
+            handler: function taking the command name, called from the safety lane thread. It
+                should raise an exception for unknown commands.
+            host: (string) interface to listen on
+        '''
+        self.handler = handler
+        # Handling times in ms, from the command being read to the handler returning
+        self.latencies = collections.deque(maxlen=LATENCY_HISTORY)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen()
+        self.thread = threading.Thread(target=self.run, name='SafetyLane', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        # Commands are handled one at a time in this thread, so two clicks cannot interleave
+        while True:
+            try:
+                conn, address = self.listener.accept()
+            except OSError:
+                break
+            with conn:
+                try:
+                    conn.settimeout(CLIENT_TIMEOUT)
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    command = json.loads(conn.makefile('r', encoding='utf-8').readline())['command']
+                    start = time.perf_counter()
+                    try:
+                        self.handler(command)
+                        reply = {'ok': True, 'error': None}
+                    except Exception as e:
+                        reply = {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}
+                    reply['handling_ms'] = (time.perf_counter() - start)*1000
+                    self.latencies.append(reply['handling_ms'])
+                    conn.sendall((json.dumps(reply) + '\n').encode('utf-8'))
+                except (OSError, ValueError, KeyError, TypeError) as e:
+                    print('SafetyLane', address, e)
+
+    def close(self):
+        self.listener.close()
@@ -0,0 +1,190 @@
+'''
+Ring buffer of raw pressure words in shared memory, for consumers on the same computer as the
+middle server. The middle server writes every word it acquires; readers attach by name and take
+NumPy views of the latest data at any rate without a request to the server.
+
+Layout: a 64-byte header followed by `capacity` little-endian uint32 words. The word with sequence
+number s (counted from 0 since the ring was created) is at index s % capacity. The header's
+seqlock counter is odd while the writer is updating the ring, so a reader that sees the same even
+value before and after a read knows the header it read is consistent. Data views are checked
+afterwards with isValid, since the writer may overwrite the oldest words at any time.
+'''
+
+import time
+import numpy as np
+from multiprocessing import shared_memory
+from gauges import abs_mbar, diff_mbar
+
+
+RING_NAME = 'gpi_pressure' # default shared memory name
+MAGIC = 0x47504952 # 'GPIR'
+VERSION = 1
+HEADER_SIZE = 64
+HEADER_DTYPE = np.dtype([('magic', '<u4'),
+                         ('version', '<u4'),
+                         ('capacity', '<u8'),
+                         ('sample_rate', '<f8'),
+                         ('seqlock', '<u8'),
+                         ('write_count', '<u8'), # sequence number of the next word
+                         ('last_time', '<f8')])  # wall time of the newest word
+WORD_DTYPE = np.dtype('<u4')
+RETRIES = 1000 # reads attempted while the writer keeps the seqlock busy
+
+
+def attach(name):
+    '''
+    Attach to an existing shared memory segment without letting this process's resource tracker
+    delete it on exit.
+    '''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 always tracks the segment, so unregister it by hand
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class SharedRingWriter:
+    def __init__(self, capacity, sampleRate, name=RING_NAME):
+        '''
+        Args:
+            capacity: (int) number of words kept
+            sampleRate: (float) samples per second, stored for readers
+            name: (string) shared memory name readers attach to
+        '''
+        size = HEADER_SIZE + capacity*WORD_DTYPE.itemsize
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Left over from a server that did not shut down cleanly
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.header = np.ndarray((), dtype=HEADER_DTYPE, buffer=self.shm.buf)
+        self.ring = np.ndarray(capacity, dtype=WORD_DTYPE, buffer=self.shm.buf, offset=HEADER_SIZE)
+        self.capacity = capacity
+        self.writeCount = 0
+        self.header['magic'] = MAGIC
+        self.header['version'] = VERSION
+        self.header['capacity'] = capacity
+        self.header['sample_rate'] = sampleRate
+        self.header['seqlock'] = 0
+        self.header['write_count'] = 0
+        self.header['last_time'] = 0
+
+    def write(self, words, t):
+        '''
+        Append words to the ring.
+
+        Args:
+            words: (NumPy uint32 array) raw words in acquisition order
+            t: (float) wall time of the last word
+        '''
+        n = len(words)
+        if n > self.capacity:
+            words = words[-self.capacity:]
+        start = (self.writeCount + n - len(words)) % self.capacity
+        first = min(len(words), self.capacity - start)
+        self.header['seqlock'] += 1
+        self.ring[start:start+first] = words[:first]
+        self.ring[:len(words)-first] = words[first:]
+        self.writeCount += n
+        self.header['write_count'] = self.writeCount
+        self.header['last_time'] = t
+        self.header['seqlock'] += 1
+
+    def close(self):
+        del self.header, self.ring
+        self.shm.close()
+        self.shm.unlink()
+
+
+class SharedRingReader:
+    def __init__(self, name=RING_NAME):
+        '''
+        Args:
+            name: (string) shared memory name used by the SharedRingWriter
+        '''
+        self.shm = attach(name)
+        self.header = np.ndarray((), dtype=HEADER_DTYPE, buffer=self.shm.buf)
+        if self.header['magic'] != MAGIC or self.header['version'] != VERSION:
+            raise ValueError('%s is not a version %d pressure ring' % (name, VERSION))
+        self.capacity = int(self.header['capacity'])
+        self.sampleRate = float(self.header['sample_rate'])
+        self.ring = np.ndarray(self.capacity, dtype=WORD_DTYPE, buffer=self.shm.buf, offset=HEADER_SIZE)
+
+    def state(self):
+        '''
+        Returns:
+            (int, float): sequence number of the next word to be written and wall time of the
+                newest word
+        '''
+        for _ in range(RETRIES):
+            before = int(self.header['seqlock'])
+            writeCount = int(self.header['write_count'])
+            lastTime = float(self.header['last_time'])
+            if before % 2 == 0 and int(self.header['seqlock']) == before:
+                return writeCount, lastTime
+            time.sleep(0)
+        raise TimeoutError('Pressure ring writer did not finish an update')
+
+    def isValid(self, s0, writeCount=None):
+        '''
+        True if the word with sequence number s0 has not been overwritten yet.
+        '''
+        if writeCount is None:
+            writeCount, _ = self.state()
+        return writeCount - s0 <= self.capacity
+
+    def view(self, s0, s1):
+        '''
+        Words with sequence numbers s0 to s1-1. This is a zero-copy view unless the range wraps
+        around the end of the ring. Check isValid(s0) after using a view; the oldest words may be
+        overwritten at any time.
+        '''
+        if s1 - s0 > self.capacity:
+            raise ValueError('Range is longer than the ring')
+        i0, i1 = s0 % self.capacity, s1 % self.capacity
+        if s1 == s0:
+            return self.ring[:0]
+        if i0 < i1 or i1 == 0:
+            return self.ring[i0:i1 or self.capacity]
+        return np.concatenate((self.ring[i0:], self.ring[:i1]))
+
+    def read(self, s0, s1=None):
+        '''
+        Copy of the words from sequence number s0 (clipped to the oldest word still in the ring)
+        up to s1, or up to the newest word if s1 is None.
+
+        Returns:
+            (NumPy uint32 array, int, float): words, sequence number of the first word and wall
+                time of the word before s1
+        '''
+        for _ in range(RETRIES):
+            writeCount, lastTime = self.state()
+            end = writeCount if s1 is None else min(s1, writeCount)
+            start = min(max(s0, writeCount - self.capacity), end)
+            words = np.array(self.view(start, end))
+            if self.isValid(start):
+                return words, start, lastTime - (writeCount - end)/self.sampleRate
+        raise TimeoutError('Pressure ring reader could not keep up with the writer')
+
+    def latest(self, seconds):
+        '''
+        Pressures over the last seconds of data.
+
+        Returns:
+            (NumPy array, NumPy array, NumPy array): wall times, absolute and differential pressure
+                in mbar
+        '''
+        writeCount, _ = self.state()
+        words, start, lastTime = self.read(writeCount - int(seconds*self.sampleRate), writeCount)
+        t = lastTime - np.arange(len(words)-1, -1, -1)/self.sampleRate
+        return t, abs_mbar(words), diff_mbar(words)
+
+    def close(self):
+        del self.header, self.ring
+        self.shm.close()
@@ -0,0 +1,133 @@
+'''
+Per-campaign archive of shot data. Each shot is one compressed .npz file holding the raw pressure
+words and a JSON metadata record (calibration, handleT0 parameters, fill pressure, event log and
+valve timeline). An append-only index.jsonl file with one line per shot lets shots be listed and
+loaded without globbing the folder.
+'''
+
+import os
+import json
+import threading
+import numpy as np
+from gauges import abs_mbar, diff_mbar
+
+
+INDEX_FILE = 'index.jsonl'
+# Metadata kept in the index so shots can be listed without opening their files
+INDEX_KEYS = ['shot_id', 'file', 'T1', 't_start', 'n_samples', 'fill_pressure']
+
+
+def load_shot_file(path):
+    '''
+    Load one shot file written by ShotArchive.save.
+
+    Returns:
+        dict: the stored metadata plus 'words' (raw uint32 array), 't' (seconds relative to T1)
+            and 'abs'/'diff' (mbar, decoded with the calibration saved with the shot)
+    '''
+    with np.load(path) as f:
+        words = f['words']
+        shot = json.loads(str(f['meta']))
+    shot['words'] = words
+    shot['t'] = shot['t_start'] - shot['T1'] + np.arange(len(words))/shot['sample_rate']
+    calibration = shot.get('calibration')
+    if calibration:
+        shot['abs'] = abs_mbar(words, calibration)
+        shot['diff'] = diff_mbar(words, calibration)
+    else:
+        shot['abs'] = abs_mbar(words)
+        shot['diff'] = diff_mbar(words)
+    return shot
+
+
+class ShotArchive:
+    def __init__(self, folder):
+        '''
+        Args:
+            folder: (string) campaign directory, created if missing
+        '''
+        self.folder = folder
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.indexPath = os.path.join(folder, INDEX_FILE)
+        # shot_id -> index entry, in the order shots were saved
+        self.index = {}
+        # Held while the index is changed or read, so one thread can save while others look up
+        self.lock = threading.Lock()
+        if os.path.exists(self.indexPath):
+            with open(self.indexPath) as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        # Last line still being written by another process or thread
+                        break
+                    line = line.strip()
+                    if line:
+                        self.addToIndex(json.loads(line))
+
+    def listShots(self):
+        '''
+        Return the index entries of all shots, oldest first.
+        '''
+        with self.lock:
+            return list(self.index.values())
+
+    def __contains__(self, shotId):
+        with self.lock:
+            return int(shotId) in self.index
+
+    def save(self, shot):
+        '''
+        Store a shot record as produced by RPServer.finishShot and add it to the index. Saving
+        a shot id that is already archived replaces its file and index entry.
+
+        Args:
+            shot: (dict) must have 'shot_id', 'T1', 't_start', 'sample_rate' and 'words' (uint32
+                array or bytes); every other key is stored as JSON metadata
+        Returns:
+            string: path of the shot file
+        '''
+        shotId = int(shot['shot_id'])
+        words = shot['words']
+        if isinstance(words, (bytes, bytearray)):
+            words = np.frombuffer(words, dtype='<u4')
+        meta = {key: value for key, value in shot.items() if key != 'words'}
+        meta['shot_id'] = shotId
+        meta['n_samples'] = len(words)
+        filename = 'shot_%d.npz' % shotId
+        path = os.path.join(self.folder, filename)
+        np.savez_compressed(path, words=np.asarray(words, dtype='<u4'), meta=np.array(json.dumps(meta)))
+
+        entry = {key: meta.get(key) for key in INDEX_KEYS}
+        entry['file'] = filename
+        with open(self.indexPath, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        self.addToIndex(entry)
+        return path
+
+    def addToIndex(self, entry):
+        # A re-saved shot moves to the end, so latest() returns the last one saved
+        with self.lock:
+            self.index.pop(entry['shot_id'], None)
+            self.index[entry['shot_id']] = entry
+
+    def load(self, shotId):
+        '''
+        Load a shot by id. See load_shot_file for the returned dict.
+        '''
+        return load_shot_file(self.path(shotId))
+
+    def path(self, shotId):
+        '''
+        Return the path of the file holding a shot.
+        '''
+        with self.lock:
+            return os.path.join(self.folder, self.index[int(shotId)]['file'])
+
+    def latest(self):
+        '''
+        Return the id of the most recently saved shot, or None if the archive is empty.
+        '''
+        with self.lock:
+            if not self.index:
+                return None
+            return next(reversed(self.index))
@@ -0,0 +1,84 @@
+'''
+Middle server side capture of shot pressure data. A ShotCapture preallocates a buffer of raw words
+covering the whole shot when T0 is received, and a ShotPersister writes finished shots to a
+ShotArchive on a background thread so saving never blocks the control loop.
+'''
+
+import queue
+import threading
+import numpy as np
+from shot_archive import ShotArchive
+
+
+CAPTURE_MARGIN = 1 # seconds of buffer beyond the end of the shot, to absorb acquisition timing jitter
+
+
+class ShotCapture:
+    def __init__(self, shotId, t0, tDone, sampleRate):
+        '''
+        Args:
+            shotId: (int) id the shot will be stored under
+            t0: (float) wall time from which samples are kept
+            tDone: (float) wall time at which the shot is over
+            sampleRate: (float) Hz
+        '''
+        self.shotId = shotId
+        self.t0 = t0
+        self.tDone = tDone
+        self.sampleRate = sampleRate
+        self.words = np.zeros(int(np.ceil((tDone - t0 + CAPTURE_MARGIN)*sampleRate)), dtype='<u4')
+        self.fill = 0
+        self.tStart = None
+
+    def add(self, words, tLast):
+        '''
+        Copy a batch of raw words into the buffer, skipping any that came before T0. Words that do
+        not fit in the buffer are well past the end of the shot and are ignored.
+
+        Args:
+            words: (NumPy uint32 array) raw words in acquisition order
+            tLast: (float) wall time of the last word in the batch
+        '''
+        if self.tStart is None:
+            tFirst = tLast - (len(words) - 1)/self.sampleRate
+            skip = max(0, int(np.ceil((self.t0 - tFirst)*self.sampleRate)))
+            if skip >= len(words):
+                return
+            self.tStart = tFirst + skip/self.sampleRate
+            words = words[skip:]
+        n = min(len(words), len(self.words) - self.fill)
+        self.words[self.fill:self.fill+n] = words[:n]
+        self.fill += n
+
+    def isComplete(self):
+        return self.fill == len(self.words) or (self.tStart is not None and self.tStart + self.fill/self.sampleRate >= self.tDone)
+
+    def capturedWords(self):
+        return self.words[:self.fill]
+
+
+class ShotPersister:
+    def __init__(self, folder, log):
+        '''
+        Args:
+            folder: (string) ShotArchive folder for the middle server's copy of every shot
+            log: function taking (text, level), called from the persister thread on save
+                failures, so it must be safe to call from another thread
+        '''
+        # Index read once here and kept up to date by each save, for lookups from other threads
+        self.archive = ShotArchive(folder)
+        self.log = log
+        self.shotQueue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='ShotPersister', daemon=True)
+        self.thread.start()
+
+    def persist(self, shot):
+        self.shotQueue.put(shot)
+
+    def run(self):
+        while True:
+            shot = self.shotQueue.get()
+            try:
+                self.archive.save(shot)
+            except Exception as e:
+                self.log('Saving shot %s failed: %s' % (shot['shot_id'], e), 'error')
@@ -0,0 +1,233 @@
+'''
+Publish/subscribe channel for middle server status. The middle server reads the hardware once per
+tick and pushes what changed to every subscriber over a local TCP port, so the number of GUIs and
+monitoring scripts does not multiply the Koheron traffic.
+
+Each message is a 4-byte big-endian length followed by that many bytes of UTF-8 JSON. The first
+message a subscriber gets is a snapshot:
+    {'type': 'snapshot', 'status': {...}, 'points': [[t, abs, diff], ...], 'messages': []}
+followed by one update per tick that has something new:
+    {'type': 'update', 'status': {changed keys only}, 'points': [new points], 'messages': [[level, text], ...]}
+A subscriber that falls more than SUBSCRIBER_QUEUE messages behind has its backlog replaced by a
+new snapshot, so a slow client loses points and log messages but never slows down the server.
+'''
+
+import json
+import queue
+import socket
+import struct
+import threading
+import collections
+
+
+SUBSCRIBER_QUEUE = 50 # messages buffered per subscriber before its backlog is replaced by a snapshot
+SNAPSHOT_POINTS = 300 # number of recent downsampled points sent to new subscribers
+SEND_TIMEOUT = 10 # seconds a subscriber may block a send before it is disconnected
+RECONNECT_INTERVAL = 1 # seconds between StatusClient connection attempts
+HEADER = struct.Struct('>I')
+
+
+def to_builtin(value):
+    # NumPy scalars and arrays are not JSON serializable
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError('%s is not JSON serializable' % type(value).__name__)
+
+
+def pack_message(message):
+    '''
+    Return a message dict framed for sending.
+    '''
+    body = json.dumps(message, default=to_builtin).encode('utf-8')
+    return HEADER.pack(len(body)) + body
+
+
+def recv_exactly(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError('Stream closed')
+        data += chunk
+    return bytes(data)
+
+
+def recv_message(sock):
+    '''
+    Read one framed message from a socket and return it as a dict.
+    '''
+    length, = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    return json.loads(recv_exactly(sock, length).decode('utf-8'))
+
+
+class Subscriber:
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.frames = queue.Queue(maxsize=SUBSCRIBER_QUEUE)
+        self.droppedMessages = 0
+        self.closed = False
+
+    def offer(self, frame):
+        '''
+        Queue a frame without blocking. Returns False if the queue is full.
+        '''
+        try:
+            self.frames.put_nowait(frame)
+            return True
+        except queue.Full:
+            return False
+
+    def reset(self, snapshot):
+        '''
+        Replace the backlog of a subscriber that fell behind with a snapshot frame.
+        '''
+        while True:
+            try:
+                self.frames.get_nowait()
+                self.droppedMessages += 1
+            except queue.Empty:
+                break
+        self.offer(snapshot)
+
+
+class StatusPublisher:
+    def __init__(self, port=None, host='0.0.0.0', pack=pack_message):
+        '''
+        Args:
+            port: (int) TCP port subscribers connect to, or None if subscribers are added with
+                subscribe by another server (see dashboard.py)
+            host: (string) interface to listen on
+            pack: function framing a message dict as bytes for the subscribers' protocol
+        '''
+        self.pack = pack
+        self.status = {}
+        self.points = collections.deque(maxlen=SNAPSHOT_POINTS)
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.listener = None
+        if port is not None:
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind((host, port))
+            self.listener.listen()
+            self.thread = threading.Thread(target=self.acceptLoop, name='StatusPublisher', daemon=True)
+            self.thread.start()
+
+    def hasSubscribers(self):
+        return bool(self.subscribers)
+
+    def snapshot(self):
+        return self.pack({'type': 'snapshot', 'status': self.status, 'points': list(self.points), 'messages': []})
+
+    def acceptLoop(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.subscribe, args=(sock, address), name='StatusSubscriber', daemon=True).start()
+
+    def subscribe(self, sock, address):
+        '''
+        Send a snapshot and then every published update to a connected socket until it is closed or
+        stops accepting data. Blocks the calling thread, which should be dedicated to this
+        subscriber.
+        '''
+        sock.settimeout(SEND_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        subscriber = Subscriber(sock, address)
+        with self.lock:
+            subscriber.offer(self.snapshot())
+            self.subscribers.append(subscriber)
+        try:
+            while not subscriber.closed:
+                subscriber.sock.sendall(subscriber.frames.get())
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                if subscriber in self.subscribers:
+                    self.subscribers.remove(subscriber)
+            subscriber.sock.close()
+
+    def publish(self, status, points, messages):
+        '''
+        Send what changed since the last call to every subscriber. Never blocks on the network.
+
+        Args:
+            status: (dict) full current status, only keys whose values changed are sent. None if
+                the status was not read, for example because there are no subscribers
+            points: list of new [t, abs, diff] downsampled points, also kept for snapshots
+            messages: list of new [level, text] log messages
+        '''
+        status = status or {}
+        delta = {key: value for key, value in status.items() if key not in self.status or self.status[key] != value}
+        with self.lock:
+            # Under the lock because acceptLoop builds snapshots from these
+            self.status.update(status)
+            self.points.extend(points)
+            if not (delta or points or messages):
+                return
+            frame = self.pack({'type': 'update', 'status': delta, 'points': points, 'messages': messages})
+            for subscriber in self.subscribers:
+                if not subscriber.offer(frame):
+                    subscriber.reset(self.snapshot())
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+        with self.lock:
+            for subscriber in self.subscribers:
+                subscriber.closed = True
+                subscriber.sock.close()
+
+
+class StatusClient:
+    def __init__(self, host, port):
+        '''
+        Subscribe to a StatusPublisher from a background thread, reconnecting whenever the
+        connection is lost. Received messages are put in self.messages; a {'type': 'disconnected'}
+        message is put there when the connection drops or cannot be made.
+        '''
+        self.host = host
+        self.port = port
+        self.messages = queue.Queue()
+        self.running = True
+        self.sock = None
+        self.thread = threading.Thread(target=self.run, name='StatusClient', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            try:
+                self.sock = socket.create_connection((self.host, self.port), timeout=RECONNECT_INTERVAL)
+                self.sock.settimeout(None)
+                while self.running:
+                    self.messages.put(recv_message(self.sock))
+            except (OSError, ValueError) as e:
+                self.messages.put({'type': 'disconnected', 'error': str(e)})
+            finally:
+                if self.sock is not None:
+                    self.sock.close()
+            if self.running:
+                threading.Event().wait(RECONNECT_INTERVAL)
+
+    def getMessages(self):
+        '''
+        Return list of messages received since the last call, without blocking.
+        '''
+        received = []
+        while True:
+            try:
+                received.append(self.messages.get_nowait())
+            except queue.Empty:
+                return received
+
+    def stop(self):
+        self.running = False
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass